@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the crawl pipeline without network: pages of photos.getPhotos response are parsed and saved
+by the remote manager, seconds of phases are measured by the profile run.
+With argument cprofile or sampling profiles of phases are written to benchmarks/profiles for
+./manage.py odnoklassniki_photos_profile_summary.
+Exits with status 1, if any pass takes more than --max-ms milliseconds (MAX_MS by default, 0 - no check).
+
+    $ python benchmarks/bench_crawl.py [cprofile|sampling] [--max-ms=N]
+'''
+from bench_parse import photo_resource, GROUP_ID, ALBUM_ID, PAGE_SIZE
+from common import check_max_ms, pop_max_ms, setup_django
+import os
+import shutil
+import sys
+import tempfile
+
+PAGES = 20
+MAX_MS = 20000
+
+
+def main():
+    max_ms = pop_max_ms(MAX_MS)
+    setup_django()
+
+    from odnoklassniki_groups.factories import GroupFactory
+    from odnoklassniki_photos.factories import AlbumFactory
+    from odnoklassniki_photos.models import Photo
+    from odnoklassniki_photos.profiling import profile_run
+
+    group = GroupFactory(id=GROUP_ID)
+    AlbumFactory(id=ALBUM_ID, owner=group)
+    pages = [[photo_resource(page * PAGE_SIZE + i) for i in range(PAGE_SIZE)] for page in range(PAGES)]
+
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'cprofile'
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles') if len(sys.argv) > 1 \
+        else tempfile.mkdtemp()
+
+    # the first pass creates photos, the second one updates them
+    measurements = []
+    try:
+        for action in ['create', 'update']:
+            with profile_run('bench_crawl_%s' % action, mode=mode, directory=directory) as run:
+                for page in pages:
+                    Photo.remote.save_instances(Photo.remote.parse_response_list(page))
+
+            print('%d pages of %d photos, %s: %s' % (PAGES, PAGE_SIZE, action, ', '.join(
+                ['%s %.2f ms' % (phase, seconds * 1000) for phase, seconds in sorted(run.seconds.items())])))
+            measurements += [(action, sum(run.seconds.values()))]
+    finally:
+        if len(sys.argv) == 1:
+            shutil.rmtree(directory)
+    check_max_ms(measurements, max_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of parsing pages of photos.getPhotos response.
+Exits with status 1, if parsing by page takes more than --max-ms milliseconds (MAX_MS by default, 0 - no check).
+
+    $ python benchmarks/bench_parse.py [--max-ms=N]
+'''
+from common import check_max_ms, pop_max_ms, setup_django, timeit
+
+GROUP_ID = 50415375614101
+ALBUM_ID = 51324428026005
+PAGE_SIZE = 100
+MAX_MS = 100
+
+
+def photo_resource(i):
+    resource = {
+        'album_id': str(ALBUM_ID),
+        'group_id': str(GROUP_ID),
+        'id': str(544442732181 + i),
+        'author_name': u'РИА Новости',
+        'author_type': 'GROUP',
+        'created_ms': 1390456312257 + i,
+        'comments_count': 4,
+        'like_summary': {'count': 147, 'last_like_date_ms': 1397655462641 + i},
+        'standard_height': 768,
+        'standard_width': 768,
+        'text': u'Если вы ' * 20,
+    }
+    for size in ['1024max', '1024x768', '128max', '128x128', '180min', '190x190', '240min', '320min', '50x50', '640x480']:
+        resource['pic' + size] = 'http://dg52.mycdn.me/getImage?photoId=%d&photoType=%s' % (544442732181 + i, size)
+    return resource
+
+
+def main():
+    max_ms = pop_max_ms(MAX_MS)
+    setup_django()
+
+    from odnoklassniki_api.models import OdnoklassnikiManager
+    from odnoklassniki_groups.factories import GroupFactory
+    from odnoklassniki_photos.factories import AlbumFactory
+    from odnoklassniki_photos.models import Photo
+
+    group = GroupFactory(id=GROUP_ID)
+    AlbumFactory(id=ALBUM_ID, owner=group)
+    page = [photo_resource(i) for i in range(PAGE_SIZE)]
+
+    per_resource = timeit(lambda: OdnoklassnikiManager.parse_response_list(Photo.remote, page))
+    per_page = timeit(lambda: Photo.remote.parse_response_list(page))
+
+    print('Page of %d photos, parsed resource by resource: %.2f ms' % (PAGE_SIZE, per_resource * 1000))
+    print('Page of %d photos, parsed by page: %.2f ms' % (PAGE_SIZE, per_page * 1000))
+    check_max_ms([('parsing of page', per_page)], max_ms)
+
+
+if __name__ == '__main__':
+    main()
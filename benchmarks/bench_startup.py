@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of startup cost of worker process: time and memory of importing models of the app.
+Every measurement is made in the fresh interpreter.
+Exits with status 1, if the best import takes more than --max-ms milliseconds (MAX_MS by default, 0 - no check).
+
+    $ python benchmarks/bench_startup.py [--max-ms=N]
+'''
+from common import check_max_ms, pop_max_ms, setup_django
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+REPEAT = 5
+MAX_MS = 200
+
+
+def get_maxrss_kb():
+    # ru_maxrss is in kilobytes on linux and in bytes on mac os
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 if sys.platform == 'darwin' else maxrss
+
+
+def measure():
+    '''
+    Import models in the current interpreter and print measurements as JSON
+    '''
+    started = time.time()
+    rss_before = get_maxrss_kb()
+    setup_django(syncdb=False)
+    modules_before = len(sys.modules)
+    settings_seconds = time.time() - started
+
+    started = time.time()
+    import odnoklassniki_photos.models
+    import_seconds = time.time() - started
+
+    print(json.dumps({
+        'settings_seconds': settings_seconds,
+        'import_seconds': import_seconds,
+        'modules': len(sys.modules) - modules_before,
+        'rss_kb': get_maxrss_kb() - rss_before,
+    }))
+
+
+def main():
+    max_ms = pop_max_ms(MAX_MS)
+    results = []
+    for i in range(REPEAT):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'])
+        results += [json.loads(output.decode('utf-8').strip().splitlines()[-1])]
+
+    best = min(results, key=lambda result: result['import_seconds'])
+    print('Import of odnoklassniki_photos.models: %.1f ms, %d modules, +%d KB max RSS (best of %d)' % (
+        best['import_seconds'] * 1000, best['modules'], best['rss_kb'], REPEAT))
+    print('Configuring of settings: %.1f ms' % (best['settings_seconds'] * 1000))
+    check_max_ms([('import of models', best['import_seconds'])], max_ms)
+
+
+if __name__ == '__main__':
+    if '--child' in sys.argv:
+        measure()
+    else:
+        main()
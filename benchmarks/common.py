@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+
+DIRNAME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django(syncdb=True):
+    '''
+    Configure Django with in-memory database and tables of the app, the same way quicktest.py does
+    '''
+    sys.path.insert(0, DIRNAME)
+    from django.conf import settings
+    from quicktest import QuickDjangoTest
+    import settings_test
+
+    custom_settings = dict([(key, getattr(settings_test, key)) for key in dir(settings_test) if key.isupper()])
+    INSTALLED_APPS = custom_settings.pop('INSTALLED_APPS', ())
+    settings.configure(
+        DEBUG=False,
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        INSTALLED_APPS=QuickDjangoTest.INSTALLED_APPS + INSTALLED_APPS + ('odnoklassniki_photos',),
+        **custom_settings
+    )
+    if syncdb:
+        from django.core.management import call_command
+        call_command('syncdb', interactive=False, verbosity=0)
+
+
+def timeit(func, repeat=5):
+    '''
+    Return the best time of `repeat` runs of func in seconds
+    '''
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        func()
+        spent = time.time() - started
+        best = spent if best is None else min(best, spent)
+    return best
+
+
+def pop_max_ms(default):
+    '''
+    Return threshold of regression in milliseconds: value of argument --max-ms=N, that is removed from sys.argv,
+    or `default`. Threshold 0 disables the check
+    '''
+    for arg in sys.argv[1:]:
+        if arg.startswith('--max-ms='):
+            sys.argv.remove(arg)
+            return float(arg.split('=', 1)[1])
+    return default
+
+
+def check_max_ms(measurements, max_ms):
+    '''
+    Exit with status 1, if any of `measurements` (list of tuples (name, seconds)) took more than `max_ms` milliseconds
+    '''
+    slow = [(name, seconds) for name, seconds in measurements if max_ms and seconds * 1000 > max_ms]
+    for name, seconds in slow:
+        print('Regression: %s took %.2f ms, more than %.2f ms' % (name, seconds * 1000, max_ms))
+    if slow:
+        sys.exit(1)
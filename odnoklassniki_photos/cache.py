@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from .routing import after_fetching
+from collections import OrderedDict
+import threading
+import time
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    from django.core.cache import get_cache
+
+CACHE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_CACHE', False)
+CACHE_BACKEND = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_CACHE_BACKEND', 'default')
+CACHE_TIMEOUT = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_CACHE_TIMEOUT', 300)
+# local cache of the process isn't invalidated by other processes, so it keeps rows for a short time
+CACHE_LOCAL_SIZE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_CACHE_LOCAL_SIZE', 10000)
+CACHE_LOCAL_TIMEOUT = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_CACHE_LOCAL_TIMEOUT', 5)
+
+
+class LocalCache(object):
+    '''
+    In-process LRU cache of limited size with expiration of values
+    '''
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.values.pop(key, None)
+            if item is None or item[0] < time.time():
+                return None
+            self.values[key] = item
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = (time.time() + self.timeout, value)
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+
+class InstanceCache(object):
+    '''
+    Read-through cache of rows of the model by pk: local LRU cache of the process in front of Django cache backend.
+    Rows are stored as tuples of values of concrete fields, not as pickled instances
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.fields = [field.attname for field in model._meta.fields]
+        self.local = LocalCache(CACHE_LOCAL_SIZE, CACHE_LOCAL_TIMEOUT)
+        self.prefix = 'odnoklassniki_photos:%s:%s:' % (model._meta.app_label, model._meta.object_name.lower())
+
+    @property
+    def backend(self):
+        return get_cache(CACHE_BACKEND)
+
+    def get_key(self, pk):
+        return '%s%s' % (self.prefix, pk)
+
+    def get_instance(self, values):
+        instance = self.model(*values)
+        instance._state.adding = False
+        instance._state.db = self.model.objects.db
+        return instance
+
+    def get_many(self, pks):
+        '''
+        Return dict of pk -> instance, rows missing in caches are read from the database by one query
+        '''
+        rows = {}
+        missing = []
+        for pk in pks:
+            values = self.local.get(self.get_key(pk))
+            if values is None:
+                missing += [pk]
+            else:
+                rows[pk] = values
+
+        if missing:
+            found = self.backend.get_many([self.get_key(pk) for pk in missing])
+            for pk in missing:
+                values = found.get(self.get_key(pk))
+                if values is not None:
+                    rows[pk] = values
+                    self.local.set(self.get_key(pk), values)
+
+        missing = [pk for pk in missing if pk not in rows]
+        if missing:
+            stored = {}
+            for values in self.model.objects.filter(pk__in=missing).values_list(*self.fields):
+                pk = values[self.fields.index(self.model._meta.pk.attname)]
+                stored[self.get_key(pk)] = rows[pk] = tuple(values)
+                self.local.set(self.get_key(pk), rows[pk])
+            self.backend.set_many(stored, CACHE_TIMEOUT)
+
+        return dict([(pk, self.get_instance(values)) for pk, values in rows.items()])
+
+    def get(self, pk):
+        instance = self.get_many([pk]).get(pk)
+        if instance is None:
+            raise self.model.DoesNotExist('%s matching query does not exist.' % self.model._meta.object_name)
+        return instance
+
+    def delete(self, keys):
+        for key in keys:
+            self.local.delete(key)
+        if keys:
+            self.backend.delete_many(keys)
+
+    def invalidate(self, pks):
+        '''
+        Remove rows from caches now and once more after the transaction of fetching is committed,
+        because other processes can read not yet updated rows into caches before the commit
+        '''
+        keys = [self.get_key(pk) for pk in pks]
+        self.delete(keys)
+        after_fetching(self.delete, keys)
+
+
+caches_of_models = {}
+
+
+def get_instance_cache(model):
+    if model not in caches_of_models:
+        caches_of_models[model] = InstanceCache(model)
+    return caches_of_models[model]
+
+
+def invalidate_instance(sender, instance, **kwargs):
+    get_instance_cache(sender).invalidate([instance.pk])
+
+
+def connect_invalidation(*models):
+    '''
+    Invalidate cached rows of models after saving and deleting of instances one by one,
+    bulk updates invalidate rows by remote managers
+    '''
+    for model in models:
+        post_save.connect(invalidate_instance, sender=model, dispatch_uid='odnoklassniki_photos_cache_save_%s' % model.__name__)
+        post_delete.connect(invalidate_instance, sender=model, dispatch_uid='odnoklassniki_photos_cache_delete_%s' % model.__name__)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Max
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from .models import Photo, PhotoImage
+from .utils import filter_by_ids
+from datetime import datetime
+from hashlib import sha1
+from pytz import utc
+import logging
+import os
+import requests
+import threading
+import uuid
+
+log = logging.getLogger('odnoklassniki_photos')
+
+IMAGES_ROOT = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_IMAGES_ROOT', None)
+IMAGES_MAX_SIZE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_IMAGES_MAX_SIZE', 1024 ** 3)
+IMAGES_WORKERS = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_IMAGES_WORKERS', 8)
+IMAGES_TIMEOUT = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_IMAGES_TIMEOUT', 30)
+
+
+class ImageStore(object):
+    '''
+    Content-addressed file store: file path is defined by sha1 of the content,
+    so the same image is stored once for all photos and sizes.
+    Total size of the store is calculated once and then is tracked by added and deleted files
+    '''
+    def __init__(self, root=None, max_size=None):
+        self.root = root or IMAGES_ROOT
+        if not self.root:
+            raise ImproperlyConfigured('Setting ODNOKLASSNIKI_PHOTOS_IMAGES_ROOT should be specified for storing images')
+        self.max_size = IMAGES_MAX_SIZE if max_size is None else max_size
+        self.total = None
+        self.lock = threading.Lock()
+
+    def get_files(self):
+        return PhotoImage.objects.order_by().values('checksum', 'path').annotate(last_accessed=Max('accessed'), size=Max('bytes'))
+
+    def get_total(self):
+        '''
+        Return total size of files of the store in bytes
+        '''
+        if self.total is None:
+            self.total = sum([f['size'] for f in self.get_files()])
+        return self.total
+
+    def get_path(self, checksum):
+        return os.path.join(checksum[:2], checksum[2:4], checksum)
+
+    def get_full_path(self, path):
+        return os.path.join(self.root, path)
+
+    def exists(self, path):
+        return os.path.exists(self.get_full_path(path))
+
+    def put(self, content):
+        '''
+        Save content and return it's checksum and path relative to the root of the store
+        '''
+        checksum = sha1(content).hexdigest()
+        path = self.get_path(checksum)
+        full_path = self.get_full_path(path)
+
+        if not os.path.exists(full_path):
+            directory = os.path.dirname(full_path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # directory was created by another thread
+                    pass
+            # write to temporary file and rename, so partially written file never appears in the store
+            tmp_path = '%s.%s.tmp' % (full_path, uuid.uuid4().hex)
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.rename(tmp_path, full_path)
+            with self.lock:
+                if self.total is not None:
+                    self.total += len(content)
+
+        return checksum, path
+
+    def delete(self, path):
+        try:
+            os.remove(self.get_full_path(path))
+        except OSError:
+            pass
+
+    def evict(self):
+        '''
+        Delete least recently accessed files until total size of the store is not more than max_size.
+        Files are read from DB only if the tracked total size exceeds max_size. Return number of deleted files
+        '''
+        if self.get_total() <= self.max_size:
+            return 0
+
+        files = list(self.get_files().order_by('last_accessed'))
+        total = sum([f['size'] for f in files])
+
+        deleted = 0
+        for f in files:
+            if total <= self.max_size:
+                break
+            PhotoImage.objects.filter(checksum=f['checksum']).delete()
+            self.delete(f['path'])
+            total -= f['size']
+            deleted += 1
+
+        self.total = total
+        return deleted
+
+
+class PhotoImageDownloader(object):
+    '''
+    Concurrent downloader of size variants of photos into the local store.
+    Images, that were already downloaded from the same url and present in the store, are skipped,
+    so interrupted downloading can be resumed by running it again.
+    Usage:
+
+        >>> downloader = PhotoImageDownloader(sizes=['pic128x128', 'pic640x480'])
+        >>> downloader.download(Photo.objects.filter(album=album))
+    '''
+    def __init__(self, sizes=('pic128x128',), store=None, workers=None, timeout=None):
+        for size in sizes:
+            Photo._meta.get_field(size)
+
+        self.sizes = list(sizes)
+        self.store = store or ImageStore()
+        self.workers = workers or IMAGES_WORKERS
+        self.timeout = timeout or IMAGES_TIMEOUT
+
+        # pool of connections shared by all threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_tasks(self, queryset):
+        '''
+        Return list of tuples (photo id, size, url) of images, that are not downloaded yet
+        '''
+        rows = list(queryset.values_list('pk', *self.sizes))
+        photos_ids = [row[0] for row in rows]
+
+        cached = {}
+        for photo_id, size, url, path in filter_by_ids(PhotoImage.objects.filter(size__in=self.sizes), photos_ids, 'photo') \
+                .values_list('photo', 'size', 'url', 'path'):
+            cached[(photo_id, size)] = (url, path)
+
+        tasks = []
+        for row in rows:
+            for size, url in zip(self.sizes, row[1:]):
+                if not url:
+                    continue
+                image = cached.get((row[0], size))
+                if image and image[0] == url and self.store.exists(image[1]):
+                    continue
+                tasks += [(row[0], size, url)]
+
+        return tasks
+
+    def fetch(self, task):
+        '''
+        Download image and put it in the store. Runs in threads, so it doesn't touch DB
+        '''
+        photo_id, size, url = task
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            content = response.content
+            checksum, path = self.store.put(content)
+            return task, (checksum, path, len(content)), None
+        except Exception as e:
+            return task, None, e
+
+    def download(self, queryset):
+        '''
+        Download images of photos from queryset. Return tuple of counts of downloaded and failed images
+        '''
+        tasks = self.get_tasks(queryset)
+        if not tasks:
+            return 0, 0
+
+        downloaded = failed = 0
+        pool = ThreadPool(self.workers)
+        try:
+            for (photo_id, size, url), result, error in pool.imap_unordered(self.fetch, tasks):
+                if error:
+                    log.error('Downloading of image %s failed with error: %s' % (url, error))
+                    failed += 1
+                    continue
+
+                checksum, path, length = result
+                now = datetime.utcnow().replace(tzinfo=utc)
+                values = dict(url=url, checksum=checksum, path=path, bytes=length, downloaded=now, accessed=now)
+                if not PhotoImage.objects.filter(photo_id=photo_id, size=size).update(**values):
+                    PhotoImage.objects.create(photo_id=photo_id, size=size, **values)
+                downloaded += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        self.store.evict()
+        return downloaded, failed
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from functools import wraps
+import threading
+
+state = threading.local()
+
+
+class FetchDiff(object):
+    '''
+    Result of fetching in dry-run mode: how fetched instances differ from stored ones.
+    `models` is dict of model name -> dict with ids of new instances, dict of pk -> changed fields,
+    ids of unchanged instances and ids of stored instances, missing remotely.
+    `likes` is dict of 'Model:pk' -> dict with ids of added and removed likes and number of unchanged ones
+    '''
+    def __init__(self):
+        self.models = {}
+        self.likes = {}
+
+    def get_model_diff(self, model):
+        return self.models.setdefault(model._meta.object_name, {'new': [], 'changed': {}, 'unchanged': [], 'missing': []})
+
+    def get_likes_diff(self, instance):
+        return self.likes.setdefault('%s:%s' % (instance._meta.object_name, instance.pk),
+                                     {'added': [], 'removed': [], 'unchanged': 0})
+
+    def summary(self):
+        '''
+        Return dict of model name -> numbers of new, changed, unchanged and missing instances,
+        numbers of added, removed and unchanged likes are summed up under 'likes'
+        '''
+        result = {}
+        for name, diff in self.models.items():
+            result[name] = dict([(key, len(value)) for key, value in diff.items()])
+        if self.likes:
+            result['likes'] = {
+                'added': sum([len(diff['added']) for diff in self.likes.values()]),
+                'removed': sum([len(diff['removed']) for diff in self.likes.values()]),
+                'unchanged': sum([diff['unchanged'] for diff in self.likes.values()]),
+            }
+        return result
+
+
+def get_dry_run_diff():
+    '''
+    Return diff of the current dry-run of the thread or None, if fetching is real
+    '''
+    return getattr(state, 'diff', None)
+
+
+@contextmanager
+def start_dry_run():
+    '''
+    Fetch without writing inside the block, nested dry-runs share the diff of the outer one
+    '''
+    previous = get_dry_run_diff()
+    state.diff = diff = previous or FetchDiff()
+    try:
+        yield diff
+    finally:
+        state.diff = previous
+
+
+def dry_runnable(method):
+    '''
+    Decorator of fetch methods: with argument dry_run=True pages are fetched and parsed as usual,
+    but compared with stored instances instead of saving, FetchDiff is returned instead of the result
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not kwargs.pop('dry_run', False):
+            return method(self, *args, **kwargs)
+        with start_dry_run() as diff:
+            method(self, *args, **kwargs)
+        return diff
+    return wrapper
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db.models import Q
+from django.utils import six
+from .models import Album, Photo
+from .routing import get_read_database
+from datetime import date, datetime, timedelta
+import csv
+import gzip
+import io
+import simplejson as json
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_EXPORT_CHUNK_SIZE', 5000)
+# incremental export reads changes after the watermark minus this number of seconds: `fetched` is stamped
+# inside of transaction of fetching, so rows can be committed long after their stamp. It should be more than
+# the longest transaction of fetching, rows of the overlap are exported again and should be upserted by pk
+EXPORT_WATERMARK_LAG = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_EXPORT_WATERMARK_LAG', 3 * 3600)
+
+FORMATS = ('jsonl', 'csv', 'parquet')
+
+
+class Export(object):
+    '''
+    Export of rows of the model table: columns are read by values_list in chunks ordered by pk,
+    so memory doesn't depend on size of the table.
+    Incremental export contains only rows, changed after the watermark datetime minus `lag` seconds,
+    every row is exported once in order of pk.
+    Rows are read from the database `using`, the read database by default
+    '''
+    def __init__(self, model, watermark_fields):
+        self.model = model
+        self.watermark_fields = watermark_fields
+
+    @property
+    def fields(self):
+        return self.model._meta.local_fields
+
+    @property
+    def columns(self):
+        return [field.attname for field in self.fields]
+
+    def get_queryset(self, since=None, using=None, lag=None):
+        queryset = self.model.objects.using(using or get_read_database()).order_by()
+        if since is not None:
+            since -= timedelta(seconds=EXPORT_WATERMARK_LAG if lag is None else lag)
+            condition = Q()
+            for field in self.watermark_fields:
+                condition |= Q(**{'%s__gt' % field: since})
+            queryset = queryset.filter(condition)
+        return queryset
+
+    def iterate_rows(self, since=None, chunk_size=None, using=None, lag=None):
+        '''
+        Yield tuples of values of columns in order of pk. Chunks are read by keyset pagination (pk greater than
+        the last one of the previous chunk) instead of server-side cursor: it isn't available in Django before 1.11,
+        and every chunk is a short query, so no transaction is held open on the database for the whole export
+        '''
+        chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+        names = [field.name for field in self.fields]
+        pk_index = self.columns.index(self.model._meta.pk.attname)
+
+        last_pk = None
+        while True:
+            queryset = self.get_queryset(since, using, lag)
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+            rows = list(queryset.order_by('pk').values_list(*names)[:chunk_size])
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                break
+            last_pk = rows[-1][pk_index]
+
+    def get_watermark(self, row):
+        '''
+        Return the latest of values of watermark fields of the row
+        '''
+        values = [row[self.columns.index(field)] for field in self.watermark_fields]
+        values = [value for value in values if value is not None]
+        return max(values) if values else None
+
+
+class LikesExport(Export):
+    '''
+    Export of like edges of albums or photos with datetimes of adding and removing of like
+    '''
+    def __init__(self, model):
+        super(LikesExport, self).__init__(model._meta.get_field('like_users').rel.through, ('time_from', 'time_to'))
+
+
+EXPORTS = {
+    'albums': Export(Album, ('fetched', 'archived_date')),
+    'photos': Export(Photo, ('fetched', 'archived_date')),
+    'album_likes': LikesExport(Album),
+    'photo_likes': LikesExport(Photo),
+}
+
+
+def serialize(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+class JsonLinesWriter(object):
+    extension = 'jsonl.gz'
+
+    def __init__(self, path, export):
+        self.file = gzip.open(path, 'wb')
+        self.columns = export.columns
+
+    def write(self, rows):
+        for row in rows:
+            line = json.dumps(dict(zip(self.columns, [serialize(value) for value in row])), ensure_ascii=False)
+            self.file.write((line + u'\n').encode('utf-8'))
+
+    def close(self):
+        self.file.close()
+
+
+class CsvWriter(object):
+    extension = 'csv.gz'
+
+    def __init__(self, path, export):
+        self.file = gzip.open(path, 'wb')
+        if six.PY3:
+            self.file = io.TextIOWrapper(self.file, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writerow(export.columns)
+
+    def writerow(self, row):
+        row = [serialize(value) for value in row]
+        if not six.PY3:
+            row = [value.encode('utf-8') if isinstance(value, six.text_type) else value for value in row]
+        self.writer.writerow(row)
+
+    def write(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter(object):
+    '''
+    Writer of row groups of parquet file, requires pyarrow
+    '''
+    extension = 'parquet'
+    row_group_size = EXPORT_CHUNK_SIZE
+
+    def __init__(self, path, export):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.columns = export.columns
+        types = {
+            'BigIntegerField': pyarrow.int64(),
+            'IntegerField': pyarrow.int64(),
+            'PositiveIntegerField': pyarrow.int64(),
+            'PositiveSmallIntegerField': pyarrow.int32(),
+            'AutoField': pyarrow.int64(),
+            'ForeignKey': pyarrow.int64(),
+            'BooleanField': pyarrow.bool_(),
+            'FloatField': pyarrow.float64(),
+            'DateField': pyarrow.date32(),
+            'DateTimeField': pyarrow.timestamp('us', tz='UTC'),
+        }
+        self.schema = pyarrow.schema([(field.attname, types.get(field.get_internal_type(), pyarrow.string()))
+                                      for field in export.fields])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.rows = []
+
+    def flush(self):
+        if self.rows:
+            columns = [list(column) for column in zip(*self.rows)]
+            self.writer.write_table(self.pyarrow.Table.from_arrays(
+                [self.pyarrow.array(column, type=self.schema.field(i).type) for i, column in enumerate(columns)],
+                schema=self.schema))
+            self.rows = []
+
+    def write(self, rows):
+        for row in rows:
+            self.rows += [row]
+            if len(self.rows) >= self.row_group_size:
+                self.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def export(name, path, format='jsonl', since=None, chunk_size=None, using=None, lag=None):
+    '''
+    Write rows of the export `name` changed after `since` minus `lag` seconds (EXPORT_WATERMARK_LAG by default)
+    to the file `path`. Return number of written rows and the new watermark, the latest change of written rows
+    '''
+    source = EXPORTS[name]
+    writer = WRITERS[format](path, source)
+
+    count = 0
+    watermark = since
+    try:
+        for row in source.iterate_rows(since, chunk_size, using, lag):
+            writer.write([row])
+            count += 1
+            row_watermark = source.get_watermark(row)
+            if row_watermark is not None and (watermark is None or row_watermark > watermark):
+                watermark = row_watermark
+    finally:
+        writer.close()
+
+    return count, watermark
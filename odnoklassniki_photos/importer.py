@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from odnoklassniki_api.decorators import atomic
+from odnoklassniki_groups.models import Group
+from odnoklassniki_users.models import User
+from .models import Album, Photo, LikeEdge, LIKES_STORAGE
+from .routing import get_write_database, using_database
+from .utils import filter_by_ids
+from datetime import datetime
+from pytz import utc
+import calendar
+import gzip
+import logging
+import simplejson as json
+
+log = logging.getLogger('odnoklassniki_photos')
+
+# number of pages imported in one transaction
+IMPORT_BATCH_PAGES = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_IMPORT_BATCH_PAGES', 50)
+
+
+class PagesImporter(object):
+    '''
+    Import of pages of API responses from files of JSON lines, one page per line:
+
+        {"groups": [...]} - resources of groups
+        {"albums": [...]} - response of photos.getAlbums
+        {"photos": [...]} - response of photos.getPhotos
+        {"album_id": ..., "users": [...]} - response of photos.getAlbumLikes with id of the album
+        {"photo_id": ..., "users": [...]} - response of photos.getPhotoLikes with id of the photo
+
+    Pages are parsed the same way as fetched ones, new instances and like edges are inserted by bulk_create.
+    Related objects should be imported before: groups before albums, albums before photos, page with
+    missing related objects fails the import of its batch, foreign keys are checked as usual.
+    Everything is written to the database `using`, the database of writes of fetching by default.
+    Usage:
+
+        >>> PagesImporter().import_file('photos.jsonl.gz')
+    '''
+    def __init__(self, batch_pages=None, using=None):
+        self.batch_pages = batch_pages or IMPORT_BATCH_PAGES
+        self.using = using
+        self.counts = dict([(key, 0) for key in ['groups', 'albums', 'photos', 'users', 'likes']])
+
+    def iterate_pages(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+
+    def import_file(self, path):
+        '''
+        Import pages of the file by batches, every batch in it's own transaction. Return dict of counts of created objects
+        '''
+        batch = []
+        for page in self.iterate_pages(path):
+            batch += [page]
+            if len(batch) >= self.batch_pages:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+        return self.counts
+
+    def import_batch(self, pages):
+        with using_database(self.using) as using:
+            with atomic(using=using):
+                for page in pages:
+                    self.import_page(page)
+
+    def import_page(self, page):
+        now = datetime.utcnow().replace(tzinfo=utc)
+        if 'groups' in page:
+            self.import_instances(Group.remote, page['groups'], 'groups', now)
+        if 'albums' in page:
+            self.import_instances(Album.remote, page['albums'], 'albums', now)
+        if 'photos' in page:
+            self.import_instances(Photo.remote, page['photos'], 'photos', now)
+        if 'users' in page:
+            users = self.import_instances(User.remote, page['users'], 'users', now)
+            if 'photo_id' in page:
+                self.import_likes(Photo, int(page['photo_id']), [user.pk for user in users], now)
+            elif 'album_id' in page:
+                self.import_likes(Album, int(page['album_id']), [user.pk for user in users], now)
+
+    def import_instances(self, manager, resources, key, now):
+        '''
+        Parse page of resources, insert new instances by one bulk_create and update stored ones.
+        Return list of all parsed instances
+        '''
+        instances = manager.parse_response_list(resources, {'fetched': now})
+        model = manager.model
+        using = get_write_database()
+
+        stored_ids = set(filter_by_ids(model.objects.using(using), [instance.pk for instance in instances])
+                         .values_list('pk', flat=True))
+        created = dict([(instance.pk, instance) for instance in instances if instance.pk not in stored_ids])
+        model.objects.using(using).bulk_create(list(created.values()))
+        self.counts[key] += len(created)
+
+        if model in (Album, Photo):
+            stored = [instance for instance in instances if instance.pk in stored_ids]
+            if stored:
+                manager.save_instances(stored)
+            # the same handlers as after fetching: aggregates, snapshots, events and search index
+            manager.counters_changed(dict([(pk, (None, dict([(field, getattr(instance, field))
+                                                              for field in model.counters_fields])))
+                                           for pk, instance in created.items()]), list(created.values()))
+            manager.instances_saved(list(created.keys()), {})
+
+        return instances
+
+    def import_likes(self, model, object_id, users_ids, now):
+        '''
+        Insert like edges of the object with users, that are not current likes already
+        '''
+        using = get_write_database()
+        if LIKES_STORAGE == 'edges':
+            instance = model.objects.using(using).get(pk=object_id)
+            current = set(LikeEdge.objects.iterate_current_ids(instance))
+            users_ids = [user_id for user_id in set(users_ids) if user_id not in current]
+            LikeEdge.objects.add(instance, users_ids, calendar.timegm(now.utctimetuple()))
+            self.counts['likes'] += len(users_ids)
+            return
+
+        field = model._meta.get_field('like_users')
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        through = field.rel.through
+
+        current = set(through.objects.using(using).filter(**{source: object_id, 'time_to': None})
+                      .values_list(target, flat=True))
+        edges = [through(**{'%s_id' % source: object_id, '%s_id' % target: user_id, 'time_from': now, 'time_to': None})
+                 for user_id in set(users_ids) if user_id not in current]
+        through.objects.using(using).bulk_create(edges)
+        self.counts['likes'] += len(edges)
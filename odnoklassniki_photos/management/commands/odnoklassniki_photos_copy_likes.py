@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from odnoklassniki_api.decorators import atomic
+from odnoklassniki_photos import models
+from odnoklassniki_photos.models import Album, Photo, LikeEdge
+from odnoklassniki_photos.routing import get_write_database
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = 'Copy history of likes from tables of like_users fields to LikeEdge table by chunks and verify the copy ' \
+           'before switching ODNOKLASSNIKI_PHOTOS_LIKES_STORAGE to edges'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=None,
+                    help='Number of edges copied by one query in its own transaction'),
+    )
+
+    def handle(self, *args, **options):
+        # edges are replaced by the copy, after switching they are the only history of likes
+        if models.LIKES_STORAGE == 'edges':
+            raise CommandError('ODNOKLASSNIKI_PHOTOS_LIKES_STORAGE is already switched to edges, copying would replace '
+                               'likes fetched after switching by the old history')
+
+        differences = []
+        for model in [Album, Photo]:
+            using = get_write_database()
+            with atomic(using=using):
+                LikeEdge.objects.using(using).filter(object_type=LikeEdge.objects.get_object_type(model)).delete()
+            count = LikeEdge.objects.copy_from_m2m(model, chunk_size=options['chunk_size'])
+            self.stdout.write('%d likes of %s copied\n' % (count, model._meta.verbose_name_plural))
+            differences += [(model, name, expected, copied)
+                            for name, expected, copied in LikeEdge.objects.get_copy_differences(model)]
+
+        if differences:
+            raise CommandError('Copy of likes differs from the source, likes were changed while copying: %s. '
+                               "Don't switch ODNOKLASSNIKI_PHOTOS_LIKES_STORAGE, run the command again without fetching "
+                               'of likes' % ', '.join(['%s of %s: %d, copied %d' % (name, model._meta.object_name, expected, copied)
+                                                       for model, name, expected, copied in differences]))
+        self.stdout.write('Copy of likes is verified, ODNOKLASSNIKI_PHOTOS_LIKES_STORAGE can be switched to edges\n')
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from odnoklassniki_photos.export import export, EXPORTS, FORMATS, WRITERS
+from optparse import make_option
+from datetime import datetime
+import os
+import simplejson as json
+
+
+class Command(BaseCommand):
+    help = 'Export stored albums, photos and like edges to gzipped JSON lines, gzipped CSV or parquet files'
+    args = '[%s ...]' % ' '.join(sorted(EXPORTS))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default='jsonl',
+                    help='Format of files: %s' % ', '.join(FORMATS)),
+        make_option('--output', action='store', dest='output', default='.',
+                    help='Directory for exported files'),
+        make_option('--watermark', action='store', dest='watermark', default=None,
+                    help='JSON file with datetimes of the last exported changes, only later changes are exported '
+                         'and the file is updated after export'),
+        make_option('--watermark-lag', action='store', dest='watermark_lag', type='int', default=None,
+                    help='Seconds before the watermark, changes after them are exported again, because rows '
+                         'are committed after their datetimes of fetching'),
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=None,
+                    help='Number of rows, read from the database by one query'),
+        make_option('--database', action='store', dest='database', default=None,
+                    help='Database to export from, the read database of the app by default'),
+    )
+
+    def handle(self, *args, **options):
+        names = list(args) or sorted(EXPORTS)
+        for name in names:
+            if name not in EXPORTS:
+                raise CommandError('Unknown export %s, available: %s' % (name, ', '.join(sorted(EXPORTS))))
+
+        format = options['format']
+        if format not in FORMATS:
+            raise CommandError('Unknown format %s, available: %s' % (format, ', '.join(FORMATS)))
+        if format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                raise CommandError('Export to parquet requires pyarrow')
+
+        watermarks = {}
+        if options['watermark'] and os.path.exists(options['watermark']):
+            with open(options['watermark']) as f:
+                watermarks = dict([(name, parse_datetime(value)) for name, value in json.load(f).items() if value])
+
+        suffix = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        for name in names:
+            path = os.path.join(options['output'], '%s-%s.%s' % (name, suffix, WRITERS[format].extension))
+            count, watermark = export(name, path, format=format, since=watermarks.get(name),
+                                      chunk_size=options['chunk_size'], using=options['database'],
+                                      lag=options['watermark_lag'])
+            if watermark is not None:
+                watermarks[name] = watermark
+            self.stdout.write('%d rows of %s exported to %s\n' % (count, name, path))
+
+        if options['watermark']:
+            with open(options['watermark'], 'w') as f:
+                json.dump(dict([(name, value.isoformat()) for name, value in watermarks.items()]), f, indent=2)
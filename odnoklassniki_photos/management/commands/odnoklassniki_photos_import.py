@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from odnoklassniki_photos.importer import PagesImporter
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = 'Import groups, albums, photos and likes from files with pages of API responses in JSON lines'
+    args = '<file file ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-pages', action='store', dest='batch_pages', type='int', default=None,
+                    help='Number of pages imported in one transaction'),
+        make_option('--database', action='store', dest='database', default=None,
+                    help='Database to import to, the primary database of the app by default'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Specify files with pages as arguments')
+
+        importer = PagesImporter(batch_pages=options['batch_pages'], using=options['database'])
+        for path in args:
+            importer.import_file(path)
+            self.stdout.write('%s imported\n' % path)
+
+        self.stdout.write(', '.join(['%d %s' % (count, key) for key, count in sorted(importer.counts.items())]) + '\n')
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+from odnoklassniki_photos.profiling import rank_collapsed
+from optparse import make_option
+import simplejson as json
+import pstats
+
+
+class Command(BaseCommand):
+    help = 'Rank the hottest functions of profile runs, written with ODNOKLASSNIKI_PHOTOS_PROFILE: ' \
+           '.prof files of cprofile mode, .collapsed files of sampling mode and .json files with seconds of phases'
+    args = '<file file ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', action='store', dest='limit', type='int', default=20,
+                    help='Number of functions in the ranking'),
+        make_option('--sort', action='store', dest='sort', default='tottime',
+                    help='Sort key of pstats for .prof files: tottime, cumulative, ncalls'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Specify files of profile runs as arguments')
+
+        for path in [path for path in args if path.endswith('.json')]:
+            with open(path) as f:
+                run = json.load(f)
+            self.stdout.write('%s (%s), %.2f s: %s\n' % (run['name'], run['mode'], run['total'], ', '.join(
+                ['%s %.2f s' % (phase, seconds) for phase, seconds in sorted(run['seconds'].items(), key=lambda item: -item[1])])))
+
+        profiles = [path for path in args if path.endswith('.prof')]
+        if profiles:
+            output = six.StringIO()
+            stats = pstats.Stats(profiles[0], stream=output)
+            for path in profiles[1:]:
+                stats.add(path)
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
+            self.stdout.write(output.getvalue())
+
+        collapsed = [path for path in args if path.endswith('.collapsed')]
+        if collapsed:
+            ranked, phases = rank_collapsed(collapsed, options['limit'])
+            samples = sum(phases.values()) or 1
+            self.stdout.write('Samples by phases: %s\n' % ', '.join(
+                ['%s %.1f%%' % (phase, 100. * count / samples) for phase, count in sorted(phases.items(), key=lambda item: -item[1])]))
+            self.stdout.write('%8s %8s  function\n' % ('own %', 'total %'))
+            for name, own, total in ranked:
+                self.stdout.write('%8.1f %8.1f  %s\n' % (100. * own / samples, 100. * total / samples, name))
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from odnoklassniki_api.decorators import atomic
+from odnoklassniki_photos.models import PhotosAggregate
+
+
+class Command(BaseCommand):
+    help = 'Recalculate aggregates of photos per album and per group from stored photos'
+    args = '[group_id group_id ...]'
+
+    def handle(self, *args, **options):
+        group_ids = [int(group_id) for group_id in args] or None
+
+        with atomic():
+            count = PhotosAggregate.objects.rebuild(group_ids)
+
+        self.stdout.write('%d aggregates rebuilt\n' % count)
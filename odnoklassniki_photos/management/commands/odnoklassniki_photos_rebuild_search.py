@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from odnoklassniki_api.decorators import atomic
+from odnoklassniki_photos.models import Album, Photo, SearchPosting
+
+
+class Command(BaseCommand):
+    help = 'Rebuild inverted search index of titles of albums and texts of photos from stored instances'
+
+    def handle(self, *args, **options):
+        for model in [Album, Photo]:
+            with atomic():
+                count = SearchPosting.objects.rebuild(model)
+            self.stdout.write('%d %s indexed\n' % (count, model._meta.verbose_name_plural))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from odnoklassniki_photos.models import CounterSnapshot
+from optparse import make_option
+from datetime import datetime, timedelta
+from pytz import utc
+
+
+class Command(BaseCommand):
+    help = 'Downsample old snapshots of counters of albums and photos and delete expired ones'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--downsample-after', action='store', dest='downsample_after', type='int', default=30,
+                    help='Age of snapshots in days for downsampling'),
+        make_option('--resolution', action='store', dest='resolution', type='int', default=24,
+                    help='Resolution of downsampled snapshots in hours'),
+        make_option('--retention', action='store', dest='retention', type='int', default=0,
+                    help='Age of snapshots in days for deleting, 0 - keep forever'),
+    )
+
+    def handle(self, *args, **options):
+        now = datetime.utcnow().replace(tzinfo=utc)
+
+        deleted = CounterSnapshot.objects.downsample(now - timedelta(options['downsample_after']),
+                                                     options['resolution'] * 3600)
+        self.stdout.write('%d snapshots deleted by downsampling\n' % deleted)
+
+        if options['retention']:
+            deleted = CounterSnapshot.objects.purge(now - timedelta(options['retention']))
+            self.stdout.write('%d expired snapshots deleted\n' % deleted)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+import simplejson as json
+import time
+
+
+def close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+def init_worker():
+    # connections inherited from the parent process can't be shared, every worker opens its own
+    # to every database, including replicas and databases of routing.
+    # API session is created by odnoklassniki_api for every call, so it's never shared too
+    close_connections()
+
+
+def sync_group(group_id):
+    from odnoklassniki_groups.models import Group
+    from odnoklassniki_photos.models import Photo, PhotoBaseRemoteManager
+
+    calls_before = PhotoBaseRemoteManager.api_calls_count
+    started = time.time()
+    result = {'group_id': group_id, 'photos': 0, 'requests': 0, 'error': None}
+    try:
+        try:
+            group = Group.objects.get(pk=group_id)
+        except Group.DoesNotExist:
+            group = Group.remote.fetch(ids=[group_id])[0]
+        result['photos'] = Photo.remote.fetch(group=group, all=True).count()
+    except Exception as e:
+        result['error'] = '%s' % e
+    finally:
+        result['requests'] = PhotoBaseRemoteManager.api_calls_count - calls_before
+        result['seconds'] = time.time() - started
+
+    return result
+
+
+class Command(BaseCommand):
+    help = 'Fetch albums and photos of groups, distributing groups across worker processes'
+    args = '<group_id group_id ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--file', action='store', dest='file', default=None,
+                    help='File with group ids, one per line'),
+        make_option('--workers', action='store', dest='workers', type='int', default=cpu_count(),
+                    help='Number of worker processes'),
+        make_option('--summary', action='store', dest='summary', default=None,
+                    help='Path of JSON file for the summary of the run'),
+    )
+
+    def handle(self, *args, **options):
+        group_ids = [int(group_id) for group_id in args]
+        if options['file']:
+            with open(options['file']) as f:
+                group_ids += [int(line) for line in f if line.strip()]
+
+        if not group_ids:
+            raise CommandError('Specify group ids as arguments or with --file option')
+
+        workers = max(options['workers'], 1)
+        close_connections()
+
+        started = time.time()
+        results = []
+        pool = Pool(processes=workers, initializer=init_worker)
+        try:
+            for result in pool.imap_unordered(sync_group, group_ids):
+                results += [result]
+                if result['error']:
+                    self.stderr.write('Group %(group_id)s: error %(error)s\n' % result)
+                else:
+                    self.stdout.write('Group %(group_id)s: %(photos)d photos, %(requests)d requests in %(seconds).1fs\n' % result)
+        finally:
+            pool.close()
+            pool.join()
+
+        seconds = time.time() - started
+        summary = {
+            'groups': len(results),
+            'failed': len([result for result in results if result['error']]),
+            'workers': workers,
+            'seconds': seconds,
+            'photos': sum([result['photos'] for result in results]),
+            'requests': sum([result['requests'] for result in results]),
+        }
+        summary['photos_per_second'] = summary['photos'] / seconds if seconds else 0
+        summary['requests_per_second'] = summary['requests'] / seconds if seconds else 0
+
+        self.stdout.write('%(groups)d groups (%(failed)d failed) by %(workers)d workers in %(seconds).1fs: '
+                          '%(requests_per_second).2f requests/s, %(photos_per_second).2f photos/s\n' % summary)
+
+        if options['summary']:
+            summary['results'] = results
+            with open(options['summary'], 'w') as f:
+                json.dump(summary, f, indent=2)
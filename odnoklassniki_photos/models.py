@@ -1,102 +1,749 @@
 # -*- coding: utf-8 -*-
-from django.db import models
-from django.db.models.query import EmptyQuerySet
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Count, Sum, Max
+from django.db.models.query import EmptyQuerySet, QuerySet
 from odnoklassniki_api.models import OdnoklassnikiManager, OdnoklassnikiPKModel
-from odnoklassniki_api.decorators import atomic, fetch_all, fetch_by_chunks_of
+from odnoklassniki_api.decorators import atomic, fetch_all, list_chunks_iterator
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 from django.utils.six import string_types
 from m2m_history.fields import ManyToManyHistoryField
 from odnoklassniki_groups.models import Group
 from odnoklassniki_users.models import User
-from datetime import datetime
+from datetime import datetime, timedelta
 from pytz import utc
+from .signals import page_saved
+from .utils import bulk_update, filter_by_ids, id_array, lazy_decorator, merge_sorted_ids, sorted_id_array, IdsTable, \
+    IN_CLAUSE_LIMIT
+import calendar
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger('odnoklassniki_photos')
+
+CACHE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_CACHE', False)
+SNAPSHOTS = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_SNAPSHOTS', False)
+AGGREGATES = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_AGGREGATES', False)
+EVENTS_OUTBOX = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_EVENTS_OUTBOX', False)
+# events of the outbox younger than this number of seconds aren't read yet, events with lower ids can be still
+# uncommitted by other workers, it should be more than duration of writing of event and differences of clocks
+EVENTS_READ_LAG = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_EVENTS_READ_LAG', 10)
+SEARCH = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_SEARCH', False)
+LIKES_LEASE_TIMEOUT = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_LIKES_LEASE_TIMEOUT', 600)
+LIKES_FRESHNESS = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_LIKES_FRESHNESS', 60)
+# database alias with separate connection to the same database for leases of likes fetching, so they are committed
+# at once and aren't held by the transaction of fetching. None - the database of writes of fetching
+LIKES_LEASE_DATABASE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_LIKES_LEASE_DATABASE', None)
+LIKES_CHUNK_SIZE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_LIKES_CHUNK_SIZE', 500)
+# storage of likes history: 'm2m' - tables of like_users fields, 'edges' - LikeEdge table
+LIKES_STORAGE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_LIKES_STORAGE', 'm2m')
+# partition key of LikeEdge: 'group' - owner group id modulo LIKES_SHARDS, 'time' - month of adding of like
+LIKES_PARTITION = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_LIKES_PARTITION', 'group')
+LIKES_SHARDS = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_LIKES_SHARDS', 64)
+
+# codes of models in tables with objects of different models
+OBJECT_TYPES = {
+    'Album': 1,
+    'Photo': 2,
+}
+
+# modules of optional features (profiling, validation, routing, dry-run, cache, search, paging) aren't imported
+# with models, decorators import them on the first call of fetch methods, other helpers - inside of methods
+profiled = lazy_decorator('odnoklassniki_photos.profiling.profiled')
+validated = lazy_decorator('odnoklassniki_photos.validation.validated')
+routed = lazy_decorator('odnoklassniki_photos.routing.routed')
+dry_runnable = lazy_decorator('odnoklassniki_photos.dryrun.dry_runnable')
+
+
+def in_phase(name):
+    return lazy_decorator('odnoklassniki_photos.profiling.in_phase', name)
+
+
+class page_limit(object):
+    '''
+    Class attribute with the limit of `count` of the API method from PAGE_LIMITS
+    '''
+    def __init__(self, api_method):
+        self.api_method = api_method
+
+    def __get__(self, instance, owner):
+        from .paging import PAGE_LIMITS
+        return PAGE_LIMITS[self.api_method]
+
+
+def datetimes_from_timestamps_ms(values):
+    '''
+    Convert list of timestamps in milliseconds to list of datetimes in UTC, None for empty, zero or wrong values
+    '''
+    fromtimestamp = datetime.utcfromtimestamp
+    result = []
+    for value in values:
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = None
+        result.append(fromtimestamp(value // 1000).replace(tzinfo=utc) if value else None)
+    return result
+
+
+def values_differ(value, stored):
+    # without USE_TZ stored datetimes are naive in the default time zone, parsed ones are aware.
+    # Naive and aware datetimes can't be compared before python 3.3
+    if isinstance(value, datetime) and isinstance(stored, datetime) \
+            and timezone.is_naive(value) != timezone.is_naive(stored):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.get_default_timezone())
+        else:
+            stored = timezone.make_aware(stored, timezone.get_default_timezone())
+    try:
+        return value != stored
+    except TypeError:
+        return True
+
+
+class PhotoBaseRemoteManager(OdnoklassnikiManager):
+    # number of API calls made by albums and photos managers in the current process
+    api_calls_count = 0
+
+    # name of the API request fields set
+    request_fields_name = None
+    # API fields, requested always, because they are needed for identifying and parsing of instance
+    request_fields_required = ()
+    # model field -> API fields, needed for it
+    request_fields_map = {}
+
+    def get_projection(self, fields=None):
+        '''
+        Return API request fields and model fields for updating for the projection of model `fields`.
+        Without projection all API fields are requested and instances are saved completely
+        '''
+        if isinstance(fields, string_types):
+            fields = [fields]
+        key = tuple(fields or ())
+
+        # request fields strings are built on the first remote call, not while importing models
+        projections = self.__dict__.setdefault('_projections', {})
+        if key not in projections:
+            if not key:
+                projections[key] = self.get_request_fields(self.request_fields_name, prefix=True)
+            else:
+                request_fields = list(self.request_fields_required)
+                for field in key:
+                    if field not in self.request_fields_map:
+                        from .validation import FetchParamsError
+                        raise FetchParamsError("Field '%s' of model %s can't be fetched separately" % (field, self.model.__name__))
+                    request_fields += [f for f in self.request_fields_map[field] if f not in request_fields]
+                projections[key] = ','.join(['%s.%s' % (self.request_fields_name, f) for f in request_fields])
 
+        return projections[key], list(key) or None
 
-class AlbumRemoteManager(OdnoklassnikiManager):
-    fetch_album_limit = 100
+    @atomic
+    def fetch(self, *args, **kwargs):
+        '''
+        Retrieve and save instances to local DB, return queryset of them
+        '''
+        return self.filter_by_ids(self.fetch_ids(*args, **kwargs))
+
+    def fetch_ids(self, *args, **kwargs):
+        '''
+        Retrieve and save instances to local DB, return list of their ids. Every page is saved by get() as soon as
+        it's fetched, so events are emitted per page. If `update_fields` are specified, existed instances are updated
+        only by these fields
+        '''
+        return self.get(*args, save=True, **kwargs)
+
+    def get_page(self, instances, save=False, update_fields=None):
+        '''
+        Return parsed instances of the page of get() or, when called by fetch_ids(), save them and return their ids
+        '''
+        return self.save_instances(instances, update_fields) if save else instances
+
+    def filter_by_ids(self, ids):
+        '''
+        Return queryset of instances with ids from the read database, it's safe for any number of ids.
+        Inside of fetching it's the database of writes, long lists of ids are joined with temporary table in its session
+        on backends other than PostgreSQL, such queryset returned by fetching stays in this session
+        '''
+        from .routing import get_read_database
+        return filter_by_ids(self.model.objects.using(get_read_database()), ids)
+
+    def get_stored_counters(self, ids, using=None):
+        '''
+        Return dict of pk -> dict of stored counters of instances with `ids`
+        '''
+        return self.get_stored_values(ids, self.model.counters_fields, using=using)
+
+    def get_stored_values(self, ids, fields, using=None):
+        '''
+        Return dict of pk -> dict of stored values of `fields` of instances with `ids`, they are read from the database
+        `using`, by default from the database of writes, because writes, aggregates and events are decided by them
+        and a lagging replica would miss instances saved by the previous page
+        '''
+        from .routing import get_write_database
+        queryset = self.model.objects.using(using or get_write_database())
+        stored = {}
+        for chunk in list_chunks_iterator(list(ids), IN_CLAUSE_LIMIT):
+            for row in queryset.filter(pk__in=chunk).values_list('pk', *fields):
+                stored[row[0]] = dict(zip(fields, row[1:]))
+        return stored
+
+    def get_tracked_fields(self, update_fields=None):
+        '''
+        Return model fields, compared with stored values for events about changed instances
+        '''
+        if update_fields:
+            names = list(update_fields) + ['archived', 'archived_date']
+            return [self.model._meta.get_field(name) for name in names]
+        return [field for field in self.model._meta.local_fields if not field.primary_key and field.name != 'fetched']
+
+    @in_phase('persist')
+    def save_instances(self, instances, update_fields=None):
+        '''
+        Save fetched instances and return list of their ids.
+        Stored counters of instances are loaded by chunks before saving for tracking their changes,
+        with listeners of events all tracked fields are loaded. Stored instances are updated by projection
+        `update_fields` with one UPDATE statement per chunk of instances.
+        In dry-run instances are only compared with stored ones
+        '''
+        from .dryrun import get_dry_run_diff
+        from .routing import get_write_database
+
+        diff = get_dry_run_diff()
+        if diff is not None:
+            return self.compare_instances(instances, update_fields, diff.get_model_diff(self.model))
+
+        ids = [instance.pk for instance in instances]
+        tracked = self.get_tracked_fields(update_fields) if self.has_events_listeners() else []
+        stored = self.get_stored_values(ids, set(self.model.counters_fields) | set([field.name for field in tracked]) | set(['archived']))
+
+        changes = {}
+        created_ids = []
+        changed_fields = {}
+        projected = {}
+        projected_fields = list(update_fields or []) + ['archived', 'archived_date', 'fetched']
+        fetched = datetime.utcnow().replace(tzinfo=utc)
+        for instance in instances:
+            old = stored.get(instance.pk)
+            if update_fields and old is not None:
+                instance.fetched = fetched
+                projected[instance.pk] = [getattr(instance, field) for field in projected_fields]
+            else:
+                # watermark of exports, otherwise _substitute() keeps the stored value
+                instance.fetched = fetched
+                self.get_or_create_from_instance(instance)
+
+            if old is None:
+                created_ids += [instance.pk]
+            elif tracked:
+                fields = [field.name for field in tracked if values_differ(getattr(instance, field.attname), old[field.name])]
+                if fields:
+                    changed_fields[instance.pk] = fields
+
+            # archived instances aren't counted in aggregates, so reappeared ones are counted as created
+            old_counters = dict([(field, old[field]) for field in self.model.counters_fields]) \
+                if old is not None and not old['archived'] else None
+            new = dict([(field, getattr(instance, field) if not update_fields or field in update_fields or old is None else old[field])
+                        for field in self.model.counters_fields])
+            if old_counters is None or [field for field in new if values_differ(new[field], old_counters[field])]:
+                changes[instance.pk] = (old_counters, new)
+
+        # parameters of CASE expressions are counted for every field of every row
+        chunk_size = max(IN_CLAUSE_LIMIT // len(projected_fields), 1)
+        for chunk in list_chunks_iterator(list(projected), chunk_size):
+            bulk_update(self.model, dict([(pk, projected[pk]) for pk in chunk]), projected_fields,
+                        using=get_write_database())
+
+        self.counters_changed(changes, instances)
+        if tracked:
+            self.instances_saved(created_ids, changed_fields)
+        self.invalidate_cache(ids)
+        return ids
+
+    def get_or_create_from_instance(self, instance):
+        '''
+        Update stored instance by fetched one or create it in the database of writes of fetching
+        '''
+        from .routing import get_write_database
+
+        using = get_write_database()
+        try:
+            instance._substitute(self.model.objects.using(using).get(pk=instance.pk))
+        except self.model.DoesNotExist:
+            log.debug('Fetch and create new object %s with remote pk %s' % (self.model, instance.pk))
+        # _substitute() copies empty fields from the stored instance, date of archiving of reappeared one is cleared
+        if not instance.archived:
+            instance.archived_date = None
+        instance.save(using=using)
+        return instance
+
+    def compare_instances(self, instances, update_fields, diff):
+        '''
+        Register fetched instances in the dry-run `diff` as new, changed or unchanged without saving,
+        stored values are loaded by chunks as for saving, but from a replica, if it's configured and not lagging,
+        because nothing is written by them. Return list of ids of instances
+        '''
+        from .routing import get_replica_database
+
+        ids = [instance.pk for instance in instances]
+        tracked = self.get_tracked_fields(update_fields)
+        stored = self.get_stored_values(ids, [field.name for field in tracked], using=get_replica_database())
+
+        for instance in instances:
+            old = stored.get(instance.pk)
+            if old is None:
+                diff['new'] += [instance.pk]
+                continue
+            fields = [field.name for field in tracked if values_differ(getattr(instance, field.attname), old[field.name])]
+            if fields:
+                diff['changed'][instance.pk] = fields
+            else:
+                diff['unchanged'] += [instance.pk]
+        return ids
+
+    def invalidate_cache(self, ids):
+        '''
+        Remove rows with `ids` from the read-through cache of the model after bulk updates
+        '''
+        if CACHE:
+            from .cache import get_instance_cache
+            get_instance_cache(self.model).invalidate(ids)
+
+    def has_events_listeners(self):
+        return EVENTS_OUTBOX or self.is_search_maintained() or bool(page_saved.receivers)
+
+    def is_search_maintained(self):
+        if not SEARCH:
+            return False
+        from .search import get_backend
+        return get_backend().maintained
+
+    def instances_saved(self, created_ids, changed_fields):
+        '''
+        Emit event about saved page of instances: ids of created ones and dict of pk -> changed fields of updated ones.
+        Event is sent by `page_saved` signal and is appended to the outbox, if it's enabled. Inside of fetching events
+        are appended by short separate transactions after the commit of fetching, so ids of events, allocated
+        by workers of parallel fetching, become visible to readers of the outbox almost in order
+        '''
+        if not created_ids and not changed_fields:
+            return
+
+        if self.is_search_maintained():
+            ids = list(created_ids) + [pk for pk, fields in changed_fields.items() if self.model.search_field in fields]
+            SearchPosting.objects.index(self.model, ids)
+
+        page_saved.send(sender=self.model, created_ids=list(created_ids), updated_ids=sorted(changed_fields.keys()),
+                        changed_fields=changed_fields)
+        if EVENTS_OUTBOX:
+            from .routing import after_commit, get_write_database
+            args = (self.model, list(created_ids), dict(changed_fields), get_write_database())
+            if not after_commit(ChangeEvent.objects.record, *args):
+                ChangeEvent.objects.record(*args)
+
+    @in_phase('persist')
+    def archive_missing(self, ids, **filters):
+        '''
+        Mark as archived stored instances, selected by `filters`, with ids not in `ids` by one UPDATE statement.
+        Return number of archived instances. In dry-run they are registered in the diff as missing
+        '''
+        from .dryrun import get_dry_run_diff
+        from .routing import get_write_database
+
+        diff = get_dry_run_diff()
+        using = get_write_database()
+        table = IdsTable(ids, using=using)
+        try:
+            queryset = table.exclude(self.model.objects.using(using).filter(archived=False, **filters))
+            if diff is not None:
+                missing_ids = list(queryset.values_list('pk', flat=True))
+                diff.get_model_diff(self.model)['missing'] += missing_ids
+                return len(missing_ids)
+            archived_ids = list(queryset.values_list('pk', flat=True)) if CACHE or self.has_events_listeners() else []
+            now = datetime.utcnow().replace(tzinfo=utc)
+            count = queryset.update(archived=True, archived_date=now, fetched=now)
+        finally:
+            table.drop()
+
+        self.instances_saved([], dict([(pk, ['archived', 'archived_date']) for pk in archived_ids]))
+        self.invalidate_cache(archived_ids)
+
+        if count:
+            log.info('%d instances of %s with %s archived, because they are missing remotely' % (count, self.model.__name__, filters))
+            if AGGREGATES and self.model is Photo:
+                group_ids = set(self.model.objects.using(using).filter(**filters).values_list('owner_id', flat=True))
+                PhotosAggregate.objects.rebuild(group_ids=group_ids, using=using)
+        return count
+
+    def counters_changed(self, changes, instances):
+        '''
+        Handler of changes of stored counters, `changes` is dict of pk -> (old counters, new counters),
+        old counters are None for created and unarchived instances
+        '''
+        from .routing import get_write_database
+
+        using = get_write_database()
+        if SNAPSHOTS:
+            CounterSnapshot.objects.record(self.model, dict([(pk, new) for pk, (old, new) in changes.items()]), using=using)
+
+        if AGGREGATES and self.model is Photo:
+            PhotosAggregate.objects.apply_changes(changes, instances, using=using)
+
+    def get_api_method(self, method='get'):
+        return '%s.%s' % (self.model.methods_namespace, self.methods[method])
+
+    def get_page_size(self, method='get'):
+        '''
+        Return current page size of the method, tuned by its page size controller
+        '''
+        from .paging import get_controller
+        return get_controller(self.get_api_method(method)).size
+
+    @in_phase('http')
+    def api_call(self, *args, **kwargs):
+        from .paging import get_controller, PAGE_LIMITS
+
+        PhotoBaseRemoteManager.api_calls_count += 1
+
+        api_method = self.get_api_method(kwargs.get('method', args[0] if args else 'get'))
+        if kwargs.pop('adaptive_count', False):
+            # fetch_all() repeats the call with the same arguments, so size of every page is read from the controller,
+            # tuned by the previous pages
+            kwargs['count'] = get_controller(api_method).size
+        if api_method not in PAGE_LIMITS or not kwargs.get('count'):
+            return super(PhotoBaseRemoteManager, self).api_call(*args, **kwargs)
+
+        # latency and errors of paginated methods are measured for tuning of their page size
+        controller = get_controller(api_method)
+        started = time.time()
+        try:
+            response = super(PhotoBaseRemoteManager, self).api_call(*args, **kwargs)
+        except Exception:
+            controller.record(kwargs['count'], 0, time.time() - started, error=True)
+            raise
+        items = sum([len(value) for value in response.values() if isinstance(value, list)])
+        controller.record(kwargs['count'], items, time.time() - started)
+        return response
+
+    @in_phase('parse')
+    def parse_response_list(self, response_list, extra_fields=None):
+        '''
+        Parse the whole page of resources at once: related objects are fetched by one query per page,
+        timestamps are converted in one pass, plain fields are assigned without type conversion.
+        The rest of fields are parsed by model.parse()
+        '''
+        resources = [dict(resource) for resource in response_list if isinstance(resource, dict)]
+        model = self.model
+
+        page_values = [{} for resource in resources]
+
+        for key, field_name, related_model in model.page_related_fields:
+            ids = set([int(resource[key]) for resource in resources if resource.get(key)])
+            objects = related_model.objects.in_bulk(list(ids)) if ids else {}
+            if len(objects) < len(ids):
+                raise related_model.DoesNotExist('%s matching query does not exist: %s' % (
+                    related_model._meta.object_name, ', '.join([str(pk) for pk in sorted(ids - set(objects))])))
+            for resource, values in zip(resources, page_values):
+                if resource.get(key):
+                    values[field_name] = objects[int(resource.pop(key))]
+
+        for key, field_name in model.page_timestamp_fields:
+            dates = datetimes_from_timestamps_ms([resource.pop(key, None) for resource in resources])
+            for values, date in zip(page_values, dates):
+                if date:
+                    values[field_name] = date
+
+        summaries = [resource.pop('like_summary', None) or {} for resource in resources]
+        dates = datetimes_from_timestamps_ms([summary.get('last_like_date_ms') for summary in summaries])
+        for values, summary, date in zip(page_values, summaries, dates):
+            if summary:
+                values['likes_count'] = summary.get('count', 0)
+                values['last_like_date'] = date
+
+        for field_name in model.page_plain_fields:
+            for resource, values in zip(resources, page_values):
+                if field_name in resource:
+                    values[field_name] = resource.pop(field_name)
+
+        instances = []
+        for resource, values in zip(resources, page_values):
+            instance = self.parse_response_dict(resource, extra_fields)
+            for field_name, value in values.items():
+                setattr(instance, field_name, value)
+            instances += [instance]
+
+        return instances
+
+
+class AlbumRemoteManager(PhotoBaseRemoteManager):
+    fetch_album_limit = page_limit('photos.getAlbums')
+
+    request_fields_name = 'group_album'
+    request_fields_required = ('aid', 'group_id', 'author_type')
+    request_fields_map = {
+        'owner_name': ('author_name',),
+        'created': ('created',),
+        'likes_count': ('like_summary',),
+        'last_like_date': ('like_summary',),
+        'photos_count': ('photos_count',),
+        'title': ('title',),
+    }
 
     @fetch_all(pagination='pagingAnchor')
     def get(self, *args, **kwargs):
+        save, update_fields = kwargs.pop('save', False), kwargs.pop('update_fields', None)
         response = self.api_call(*args, **kwargs)
 
-        if kwargs.get('count') and kwargs.get('all'):
-            kwargs['count'] = self.__class__.fetch_photo_limit
-
         if kwargs.get('method') == 'get_one':
             response_data = [response.get('album')]
         else:
             response_data = response.pop('albums')
 
-        return self.parse_response(response_data), response
+        return self.get_page(self.parse_response(response_data), save, update_fields), response
+
+    def validate_fetch(self, group=None, archive_missing=False, **kwargs):
+        from .validation import check_archive_missing, check_count, check_instance
+
+        check_instance('group', group, Group)
+        check_archive_missing(archive_missing, bool(kwargs.get('all')))
+        if not kwargs.get('all'):
+            check_count(kwargs.get('count'), self.get_api_method())
+        self.get_projection(kwargs.get('fields'))
 
+    @profiled
+    @validated
+    @routed
+    @dry_runnable
     @atomic
-    def fetch(self, group, **kwargs):
+    def fetch(self, group, archive_missing=False, **kwargs):
         """
         Req params:  ids | group | (group & album)
         Opt params: count - count of albums to fetch ( value <= fetch_album_limit )
+                    fields - list of model fields to fetch and update
+                    archive_missing - mark as archived stored albums of the group missing remotely, only with all=True
+                    dry_run - compare fetched albums with stored ones without saving and return FetchDiff
+                    using - alias of the database for writes
         See: photos.getPhotos, photos.getInfo
         """
-        if not 'count' in kwargs:
+        if kwargs.get('all'):
+            # pages of adaptive size while fetching all albums
+            kwargs.pop('count', None)
+            kwargs['adaptive_count'] = True
+        elif not 'count' in kwargs:
             kwargs['count'] = self.__class__.fetch_album_limit
 
-        if not isinstance(group, Group):
-            raise Exception('group parameter should be odnoklassniki_groups.models.Group object')
-
         kwargs['gid'] = group.pk
-        kwargs['fields'] = self.get_request_fields('group_album', prefix=True)
+        kwargs['fields'], kwargs['update_fields'] = self.get_projection(kwargs.get('fields'))
 
-        return super(AlbumRemoteManager, self).fetch(**kwargs)
+        ids = super(AlbumRemoteManager, self).fetch_ids(**kwargs)
+        if archive_missing:
+            self.archive_missing(ids, owner_id=group.pk)
 
-    @atomic
-    def fetch_group_specific(self, ids, *args, **kwargs):
-        group = kwargs.pop('group', None)
-        if not isinstance(group, Group):
-            raise Exception('This function needs group parameter (object of odnoklassniki_groups.models.Group) to get albums from')
+        return self.filter_by_ids(ids)
 
-        if not isinstance(ids, (list, tuple)):
-            raise Exception('ids should be tuple or list of ints')
+    def validate_fetch_group_specific(self, ids=None, *args, **kwargs):
+        from .validation import check_ids, check_instance
 
+        check_instance('group', kwargs.get('group'), Group)
+        check_ids('ids', ids)
+        self.get_projection(kwargs.get('fields'))
+
+    @profiled
+    @validated
+    @routed
+    @dry_runnable
+    @atomic
+    def fetch_group_specific(self, ids, *args, **kwargs):
+        group = kwargs.pop('group')
         kwargs['method'] = 'get_one'
         kwargs['gid'] = group.pk
-        kwargs['fields'] = self.get_request_fields('group_album', prefix=True)
+        kwargs['fields'], kwargs['update_fields'] = self.get_projection(kwargs.get('fields'))
 
-        result = EmptyQuerySet(model=Album)
         if kwargs.get('count'):
             ids = ids[:kwargs['count']]
 
+        fetched_ids = []
         for id in ids:
             kwargs['aid'] = id
-            result = super(AlbumRemoteManager, self).fetch(*args, **kwargs) | result
+            fetched_ids += super(AlbumRemoteManager, self).fetch_ids(*args, **kwargs)
 
-        return result
+        return self.filter_by_ids(fetched_ids)
 
 
 class Likable(object):
-    fetch_like_users_limit = 100
+    fetch_like_users_limit = page_limit('photos.getPhotoLikes')
 
+    @in_phase('likes')
     def update_likes(self, instances, *args, **kwargs):
+        '''
+        Replace current likes with users with ids `instances`.
+        Remote ids are compared with stored ones in sorted order by chunks, so memory doesn't depend on likes count
+        '''
+        from .dryrun import get_dry_run_diff
+
         if not getattr(self, 'like_users'):
             raise Exception('Model derriving from Likable should have like_users field')
 
-        users = User.objects.filter(pk__in=instances)
-        self.like_users = users
+        remote_ids = sorted_id_array(instances)
+
+        if LIKES_STORAGE == 'edges':
+            timestamp = int(time.time())
+            stored_ids = LikeEdge.objects.iterate_current_ids(self)
+            add = lambda ids: LikeEdge.objects.add(self, ids, timestamp)
+            remove = lambda ids: LikeEdge.objects.remove(self, ids, timestamp)
+        else:
+            # the same manager for all changes, so they are registered in history with the same time
+            manager = self.like_users
+            stored_ids = self.iterate_stored_likes(manager)
+            add = lambda ids: manager.add(*ids)
+            remove = lambda ids: manager.remove(*ids)
+
+        diff = get_dry_run_diff()
+        if diff is not None:
+            likes_diff = diff.get_likes_diff(self)
+            add, remove = likes_diff['added'].extend, likes_diff['removed'].extend
+
+        added, removed = [], []
+        for user_id, is_remote in merge_sorted_ids(remote_ids, stored_ids):
+            if is_remote:
+                added += [user_id]
+            else:
+                removed += [user_id]
+
+            if len(added) >= LIKES_CHUNK_SIZE:
+                add(added)
+                added = []
+            if len(removed) >= LIKES_CHUNK_SIZE:
+                remove(removed)
+                removed = []
+
+        if added:
+            add(added)
+        if removed:
+            remove(removed)
+
+        if diff is not None:
+            likes_diff['unchanged'] = len(remote_ids) - len(likes_diff['added'])
+            return self.get_like_users()
+
         self.save()
-        return users
+        return self.get_like_users()
+
+    def get_like_users(self, at=None):
+        '''
+        Return queryset of users, liked the object at the moment `at` or currently, from the storage of likes
+        '''
+        if LIKES_STORAGE == 'edges':
+            return LikeEdge.objects.get_users(self, at)
+        elif at is None:
+            return self.like_users.all()
+        else:
+            return self.like_users.were_at(at)
+
+    def iterate_stored_likes(self, manager):
+        '''
+        Iterate over ids of current likes in ascending order, fetching them by chunks
+        '''
+        field = manager.target_field_name
+        # get_query_set_through is deprecated in newer versions of m2m_history
+        get_queryset_through = getattr(manager, 'get_queryset_through', None) or manager.get_query_set_through
+        last_id = None
+        while True:
+            ids = get_queryset_through().filter(time_to=None)
+            if last_id is not None:
+                ids = ids.filter(**{'%s__gt' % field: last_id})
+            ids = list(ids.order_by(field).values_list(field, flat=True).distinct()[:LIKES_CHUNK_SIZE])
+            for user_id in ids:
+                yield user_id
+            if len(ids) < LIKES_CHUNK_SIZE:
+                break
+            last_id = ids[-1]
+
+    @profiled
+    @routed
+    def fetch_likes(self, wait=False, dry_run=False, **kwargs):
+        '''
+        Fetch likes, if no other worker is fetching likes of the same object at the moment.
+        Otherwise return stored likes or wait for the end of the other fetching if `wait` is True.
+        Stored likes are returned also if all likes were fetched less than LIKES_FRESHNESS seconds ago.
+        With `dry_run` all likes are compared with stored ones without lease and saving, FetchDiff is returned
+        '''
+        from .dryrun import start_dry_run
+        from .validation import check_count, FetchParamsError
+
+        check_count(kwargs.get('count'), self.__class__.remote.get_api_method('get_likes'))
+        full = bool(kwargs.get('all'))
+        if dry_run:
+            if not full:
+                raise FetchParamsError('Argument dry_run is applicable only for fetching all likes')
+            with start_dry_run() as diff:
+                self._fetch_likes(**kwargs)
+            return diff
+
+        started = time.time()
+        while True:
+            lease = LikesLease.objects.claim(self, full=full)
+            if lease or not wait or LikesLease.objects.is_fresh(self) or time.time() - started > LIKES_LEASE_TIMEOUT:
+                break
+            time.sleep(1)
+
+        if not lease:
+            return self.get_like_users()
+
+        try:
+            result = self._fetch_likes(lease=lease, **kwargs)
+        except LikesLeaseLost:
+            # likes are fetching by another worker now, staged pages are rolled back
+            return self.get_like_users()
+        except:
+            LikesLease.objects.release(lease)
+            raise
+
+        LikesLease.objects.release(lease, synced=full)
+        return result
 
+    @in_phase('likes')
     @atomic
-    @fetch_all(return_all=update_likes)
-    def fetch_likes(self, **kwargs):
+    def _fetch_likes(self, all=False, lease=None, **kwargs):
+        '''
+        Fetch one page of likes or all pages, if `all` is True. All pages are staged in compact array of ids
+        and applied by update_likes() at the end. Queryset of users is returned in both cases.
+        The `lease` is prolonged after every page, so long fetching of popular objects doesn't lose it
+        '''
+        if not all:
+            return User.objects.filter(pk__in=list(self.fetch_likes_page(**kwargs)[0]))
+
+        users_ids = id_array()
+        while True:
+            page_ids, response = self.fetch_likes_page(**kwargs)
+            page_ids = list(page_ids)
+            users_ids.extend(page_ids)
+            if lease is not None:
+                LikesLease.objects.extend(lease)
+            if not page_ids or not response.get('has_more', 'anchor' in response):
+                break
+            kwargs['anchor'] = response.get('anchor')
+
+        return self.update_likes(users_ids)
+
+    def fetch_likes_page(self, **kwargs):
+        from .dryrun import get_dry_run_diff
+
         kwargs['gid'] = self.owner.pk
 
         if not kwargs.get('count'):
-            kwargs['count'] = self.__class__.fetch_like_users_limit
+            kwargs['count'] = self.__class__.remote.get_page_size('get_likes')
 
         kwargs['fields'] = self.__class__.remote.get_request_fields('user', prefix=True)
 
         response = self.__class__.remote.api_call(method='get_likes', **kwargs)
         users = response.get('users')
-        if users:
+        if users and get_dry_run_diff() is not None:
+            users_ids = [user.pk for user in User.remote.parse_response_list(users)]
+        elif users:
             users_ids = User.remote.get_or_create_from_resources_list(users).values_list('pk', flat=True)
         else:
             users_ids = EmptyQuerySet(model=User)
@@ -104,6 +751,107 @@ class Likable(object):
         return users_ids, response
 
 
+class PhotoBaseQuerySet(QuerySet):
+
+    def prefetch_like_users(self, at=None, only_pk=False, only_count=False):
+        '''
+        Return list of objects with attribute `prefetched_like_users`: list of users, liked the object at the moment `at`
+        (currently if None). Likes of all objects are fetched by one query, users by another one.
+        With `only_pk` attribute is list of users ids, with `only_count` it's number of users
+        '''
+        instances = list(self)
+        if not instances:
+            return instances
+
+        if LIKES_STORAGE == 'edges':
+            source, target = 'object_id', 'user_id'
+            through = LikeEdge.objects.get_edges(self.model, instances, at)
+        else:
+            field = self.model._meta.get_field('like_users')
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            through = field.rel.through.objects.all()
+            if at is None:
+                through = through.filter(time_to=None)
+            else:
+                # the same conditions as in ManyToManyHistoryField.were_at()
+                through = through.filter(Q(time_from=None) | Q(time_from__lte=at), Q(time_to=None) | Q(time_to__gt=at))
+        through = filter_by_ids(through, [instance.pk for instance in instances], source)
+
+        if only_count:
+            counts = dict(through.values_list(source).annotate(count=Count(target, distinct=True)).order_by())
+            for instance in instances:
+                instance.prefetched_like_users = counts.get(instance.pk, 0)
+            return instances
+
+        likes = {}
+        for object_id, user_id in through.values_list(source, target).order_by(source, target).distinct():
+            likes.setdefault(object_id, []).append(user_id)
+
+        if not only_pk:
+            users = User.objects.in_bulk(list(set([user_id for ids in likes.values() for user_id in ids])))
+            likes = dict([(object_id, [users[user_id] for user_id in ids if user_id in users])
+                          for object_id, ids in likes.items()])
+
+        for instance in instances:
+            instance.prefetched_like_users = likes.get(instance.pk, [])
+        return instances
+
+    def search(self, q, group=None, page=1, per_page=None, archived=False):
+        '''
+        Return page of objects of the queryset, found by full-text search of query `q` in the `search_field`,
+        ordered by relevance, that is in attribute `search_rank` of every object. Archived objects are found
+        only with `archived`
+        '''
+        from .search import get_backend, SEARCH_PAGE_SIZE
+
+        queryset = self if archived else self.filter(archived=False)
+        if group is not None:
+            queryset = queryset.filter(owner_id=getattr(group, 'pk', group))
+        per_page = per_page or SEARCH_PAGE_SIZE
+        return get_backend(self.db).search(queryset, q, offset=(page - 1) * per_page, limit=per_page)
+
+
+class PhotoBaseManager(models.Manager):
+
+    def get_query_set(self):
+        return PhotoBaseQuerySet(self.model, using=self._db)
+
+    get_queryset = get_query_set
+
+    def prefetch_like_users(self, *args, **kwargs):
+        return self.get_query_set().prefetch_like_users(*args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        return self.get_query_set().search(*args, **kwargs)
+
+    def get_cached_many(self, pks, owner=False):
+        '''
+        Return dict of pk -> instance, read through the cache of rows, if it's enabled.
+        With `owner` groups are also read through the cache and assigned to instances
+        '''
+        if not CACHE:
+            instances = self.in_bulk(list(pks))
+            if owner:
+                groups = Group.objects.in_bulk(list(set([instance.owner_id for instance in instances.values()])))
+        else:
+            from .cache import get_instance_cache
+            instances = get_instance_cache(self.model).get_many(pks)
+            if owner:
+                groups = get_instance_cache(Group).get_many(set([instance.owner_id for instance in instances.values()]))
+
+        if owner:
+            for instance in instances.values():
+                if instance.owner_id in groups:
+                    instance.owner = groups[instance.owner_id]
+        return instances
+
+    def get_cached(self, pk, owner=False):
+        instance = self.get_cached_many([pk], owner).get(pk)
+        if instance is None:
+            raise self.model.DoesNotExist('%s matching query does not exist.' % self.model._meta.object_name)
+        return instance
+
+
 class PhotoBase(OdnoklassnikiPKModel, Likable):
     class Meta:
         abstract = True
@@ -115,6 +863,20 @@ class PhotoBase(OdnoklassnikiPKModel, Likable):
     likes_count = models.PositiveIntegerField(default=0)
     last_like_date = models.DateTimeField(null=True)
 
+    # instance is missing remotely since archived_date
+    archived = models.BooleanField(default=False, db_index=True)
+    archived_date = models.DateTimeField(null=True)
+
+    # tables of fields, converted by the remote manager for the whole page of response at once:
+    # (response key, model field, related model) of related objects
+    page_related_fields = (('group_id', 'owner', Group),)
+    # (response key, model field) of timestamps in milliseconds
+    page_timestamp_fields = ()
+    # model fields, assigned from response as is
+    page_plain_fields = ()
+
+    objects = PhotoBaseManager()
+
     def parse(self, response):
         if response.get('author_name'):
             self.owner_name = response.pop('author_name')
@@ -129,11 +891,7 @@ class PhotoBase(OdnoklassnikiPKModel, Likable):
         if response.get('like_summary'):
             summary = response.pop('like_summary')
             self.likes_count = summary.get('count', 0)
-            try:
-                value = datetime.utcfromtimestamp(int(summary['last_like_date_ms'])/1000).replace(tzinfo=utc)
-            except:
-                value = None
-            self.last_like_date = value
+            self.last_like_date = datetimes_from_timestamps_ms([summary.get('last_like_date_ms')])[0]
 
         return super(PhotoBase, self).parse(response)
 
@@ -145,6 +903,9 @@ class Album(PhotoBase):
 
     remote_pk_field = 'aid'
 
+    counters_fields = ('likes_count', 'photos_count', 'last_like_date')
+    search_field = 'title'
+
     created = models.DateField(null=True)
 
     like_users = ManyToManyHistoryField(User, related_name='like_albums')
@@ -178,68 +939,147 @@ class Album(PhotoBase):
 
         return super(Album, self).fetch_likes(**kwargs)
 
-class PhotoRemoteManager(OdnoklassnikiManager):
+class PhotoRemoteManager(PhotoBaseRemoteManager):
 
-    fetch_photo_limit = 100
+    fetch_photo_limit = page_limit('photos.getPhotos')
+
+    request_fields_name = 'group_photo'
+    request_fields_required = ('id', 'album_id', 'group_id', 'author_type')
+    request_fields_map = dict([
+        ('owner_name', ('author_name',)),
+        ('comments_count', ('comments_count',)),
+        ('created', ('created_ms',)),
+        ('likes_count', ('like_summary',)),
+        ('last_like_date', ('like_summary',)),
+        ('standard_height', ('standard_height',)),
+        ('standard_width', ('standard_width',)),
+        ('text', ('text',)),
+    ] + [(size, (size,)) for size in ('pic1024max', 'pic1024x768', 'pic128max', 'pic128x128', 'pic180min',
+                                      'pic190x190', 'pic240min', 'pic320min', 'pic50x50', 'pic640x480')])
 
     @fetch_all
     def get(self, *args, **kwargs):
-        if kwargs.get('count') and kwargs.get('all'):
-            kwargs['count'] = self.__class__.fetch_photo_limit
-
+        save, update_fields = kwargs.pop('save', False), kwargs.pop('update_fields', None)
         response = self.api_call(*args, **kwargs)
 
-        return super(PhotoRemoteManager, self).parse_response(response.pop('photos')), response
+        return self.get_page(super(PhotoRemoteManager, self).parse_response(response.pop('photos')), save, update_fields), \
+            response
+
+    def validate_fetch(self, **kwargs):
+        from .validation import check_archive_missing, check_instance
 
+        check_instance('group', kwargs.get('group'), Group)
+        check_instance('album', kwargs.get('album'), Album, required='album' in kwargs)
+        check_archive_missing(kwargs.get('archive_missing'), bool(kwargs.get('all') or not kwargs.get('count')))
+        self.get_projection(kwargs.get('fields'))
+
+    @profiled
+    @validated
+    @routed
+    @dry_runnable
     @atomic
     def fetch(self, **kwargs):
         """
-        Params: group, album, [count]
+        Params: group, album, [count], [fields], [archive_missing], [dry_run], [using]
+        Descr: archive_missing - mark as archived stored photos of the album or the group missing remotely,
+               only for fetching all photos
+               dry_run - compare fetched photos and albums with stored ones without saving and return FetchDiff,
+               photos of albums missing locally aren't fetched
+               using - alias of the database for writes
         See: photos.getPhotos
         """
-        group = kwargs.get('group')
-        if not isinstance(group, Group):
-            raise Exception('This function needs group parameter (object of odnoklassniki_groups.models.Group)')
-
         if 'album' in kwargs:
-            return self._fetch_group_album(**kwargs)
+            return self.filter_by_ids(self._fetch_group_album(**kwargs))
         else:
-            return self._fetch_all_for_group(**kwargs)
+            return self.filter_by_ids(self._fetch_all_for_group(**kwargs))
+
+    def validate_fetch_group_specific(self, **kwargs):
+        from .validation import check_ids, check_instance
 
+        check_instance('group', kwargs.get('group'), Group)
+        check_instance('album', kwargs.get('album'), Album)
+        check_ids('ids', kwargs.get('ids'))
+        self.get_projection(kwargs.get('fields'))
+
+    @profiled
+    @validated
+    @routed
+    @dry_runnable
     @atomic
-    @fetch_by_chunks_of(fetch_photo_limit)
     def fetch_group_specific(self, **kwargs):
         """
-        Params: group,  ids
+        Params: group,  ids, [fields], [dry_run], [using]
         Descr: Fetch list of photos
         See: photos.getInfo
         """
-        group = kwargs.get('group')
-        if not isinstance(group, Group):
-            raise Exception('This function needs group parameter (object of odnoklassniki_groups.models.Group)')
-
-        album = kwargs.get('album')
-        if not isinstance(album, Album):
-            raise Exception('album parameter should be odnoklassniki_photos.models.Album object')
-
-        if not isinstance(kwargs['ids'], (tuple, list)):
-            raise Exception('ids parameter should be int tuple or int list')
-
-        kwargs['fields'] = Photo.remote.get_request_fields('group_photo', prefix=True)
+        kwargs['fields'], kwargs['update_fields'] = self.get_projection(kwargs.get('fields'))
         kwargs['method'] = 'get_specific'
-        kwargs['photo_ids'] = ','.join(map(lambda i: str(i), kwargs['ids']))
         kwargs['gid'] = kwargs.pop('group').pk
         kwargs['aid'] = kwargs.pop('album').pk
 
-        return super(PhotoRemoteManager, self).fetch(**kwargs)
+        fetched_ids = []
+        for chunk in list_chunks_iterator(list(kwargs.pop('ids')), self.__class__.fetch_photo_limit):
+            kwargs['photo_ids'] = ','.join(map(lambda i: str(i), chunk))
+            fetched_ids += super(PhotoRemoteManager, self).fetch_ids(**kwargs)
+
+        return self.filter_by_ids(fetched_ids)
+
+    @profiled
+    @routed
+    @atomic
+    def refresh_counters(self, queryset):
+        """
+        Descr: Fetch only likes_count, comments_count and last_like_date of photos from queryset
+               and update them by one UPDATE statement per chunk of photos
+        Return: list of ids of photos with changed counters
+        See: photos.getInfo
+        """
+        fields, update_fields = self.get_projection(self.model.counters_fields)
+
+        changed_ids = []
+        for owner_id, album_id in queryset.values_list('owner_id', 'album_id').order_by().distinct():
+            ids = list(queryset.filter(owner_id=owner_id, album_id=album_id).values_list('pk', flat=True))
+            for chunk in list_chunks_iterator(ids, self.__class__.fetch_photo_limit):
+                instances = self.get(method='get_specific', gid=owner_id, aid=album_id, fields=fields,
+                                     photo_ids=','.join([str(id) for id in chunk]))
+                changed_ids += self.update_counters(instances, update_fields)
+
+        return changed_ids
+
+    @in_phase('persist')
+    def update_counters(self, instances, fields):
+        stored = self.get_stored_counters([instance.pk for instance in instances])
+
+        changes = {}
+        for instance in instances:
+            old = stored.get(instance.pk)
+            if old is None:
+                continue
+            new = dict(old, **dict([(field, getattr(instance, field)) for field in fields]))
+            if [field for field in fields if values_differ(new[field], old[field])]:
+                changes[instance.pk] = (old, new)
+
+        from .routing import get_write_database
+        fetched = datetime.utcnow().replace(tzinfo=utc)
+        bulk_update(self.model, dict([(pk, [new[field] for field in fields] + [fetched]) for pk, (old, new) in changes.items()]),
+                    list(fields) + ['fetched'], using=get_write_database())
+        self.counters_changed(changes, instances)
+        self.instances_saved([], dict([(pk, [field for field in fields if values_differ(new[field], old[field])])
+                                       for pk, (old, new) in changes.items()]))
+        self.invalidate_cache(changes.keys())
+        return list(changes.keys())
 
     @atomic
     def _fetch_all_for_group(self, **kwargs):
+        from .routing import get_write_database
+
         group = kwargs['group']
-        albums = Album.remote.fetch(group, all=True)
+        archive_missing = kwargs.pop('archive_missing', False)
+        # albums created by this transaction aren't visible in the read database before the commit
+        albums = Album.remote.fetch(group, all=True, archive_missing=archive_missing).using(get_write_database())
 
-        overall_result = EmptyQuerySet(model=Photo)
-        last_result = EmptyQuerySet(model=Photo)
+        overall_result = id_array()
+        last_result = []
         overall_count = kwargs.get('count')
         for album in albums:
             if overall_count is not None and not kwargs.get('all'):
@@ -252,7 +1092,10 @@ class PhotoRemoteManager(OdnoklassnikiManager):
 
             kwargs['album'] = album
             last_result = self._fetch_group_album(**kwargs)
-            overall_result = last_result | overall_result
+            overall_result.extend(last_result)
+
+        if archive_missing:
+            self.archive_missing(overall_result, owner_id=group.pk)
 
         return overall_result
 
@@ -260,34 +1103,38 @@ class PhotoRemoteManager(OdnoklassnikiManager):
     def _fetch_group_album(self, **kwargs):
         kwargs_copy = dict(kwargs)
         album = kwargs_copy.pop('album')
-        if not isinstance(album, Album):
-            raise Exception('album parameter should be odnoklassniki_photos.models.Album object')
-
         group = kwargs_copy.pop('group')
+        archive_missing = kwargs_copy.pop('archive_missing', False)
 
-        kwargs_copy['fields'] = Photo.remote.get_request_fields('group_photo', prefix=True)
+        kwargs_copy['fields'], kwargs_copy['update_fields'] = self.get_projection(kwargs_copy.get('fields'))
         kwargs_copy['aid'] = album.pk
         kwargs_copy['gid'] = group.pk
 
         count = kwargs_copy.get('count')
         if count:
             if not kwargs_copy.get('all'):
-                result = EmptyQuerySet(model=Photo)
+                result = []
 
                 while count > 0:
                     kwargs_copy['count'] = min(self.__class__.fetch_photo_limit, count)
                     count -= kwargs_copy['count']
-                    result = super(PhotoRemoteManager, self).fetch(**kwargs_copy) | result
+                    result += super(PhotoRemoteManager, self).fetch_ids(**kwargs_copy)
 
-                return result
+                return list(set(result))
             else:
-                # set count to the highest available value to speed pagination
-                kwargs_copy['count'] = self.__class__.fetch_photo_limit
-                return super(PhotoRemoteManager, self).fetch(**kwargs_copy)
+                # pages of adaptive size while fetching all photos
+                kwargs_copy.pop('count')
+                kwargs_copy['adaptive_count'] = True
         else:
             # return all if count is not set
             kwargs_copy['all'] = True
-            return super(PhotoRemoteManager, self).fetch(**kwargs_copy)
+            kwargs_copy['adaptive_count'] = True
+
+        ids = super(PhotoRemoteManager, self).fetch_ids(**kwargs_copy)
+        if archive_missing:
+            self.archive_missing(ids, album_id=album.pk)
+
+        return ids
 
 
 class Photo(PhotoBase):
@@ -297,6 +1144,14 @@ class Photo(PhotoBase):
 
     remote_pk_field = 'id'
 
+    counters_fields = ('likes_count', 'comments_count', 'last_like_date')
+    search_field = 'text'
+
+    page_related_fields = PhotoBase.page_related_fields + (('album_id', 'album', Album),)
+    page_timestamp_fields = (('created_ms', 'created'),)
+    page_plain_fields = ('pic1024max', 'pic1024x768', 'pic128max', 'pic128x128', 'pic180min',
+                         'pic190x190', 'pic240min', 'pic320min', 'pic50x50', 'pic640x480')
+
     album = models.ForeignKey(Album, related_name='photos')
 
     comments_count = models.PositiveIntegerField(default=0)
@@ -349,7 +1204,773 @@ class Photo(PhotoBase):
         if created:
             response[u'created'] = created/1000
 
+        # existence of the album is checked by the foreign key, without query for every photo
         if response.get('album_id'):
-            self.album = Album.objects.get(id=int(response.get('album_id')))
+            self.album_id = int(response.pop('album_id'))
 
         return super(Photo, self).parse(response)
+
+
+class CrawlTask(models.Model):
+    class Meta:
+        verbose_name = u'Задача обновления Одноклассники'
+        verbose_name_plural = u'Задачи обновления Одноклассники'
+        unique_together = (('kind', 'target_content_type', 'target_id'),)
+
+    KIND_ALBUMS = 'albums'
+    KIND_PHOTOS = 'photos'
+    KIND_LIKES = 'likes'
+    KIND_CHOICES = (
+        (KIND_ALBUMS, u'Альбомы группы'),
+        (KIND_PHOTOS, u'Фотографии альбома'),
+        (KIND_LIKES, u'Лайки объекта'),
+    )
+
+    # priority of tasks, that never were executed
+    NEW_TASK_PRIORITY = 10 ** 9
+    # changes per hour assumed for any task, so dead content is refreshed anyway, but rarely
+    BASE_CHANGE_RATE = 0.01
+    # weight of the last observation in the moving average of change rate
+    CHANGE_RATE_SMOOTHING = 0.5
+    # delay of retry after the first failure, doubled by every next failure up to the maximum
+    RETRY_BACKOFF = timedelta(minutes=5)
+    RETRY_BACKOFF_MAX = timedelta(days=1)
+
+    kind = models.CharField(max_length=6, choices=KIND_CHOICES)
+
+    target_content_type = models.ForeignKey(ContentType, related_name='odnoklassniki_crawl_tasks')
+    target_id = models.BigIntegerField(db_index=True)
+    target = generic.GenericForeignKey('target_content_type', 'target_id')
+
+    priority = models.FloatField(default=NEW_TASK_PRIORITY, db_index=True)
+    change_rate = models.FloatField(default=0)
+
+    observed_count = models.PositiveIntegerField(default=0)
+    observed_date = models.DateTimeField(null=True)
+
+    runs_count = models.PositiveIntegerField(default=0)
+    last_run = models.DateTimeField(null=True)
+
+    failures_count = models.PositiveIntegerField(default=0)
+    retry_after = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.kind, self.target_id)
+
+    def get_priority(self, now):
+        '''
+        Priority grows with staleness of the task and with observed change rate of the target
+        '''
+        if not self.last_run:
+            return self.NEW_TASK_PRIORITY
+
+        stale_hours = max((now - self.last_run).total_seconds() / 3600., 0)
+        return (self.change_rate + self.BASE_CHANGE_RATE) * stale_hours
+
+    def observe(self, count, date, now):
+        '''
+        Register state of the target after the crawl and update moving average of change rate
+        '''
+        if self.last_run:
+            hours = max((now - self.last_run).total_seconds() / 3600., 1 / 60.)
+            changes = abs(count - self.observed_count)
+            if date and date != self.observed_date:
+                changes = max(changes, 1)
+            self.change_rate = self.CHANGE_RATE_SMOOTHING * changes / hours \
+                + (1 - self.CHANGE_RATE_SMOOTHING) * self.change_rate
+
+        self.observed_count = count
+        self.observed_date = date
+        self.last_run = now
+        self.runs_count += 1
+        self.priority = self.get_priority(now)
+        self.failures_count = 0
+        self.retry_after = None
+
+    def fail(self, now):
+        '''
+        Register failure of the crawl, the task is postponed for exponentially growing delay
+        '''
+        self.failures_count += 1
+        self.retry_after = now + min(self.RETRY_BACKOFF * 2 ** min(self.failures_count - 1, 16), self.RETRY_BACKOFF_MAX)
+
+
+class CounterSnapshotManager(models.Manager):
+
+    def get_object_type(self, model):
+        return OBJECT_TYPES[model._meta.object_name]
+
+    def record(self, model, counters, timestamp=None, using=None):
+        '''
+        Append snapshots of `counters` (dict of pk -> dict of counters) of instances of the `model`
+        to the database `using`, by default to the database of writes.
+        Snapshot is written only if any counter differs from the last snapshot of instance
+        '''
+        from .routing import get_write_database
+
+        if not counters:
+            return []
+
+        using = using or get_write_database()
+        object_type = self.get_object_type(model)
+        timestamp = timestamp or int(time.time())
+
+        last = self.get_last(object_type, counters.keys(), using=using)
+
+        snapshots = []
+        for pk, values in counters.items():
+            row = tuple([values.get(field) or 0 for field in CounterSnapshot.COUNTERS])
+            if pk in last and (last[pk][1:] == row or last[pk][0] >= timestamp):
+                continue
+            snapshots += [CounterSnapshot(object_type=object_type, object_id=pk, timestamp=timestamp,
+                                          **dict(zip(CounterSnapshot.COUNTERS, row)))]
+
+        self.db_manager(using).bulk_create(snapshots)
+        return snapshots
+
+    def get_last(self, object_type, ids, using=None):
+        '''
+        Return dict of pk -> (timestamp, counters...) of the last snapshots of objects with `ids`.
+        Only the last snapshot of every object is read, not the whole history
+        '''
+        last = {}
+        for chunk in list_chunks_iterator(list(ids), IN_CLAUSE_LIMIT):
+            snapshots = self.using(using).filter(object_type=object_type, object_id__in=chunk)
+            timestamps = dict(snapshots.order_by().values_list('object_id').annotate(Max('timestamp')))
+            if not timestamps:
+                continue
+            rows = snapshots.filter(timestamp__in=set(timestamps.values())) \
+                .values_list('object_id', 'timestamp', *CounterSnapshot.COUNTERS)
+            for row in rows:
+                if timestamps[row[0]] == row[1]:
+                    last[row[0]] = row[1:]
+        return last
+
+    def history(self, instance, since=None, until=None):
+        '''
+        Return queryset of snapshots of the instance in the range of datetimes
+        '''
+        snapshots = self.filter(object_type=self.get_object_type(instance.__class__), object_id=instance.pk)
+        if since:
+            snapshots = snapshots.filter(timestamp__gte=calendar.timegm(since.utctimetuple()))
+        if until:
+            snapshots = snapshots.filter(timestamp__lte=calendar.timegm(until.utctimetuple()))
+        return snapshots.order_by('timestamp')
+
+    def downsample(self, older_than, resolution, using=None):
+        '''
+        Leave only the last snapshot of every object in every interval of `resolution` seconds
+        for snapshots older than `older_than` datetime in the database `using`, by default in the database of writes.
+        Return number of deleted snapshots
+        '''
+        from .routing import get_write_database
+
+        manager = self.db_manager(using or get_write_database())
+        rows = manager.filter(timestamp__lt=calendar.timegm(older_than.utctimetuple())) \
+            .order_by('object_type', 'object_id', 'timestamp').values_list('id', 'object_type', 'object_id', 'timestamp')
+
+        deleted = 0
+        ids = []
+        previous = None
+        for id, object_type, object_id, timestamp in rows.iterator():
+            bucket = (object_type, object_id, timestamp // resolution)
+            if previous and previous[1] == bucket:
+                ids += [previous[0]]
+            previous = (id, bucket)
+
+            if len(ids) >= 500:
+                deleted += len(ids)
+                manager.filter(id__in=ids).delete()
+                ids = []
+
+        deleted += len(ids)
+        manager.filter(id__in=ids).delete()
+        return deleted
+
+    def purge(self, older_than, using=None):
+        '''
+        Delete snapshots older than `older_than` datetime in the database `using`, by default in the database of writes
+        '''
+        from .routing import get_write_database
+
+        snapshots = self.using(using or get_write_database()).filter(timestamp__lt=calendar.timegm(older_than.utctimetuple()))
+        count = snapshots.count()
+        snapshots.delete()
+        return count
+
+
+class CounterSnapshot(models.Model):
+    '''
+    Append-only history of counters of albums and photos, written when counters change
+    '''
+    class Meta:
+        verbose_name = u'Снимок счетчиков Одноклассники'
+        verbose_name_plural = u'Снимки счетчиков Одноклассники'
+        unique_together = (('object_type', 'object_id', 'timestamp'),)
+
+    COUNTERS = ('likes_count', 'photos_count', 'comments_count')
+
+    object_type = models.PositiveSmallIntegerField()
+    object_id = models.BigIntegerField()
+    # unix time in seconds
+    timestamp = models.PositiveIntegerField()
+
+    likes_count = models.PositiveIntegerField(default=0)
+    photos_count = models.PositiveIntegerField(default=0)
+    comments_count = models.PositiveIntegerField(default=0)
+
+    objects = CounterSnapshotManager()
+
+
+class PhotosAggregateManager(models.Manager):
+
+    def get_for(self, instance):
+        '''
+        Return aggregate of photos of the album or the group
+        '''
+        object_type = PhotosAggregate.OBJECT_TYPE_ALBUM if isinstance(instance, Album) else PhotosAggregate.OBJECT_TYPE_GROUP
+        try:
+            return self.get(object_type=object_type, object_id=instance.pk)
+        except PhotosAggregate.DoesNotExist:
+            return PhotosAggregate(object_type=object_type, object_id=instance.pk)
+
+    def apply_changes(self, changes, instances, using=None):
+        '''
+        Increment aggregates of albums and groups by changes of counters of photos in the database `using`,
+        by default in the database of writes, `instances` is list of changed photos
+        '''
+        from .routing import get_write_database
+
+        manager = self.db_manager(using or get_write_database())
+        instances = dict([(instance.pk, instance) for instance in instances])
+        deltas = {}
+        for pk, (old, new) in changes.items():
+            instance = instances[pk]
+            old = old or {}
+            delta = (0 if old else 1,
+                     (new.get('likes_count') or 0) - (old.get('likes_count') or 0),
+                     (new.get('comments_count') or 0) - (old.get('comments_count') or 0),
+                     instance.created if not old else None)
+            for key in [(PhotosAggregate.OBJECT_TYPE_ALBUM, instance.album_id),
+                        (PhotosAggregate.OBJECT_TYPE_GROUP, instance.owner_id)]:
+                photos, likes, comments, created = deltas.get(key, (0, 0, 0, None))
+                deltas[key] = (photos + delta[0], likes + delta[1], comments + delta[2],
+                               max(created, delta[3]) if created and delta[3] else created or delta[3])
+
+        for (object_type, object_id), (photos, likes, comments, created) in deltas.items():
+            manager.get_or_create(object_type=object_type, object_id=object_id)
+            aggregates = manager.filter(object_type=object_type, object_id=object_id)
+            aggregates.update(photos_count=F('photos_count') + photos,
+                              likes_count=F('likes_count') + likes,
+                              comments_count=F('comments_count') + comments)
+            if created:
+                aggregates.filter(Q(last_photo_created__lt=created) | Q(last_photo_created=None)) \
+                    .update(last_photo_created=created)
+
+    def rebuild(self, group_ids=None, using=None):
+        '''
+        Recalculate aggregates of albums and groups from stored photos in the database `using`,
+        by default in the database of writes
+        '''
+        from .routing import get_write_database
+
+        using = using or get_write_database()
+        photos = Photo.objects.using(using).filter(archived=False)
+        aggregates = self.using(using)
+        if group_ids is not None:
+            photos = photos.filter(owner_id__in=group_ids)
+            aggregates = aggregates.filter(
+                Q(object_type=PhotosAggregate.OBJECT_TYPE_GROUP, object_id__in=group_ids) |
+                Q(object_type=PhotosAggregate.OBJECT_TYPE_ALBUM,
+                  object_id__in=Album.objects.using(using).filter(owner_id__in=group_ids).values('pk')))
+        aggregates.delete()
+
+        count = 0
+        for object_type, field in [(PhotosAggregate.OBJECT_TYPE_ALBUM, 'album'), (PhotosAggregate.OBJECT_TYPE_GROUP, 'owner_id')]:
+            rows = photos.order_by().values(field).annotate(photos_count=Count('id'), likes_count=Sum('likes_count'),
+                                                             comments_count=Sum('comments_count'), last_photo_created=Max('created'))
+            self.db_manager(using).bulk_create([PhotosAggregate(object_type=object_type, object_id=row.pop(field), **row) for row in rows])
+            count += len(rows)
+
+        return count
+
+
+class PhotosAggregate(models.Model):
+    '''
+    Totals of stored photos per album and per group, maintained incrementally by the remote managers
+    '''
+    class Meta:
+        verbose_name = u'Статистика фотографий Одноклассники'
+        verbose_name_plural = u'Статистика фотографий Одноклассники'
+        unique_together = (('object_type', 'object_id'),)
+
+    OBJECT_TYPE_ALBUM = 1
+    OBJECT_TYPE_GROUP = 2
+    OBJECT_TYPE_CHOICES = (
+        (OBJECT_TYPE_ALBUM, u'Альбом'),
+        (OBJECT_TYPE_GROUP, u'Группа'),
+    )
+
+    object_type = models.PositiveSmallIntegerField(choices=OBJECT_TYPE_CHOICES)
+    object_id = models.BigIntegerField()
+
+    photos_count = models.IntegerField(default=0)
+    likes_count = models.BigIntegerField(default=0)
+    comments_count = models.BigIntegerField(default=0)
+    last_photo_created = models.DateTimeField(null=True)
+
+    objects = PhotosAggregateManager()
+
+
+class LikesLeaseManager(models.Manager):
+
+    def get_owner(self):
+        return '%s:%d:%d' % (socket.gethostname(), os.getpid(), threading.current_thread().ident)
+
+    def get_database(self):
+        from .routing import get_write_database
+        return LIKES_LEASE_DATABASE or get_write_database()
+
+    def is_fresh(self, instance):
+        '''
+        Return True if all likes of the instance were fetched less than LIKES_FRESHNESS seconds ago
+        '''
+        synced_after = datetime.utcnow().replace(tzinfo=utc) - timedelta(seconds=LIKES_FRESHNESS)
+        return self.using(self.get_database()).filter(object_type=OBJECT_TYPES[instance._meta.object_name],
+                                                      object_id=instance.pk, synced__gte=synced_after).exists()
+
+    def claim(self, instance, full=True):
+        '''
+        Return lease for fetching likes of the instance or None, if likes are fetching by another worker.
+        For fetching of all likes (`full`) None is returned also if they are fresh enough.
+        With LIKES_LEASE_DATABASE the lease is claimed in its own transaction, committed before fetching
+        '''
+        if LIKES_LEASE_DATABASE:
+            with atomic(using=LIKES_LEASE_DATABASE):
+                return self._claim(instance, full, LIKES_LEASE_DATABASE)
+        return self._claim(instance, full, self.get_database())
+
+    def _claim(self, instance, full, using):
+        now = datetime.utcnow().replace(tzinfo=utc)
+        owner = self.get_owner()
+        expires = now + timedelta(seconds=LIKES_LEASE_TIMEOUT)
+        object_type = OBJECT_TYPES[instance._meta.object_name]
+        leases = self.using(using)
+
+        try:
+            lease = leases.get(object_type=object_type, object_id=instance.pk)
+        except LikesLease.DoesNotExist:
+            try:
+                sid = transaction.savepoint(using=using)
+                lease = leases.create(object_type=object_type, object_id=instance.pk, owner=owner, expires=expires)
+                transaction.savepoint_commit(sid, using=using)
+                return lease
+            except IntegrityError:
+                # another worker has just created the lease
+                transaction.savepoint_rollback(sid, using=using)
+                return None
+
+        if full and lease.synced and lease.synced >= now - timedelta(seconds=LIKES_FRESHNESS):
+            return None
+
+        # lease is taken, if it's expired or it's already ours
+        if leases.filter(pk=lease.pk).filter(Q(expires__lt=now) | Q(owner=owner)).update(owner=owner, expires=expires):
+            lease.owner, lease.expires = owner, expires
+            return lease
+
+        return None
+
+    def extend(self, lease):
+        '''
+        Prolong the lease for LIKES_LEASE_TIMEOUT seconds from now while likes are fetching.
+        Raise LikesLeaseLost, if the lease expired and was claimed by another worker
+        '''
+        expires = datetime.utcnow().replace(tzinfo=utc) + timedelta(seconds=LIKES_LEASE_TIMEOUT)
+        if not self._update(lease, expires=expires):
+            raise LikesLeaseLost('Lease of likes of object %d of type %d is claimed by another worker'
+                                 % (lease.object_id, lease.object_type))
+        lease.expires = expires
+
+    def release(self, lease, synced=False):
+        now = datetime.utcnow().replace(tzinfo=utc)
+        values = {'expires': now}
+        if synced:
+            values['synced'] = now
+        self._update(lease, **values)
+
+    def _update(self, lease, **values):
+        leases = self.using(self.get_database()).filter(pk=lease.pk, owner=lease.owner)
+        if LIKES_LEASE_DATABASE:
+            with atomic(using=LIKES_LEASE_DATABASE):
+                return leases.update(**values)
+        return leases.update(**values)
+
+
+class LikesLeaseLost(Exception):
+    '''
+    Lease of fetching likes expired during fetching and was claimed by another worker
+    '''
+
+
+class LikesLease(models.Model):
+    '''
+    Lease of fetching likes of album or photo by one worker at a time
+    '''
+    class Meta:
+        verbose_name = u'Блокировка обновления лайков Одноклассники'
+        verbose_name_plural = u'Блокировки обновления лайков Одноклассники'
+        unique_together = (('object_type', 'object_id'),)
+
+    object_type = models.PositiveSmallIntegerField()
+    object_id = models.BigIntegerField()
+
+    owner = models.CharField(max_length=100)
+    expires = models.DateTimeField()
+    # time of the last fetching of all likes
+    synced = models.DateTimeField(null=True)
+
+    objects = LikesLeaseManager()
+
+
+class PhotoImageManager(models.Manager):
+
+    def get_local(self, photo, size):
+        '''
+        Return downloaded image of the photo of the size or None, registering access to it for LRU eviction
+        '''
+        try:
+            image = self.get(photo=photo, size=size)
+        except PhotoImage.DoesNotExist:
+            return None
+
+        image.accessed = datetime.utcnow().replace(tzinfo=utc)
+        self.filter(pk=image.pk).update(accessed=image.accessed)
+        return image
+
+
+class PhotoImage(models.Model):
+    '''
+    Local copy of the size variant of the photo in the content-addressed store of downloader
+    '''
+    class Meta:
+        verbose_name = u'Локальная копия фотографии Одноклассники'
+        verbose_name_plural = u'Локальные копии фотографий Одноклассники'
+        unique_together = (('photo', 'size'),)
+
+    photo = models.ForeignKey(Photo, related_name='images')
+    # name of the field with url of the size variant, for example pic128x128
+    size = models.CharField(max_length=20)
+    url = models.URLField()
+
+    # sha1 of the content, it defines path of the file in the store
+    checksum = models.CharField(max_length=40, db_index=True)
+    path = models.CharField(max_length=100)
+    bytes = models.PositiveIntegerField()
+
+    downloaded = models.DateTimeField()
+    accessed = models.DateTimeField(db_index=True)
+
+    objects = PhotoImageManager()
+
+
+class ChangeEventManager(models.Manager):
+
+    def record(self, model, created_ids, changed_fields, using=None):
+        '''
+        Append event to the outbox in the database `using`, by default in the database of writes, by own transaction
+        '''
+        import simplejson as json
+        from .routing import get_write_database
+
+        using = using or get_write_database()
+        with atomic(using=using):
+            return self.db_manager(using).create(
+                object_type=OBJECT_TYPES[model._meta.object_name],
+                created_ids=','.join([str(pk) for pk in created_ids]),
+                changed_fields=json.dumps(dict([(str(pk), fields) for pk, fields in changed_fields.items()])),
+                timestamp=datetime.utcnow().replace(tzinfo=utc))
+
+    def read(self, cursor=0, limit=100, model=None, lag=None):
+        '''
+        Return list of events after the `cursor`, pk of the last read event is the cursor for the next reading.
+        Events are returned up to the first one younger than `lag` seconds (EVENTS_READ_LAG by default):
+        events with lower pks can be still uncommitted by other workers, the cursor would skip them forever
+        '''
+        lag = EVENTS_READ_LAG if lag is None else lag
+        visible = datetime.utcnow().replace(tzinfo=utc) - timedelta(seconds=lag)
+
+        events = self.filter(pk__gt=cursor)
+        if model is not None:
+            events = events.filter(object_type=OBJECT_TYPES[model._meta.object_name])
+
+        result = []
+        for event in events.order_by('pk')[:limit]:
+            if event.timestamp > visible:
+                break
+            result += [event]
+        return result
+
+    def purge(self, older_than):
+        '''
+        Delete events older than `older_than` datetime. Return number of deleted events
+        '''
+        events = self.filter(timestamp__lt=older_than)
+        count = events.count()
+        events.delete()
+        return count
+
+
+class ChangeEvent(models.Model):
+    '''
+    Outbox of saved pages of albums and photos: created instances and changed fields of updated ones
+    '''
+    class Meta:
+        verbose_name = u'Изменение альбомов или фотографий Одноклассники'
+        verbose_name_plural = u'Изменения альбомов и фотографий Одноклассники'
+
+    # 1 - album, 2 - photo
+    object_type = models.PositiveSmallIntegerField()
+    # comma separated ids
+    created_ids = models.TextField(blank=True)
+    # JSON dict of id -> list of changed fields
+    changed_fields = models.TextField(blank=True)
+    timestamp = models.DateTimeField(db_index=True)
+
+    objects = ChangeEventManager()
+
+    def get_created_ids(self):
+        return [int(pk) for pk in self.created_ids.split(',') if pk]
+
+    def get_changed_fields(self):
+        import simplejson as json
+        return dict([(int(pk), fields) for pk, fields in json.loads(self.changed_fields or '{}').items()])
+
+    def get_updated_ids(self):
+        return sorted(self.get_changed_fields().keys())
+
+
+class SearchPostingManager(models.Manager):
+
+    def index(self, model, ids, using=None):
+        '''
+        Replace postings of instances of the `model` with `ids` by terms of their current `search_field`
+        in the database `using`, by default in the database of writes
+        '''
+        from .routing import get_write_database
+        from .search import tokenize
+
+        using = using or get_write_database()
+        manager = self.db_manager(using)
+        object_type = OBJECT_TYPES[model._meta.object_name]
+        for chunk in list_chunks_iterator(list(ids), IN_CLAUSE_LIMIT):
+            manager.filter(object_type=object_type, object_id__in=chunk).delete()
+
+            postings = []
+            for pk, text in model.objects.using(using).filter(pk__in=chunk).values_list('pk', model.search_field):
+                counts = {}
+                for term in tokenize(text):
+                    counts[term] = counts.get(term, 0) + 1
+                postings += [SearchPosting(object_type=object_type, term=term, object_id=pk, count=min(count, 32767))
+                             for term, count in counts.items()]
+            manager.bulk_create(postings)
+
+    def rebuild(self, model, using=None):
+        '''
+        Index all instances of the `model` from scratch by chunks of ids in the database `using`,
+        by default in the database of writes. Return number of indexed instances
+        '''
+        from .routing import get_write_database
+
+        using = using or get_write_database()
+        self.db_manager(using).filter(object_type=OBJECT_TYPES[model._meta.object_name]).delete()
+
+        count = 0
+        last_id = None
+        while True:
+            ids = model.objects.using(using).order_by('pk')
+            if last_id is not None:
+                ids = ids.filter(pk__gt=last_id)
+            ids = list(ids.values_list('pk', flat=True)[:IN_CLAUSE_LIMIT])
+            if not ids:
+                break
+            self.index(model, ids, using=using)
+            count += len(ids)
+            last_id = ids[-1]
+        return count
+
+
+class SearchPosting(models.Model):
+    '''
+    Term of the inverted index of titles of albums and texts of photos
+    '''
+    class Meta:
+        verbose_name = u'Термин поискового индекса фотографий Одноклассники'
+        verbose_name_plural = u'Термины поискового индекса фотографий Одноклассники'
+        unique_together = (('object_type', 'term', 'object_id'),)
+
+    # 1 - album, 2 - photo
+    object_type = models.PositiveSmallIntegerField()
+    term = models.CharField(max_length=50)
+    object_id = models.BigIntegerField(db_index=True)
+    # number of occurrences of the term
+    count = models.PositiveSmallIntegerField(default=1)
+
+    objects = SearchPostingManager()
+
+
+class LikeEdgeManager(models.Manager):
+
+    def get_object_type(self, model):
+        return OBJECT_TYPES[model._meta.object_name]
+
+    def get_timestamp(self, value):
+        return calendar.timegm(value.utctimetuple())
+
+    def get_shard(self, owner_id, timestamp):
+        '''
+        Return partition key of the edge of object of the owner group, added at `timestamp`
+        '''
+        if LIKES_PARTITION == 'time':
+            added = datetime.utcfromtimestamp(timestamp)
+            return added.year * 100 + added.month
+        return owner_id % LIKES_SHARDS
+
+    def get_edges(self, model, instances, at=None, using=None):
+        '''
+        Return queryset of edges of likes of `instances` of the `model`, current or at the moment `at`,
+        in the database `using`, decided by the router by default. Only shards, where edges can be, are read:
+        with partitioning by time current likes can be in any shard
+        '''
+        edges = self.using(using).filter(object_type=OBJECT_TYPES[model._meta.object_name])
+        if LIKES_PARTITION == 'group':
+            edges = edges.filter(shard__in=list(set([self.get_shard(instance.owner_id, 0) for instance in instances])))
+
+        if at is None:
+            edges = edges.filter(removed=None)
+        else:
+            timestamp = self.get_timestamp(at)
+            edges = edges.filter(Q(removed=None) | Q(removed__gt=timestamp), added__lte=timestamp)
+            if LIKES_PARTITION == 'time':
+                edges = edges.filter(shard__lte=self.get_shard(None, timestamp))
+        return edges
+
+    def get_users(self, instance, at=None):
+        from .routing import get_read_database
+        # users are in the same database as likes, like_users fields join them
+        using = get_read_database()
+        edges = self.get_edges(instance.__class__, [instance], at, using=using)
+        return User.objects.using(using).filter(pk__in=edges.filter(object_id=instance.pk).values('user_id'))
+
+    def iterate_current_ids(self, instance):
+        '''
+        Iterate over ids of users of current likes of the instance in ascending order, fetching them by chunks
+        from the database of writes, because changes of likes are decided by them
+        '''
+        from .routing import get_write_database
+        edges = self.get_edges(instance.__class__, [instance], using=get_write_database()).filter(object_id=instance.pk)
+        last_id = None
+        while True:
+            ids = edges if last_id is None else edges.filter(user_id__gt=last_id)
+            ids = list(ids.order_by('user_id').values_list('user_id', flat=True).distinct()[:LIKES_CHUNK_SIZE])
+            for user_id in ids:
+                yield user_id
+            if len(ids) < LIKES_CHUNK_SIZE:
+                break
+            last_id = ids[-1]
+
+    def add(self, instance, users_ids, timestamp):
+        from .routing import get_write_database
+        object_type = OBJECT_TYPES[instance.__class__._meta.object_name]
+        self.db_manager(get_write_database()).bulk_create([LikeEdge(shard=self.get_shard(instance.owner_id, timestamp), object_type=object_type,
+                                   object_id=instance.pk, user_id=user_id, added=timestamp)
+                          for user_id in users_ids])
+
+    def remove(self, instance, users_ids, timestamp):
+        from .routing import get_write_database
+        self.get_edges(instance.__class__, [instance], using=get_write_database()) \
+            .filter(object_id=instance.pk, user_id__in=list(users_ids)).update(removed=timestamp)
+
+    def copy_from_m2m(self, model, chunk_size=None):
+        '''
+        Copy history of likes of the `model` from the table of like_users field by chunks ordered by pk,
+        every chunk in its own transaction of the database of writes. Return number of copied edges
+        '''
+        from .routing import get_write_database
+
+        using = get_write_database()
+        chunk_size = chunk_size or LIKES_CHUNK_SIZE
+        field = model._meta.get_field('like_users')
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        object_type = OBJECT_TYPES[model._meta.object_name]
+        owners = {}
+
+        count = 0
+        last_id = None
+        while True:
+            rows = field.rel.through.objects.using(using).order_by('pk')
+            if last_id is not None:
+                rows = rows.filter(pk__gt=last_id)
+            rows = list(rows.values_list('pk', source, target, 'time_from', 'time_to')[:chunk_size])
+            if not rows:
+                break
+
+            missing = set([row[1] for row in rows]) - set(owners)
+            owners.update(model.objects.using(using).filter(pk__in=list(missing)).values_list('pk', 'owner_id'))
+
+            edges = []
+            for pk, object_id, user_id, time_from, time_to in rows:
+                added = self.get_timestamp(time_from) if time_from else 0
+                edges += [LikeEdge(shard=self.get_shard(owners.get(object_id, 0), added), object_type=object_type,
+                                   object_id=object_id, user_id=user_id, added=added,
+                                   removed=self.get_timestamp(time_to) if time_to else None)]
+            with atomic(using=using):
+                self.db_manager(using).bulk_create(edges)
+            count += len(edges)
+            last_id = rows[-1][0]
+
+        return count
+
+    def get_copy_differences(self, model):
+        '''
+        Return list of differences between the table of like_users field of the `model` and its edges:
+        tuples (name of counter, count in the table, count of edges). Empty list means the copy is complete
+        '''
+        from .routing import get_write_database
+
+        using = get_write_database()
+        through = model._meta.get_field('like_users').rel.through.objects.using(using)
+        edges = self.using(using).filter(object_type=OBJECT_TYPES[model._meta.object_name])
+        counts = [
+            ('likes', through.count(), edges.count()),
+            ('current likes', through.filter(time_to=None).count(), edges.filter(removed=None).count()),
+        ]
+        return [(name, expected, copied) for name, expected, copied in counts if expected != copied]
+
+
+class LikeEdge(models.Model):
+    '''
+    Compact edge of history of likes: object, user and unix timestamps of adding and removing of like.
+    `shard` is the partition key: owner group of the object or month of adding of like. It's one table,
+    queries are limited to shards by conditions on the leading column of the index; native partitions of the database
+    or tables per shard aren't created by the app, the table can be partitioned by `shard` by the database.
+    Indexes (shard, object_type, object_id, user_id) and (object_type, object_id) for partitions by time
+    are created by migrations, index_together isn't available in Django 1.4
+    '''
+    class Meta:
+        verbose_name = u'Лайк альбома или фотографии Одноклассники'
+        verbose_name_plural = u'Лайки альбомов и фотографий Одноклассники'
+
+    shard = models.PositiveIntegerField()
+    # 1 - album, 2 - photo
+    object_type = models.PositiveSmallIntegerField()
+    object_id = models.BigIntegerField()
+    user_id = models.BigIntegerField()
+    added = models.BigIntegerField()
+    removed = models.BigIntegerField(null=True)
+
+    objects = LikeEdgeManager()
+
+
+if CACHE:
+    from .cache import connect_invalidation
+    connect_invalidation(Album, Photo, Group)
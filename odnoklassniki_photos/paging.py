@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+import threading
+
+# API limits of `count` parameter of methods, the only place where they are defined
+PAGE_LIMITS = {
+    'photos.getAlbums': 100,
+    'photos.getPhotos': 100,
+    'photos.getInfo': 100,
+    'photos.getAlbumLikes': 100,
+    'photos.getPhotoLikes': 100,
+}
+
+ADAPTIVE_PAGING = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_ADAPTIVE_PAGING', True)
+PAGE_MIN_SIZE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_PAGE_MIN_SIZE', 10)
+PAGE_SIZE_STEP = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_PAGE_SIZE_STEP', 10)
+# weight of the last measurement in the smoothed throughput of the page size
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class PageSizeController(object):
+    '''
+    Tuner of page size of the API method for the best number of items per second.
+    After every full page the size moves by `step` in the direction, where smoothed throughput grows,
+    and turns back, when it falls. After error the size is halved.
+    Size is always between `min_size` and API limit of the method
+    '''
+    def __init__(self, limit, min_size=None, step=None, adaptive=None):
+        self.limit = limit
+        self.min_size = min(PAGE_MIN_SIZE if min_size is None else min_size, limit)
+        self.step = PAGE_SIZE_STEP if step is None else step
+        self.adaptive = ADAPTIVE_PAGING if adaptive is None else adaptive
+
+        self.size = limit
+        self.direction = -1
+        self.previous_size = None
+        # page size -> smoothed items per second
+        self.throughput = {}
+
+        self.requests = 0
+        self.errors = 0
+        self.items = 0
+        self.seconds = 0.
+
+        self.lock = threading.Lock()
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.limit, size))
+
+    def record(self, size, items, seconds, error=False):
+        '''
+        Register result of request of page of `size`: number of returned `items` and spent `seconds`
+        '''
+        with self.lock:
+            self.requests += 1
+            self.seconds += seconds
+            if error:
+                self.errors += 1
+                if self.adaptive:
+                    self.previous_size, self.size, self.direction = self.size, self.clamp(size // 2), 1
+                return
+
+            self.items += items
+            # last pages are shorter and pages of not current size are requested by explicit count
+            if not self.adaptive or size != self.size or items < size or seconds <= 0:
+                return
+
+            throughput = items / seconds
+            smoothed = self.throughput.get(size)
+            self.throughput[size] = throughput if smoothed is None \
+                else smoothed * (1 - THROUGHPUT_SMOOTHING) + throughput * THROUGHPUT_SMOOTHING
+
+            previous = self.throughput.get(self.previous_size)
+            if previous is not None and self.throughput[size] < previous:
+                self.direction = -self.direction
+
+            size_next = self.clamp(size + self.direction * self.step)
+            if size_next == size:
+                self.direction = -self.direction
+                size_next = self.clamp(size + self.direction * self.step)
+
+            self.previous_size, self.size = size, size_next
+
+    def get_metrics(self):
+        return {
+            'size': self.size,
+            'limit': self.limit,
+            'requests': self.requests,
+            'errors': self.errors,
+            'error_rate': float(self.errors) / self.requests if self.requests else 0.,
+            'items_per_second': self.items / self.seconds if self.seconds else 0.,
+        }
+
+
+controllers = {}
+controllers_lock = threading.Lock()
+
+
+def get_controller(method):
+    '''
+    Return page size controller of the API method, shared by all managers of the process
+    '''
+    controller = controllers.get(method)
+    if controller is None:
+        with controllers_lock:
+            controller = controllers.setdefault(method, PageSizeController(PAGE_LIMITS[method]))
+    return controller
+
+
+def get_metrics():
+    '''
+    Return dict of API method -> chosen page size and measurements of its requests
+    '''
+    return dict([(method, controller.get_metrics()) for method, controller in controllers.items()])
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+log = logging.getLogger('odnoklassniki_photos')
+
+# profiling of fetch entry points: None - disabled, 'cprofile' - deterministic profile of every phase,
+# 'sampling' - call stacks sampled by the thread and written in collapsed format of flamegraph.pl
+PROFILE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_PROFILE', None)
+# directory of files of runs, by default in the temporary directory, not in the working one of the process
+PROFILE_DIR = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_PROFILE_DIR',
+                      os.path.join(tempfile.gettempdir(), 'odnoklassniki_photos_profiles'))
+# seconds between samples of call stack in 'sampling' mode
+PROFILE_INTERVAL = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_PROFILE_INTERVAL', 0.005)
+
+MODES = ('cprofile', 'sampling')
+# time outside of phases is accounted as 'other'
+PHASES = ('http', 'decode', 'parse', 'persist', 'likes', 'other')
+# decoding of responses happens inside of API client: Response.json() of requests is accounted to decode phase
+# in both modes, samples of http phase in these modules are decode phase too, if it's decoded by other way
+DECODE_MODULES = ('json', 'simplejson')
+
+state = threading.local()
+# number of active runs in all threads, phases aren't accounted without them
+active = 0
+lock = threading.Lock()
+
+
+class Sampler(threading.Thread):
+    '''
+    Thread, that samples call stack of the profiled thread every `interval` seconds
+    '''
+    def __init__(self, run, interval):
+        super(Sampler, self).__init__(name='odnoklassniki_photos_sampler')
+        self.daemon = True
+        self.run_ = run
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.run_.thread_id)
+            if frame is not None:
+                self.run_.add_sample(frame)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class ProfileRun(object):
+    '''
+    Profile of one run of the fetch entry point: wall time of phases and cProfile profiles of every phase
+    or sampled call stacks, prefixed by the phase
+    '''
+    def __init__(self, name, mode=None, directory=None, interval=None):
+        self.name = name
+        self.mode = mode or PROFILE
+        if self.mode not in MODES:
+            raise ValueError('Unknown mode of profiling %s, available: %s' % (self.mode, ', '.join(MODES)))
+        self.directory = directory or PROFILE_DIR
+        self.interval = interval or PROFILE_INTERVAL
+        self.thread_id = threading.current_thread().ident
+
+        self.phases = []
+        self.seconds = {}
+        self.profilers = {}
+        self.stacks = {}
+        self.sampler = None
+        self.mark = None
+        self.started = None
+
+    @property
+    def phase(self):
+        return self.phases[-1] if self.phases else 'other'
+
+    def get_profiler(self, phase):
+        if phase not in self.profilers:
+            import cProfile
+            self.profilers[phase] = cProfile.Profile()
+        return self.profilers[phase]
+
+    def switch(self, enter=None):
+        '''
+        Account time of the current phase and enter the phase `enter` or return to the outer one
+        '''
+        now = time.time()
+        self.seconds[self.phase] = self.seconds.get(self.phase, 0.) + now - self.mark
+        self.mark = now
+
+        if self.mode == 'cprofile':
+            # only one profiler can be active in the thread
+            self.get_profiler(self.phase).disable()
+        if enter:
+            self.phases.append(enter)
+        else:
+            self.phases.pop()
+        if self.mode == 'cprofile':
+            self.get_profiler(self.phase).enable()
+
+    def add_sample(self, frame):
+        phase = self.phase
+        names = []
+        while frame is not None:
+            module = frame.f_globals.get('__name__', '?')
+            if phase == 'http' and module.split('.')[0] in DECODE_MODULES:
+                phase = 'decode'
+            names.append('%s:%s' % (module, frame.f_code.co_name))
+            frame = frame.f_back
+        key = ';'.join([phase] + names[::-1])
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def start(self):
+        self.started = self.mark = time.time()
+        if self.mode == 'cprofile':
+            self.get_profiler(self.phase).enable()
+        else:
+            self.sampler = Sampler(self, self.interval)
+            self.sampler.start()
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            self.get_profiler(self.phase).disable()
+        else:
+            self.sampler.stop()
+        self.seconds[self.phase] = self.seconds.get(self.phase, 0.) + time.time() - self.mark
+
+    def save(self):
+        '''
+        Write files of the run: <prefix>.json with seconds of phases, <prefix>.<phase>.prof with profiles of phases
+        or <prefix>.collapsed with sampled stacks. Prefix contains name, mode, time with microseconds and pid,
+        so runs of the same second don't overwrite each other. Return list of paths
+        '''
+        import simplejson as json
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        prefix = os.path.join(self.directory, '%s-%s-%s-%d' % (self.name, self.mode, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'),
+                                                               os.getpid()))
+
+        paths = [prefix + '.json']
+        with open(paths[0], 'w') as f:
+            json.dump({'name': self.name, 'mode': self.mode, 'total': time.time() - self.started,
+                       'seconds': self.seconds}, f, indent=2)
+
+        if self.mode == 'cprofile':
+            for phase, profiler in sorted(self.profilers.items()):
+                paths += ['%s.%s.prof' % (prefix, phase)]
+                profiler.dump_stats(paths[-1])
+        else:
+            paths += [prefix + '.collapsed']
+            with open(paths[-1], 'w') as f:
+                for key, count in sorted(self.stacks.items()):
+                    f.write('%s %d\n' % (key, count))
+        return paths
+
+
+def get_run():
+    return getattr(state, 'run', None) if active else None
+
+
+def install_decode_phase():
+    '''
+    Account Response.json() of requests, used by API client for decoding of responses, to decode phase
+    '''
+    from requests.models import Response
+
+    if not getattr(Response.json, 'decode_phase', False):
+        json = in_phase('decode')(Response.json)
+        json.decode_phase = True
+        Response.json = json
+
+
+@contextmanager
+def profile_run(name, mode=None, directory=None, interval=None):
+    '''
+    Profile the block in the current thread and write files of the run at the end
+    '''
+    global active
+
+    run = ProfileRun(name, mode, directory, interval)
+    with lock:
+        install_decode_phase()
+        active += 1
+    state.run = run
+    run.start()
+    try:
+        yield run
+    finally:
+        run.stop()
+        state.run = None
+        with lock:
+            active -= 1
+        log.info('Profile of %s is written to %s' % (name, ', '.join(run.save())))
+
+
+@contextmanager
+def phase(name):
+    '''
+    Account the block to the phase `name` of the current profile run, if there is one
+    '''
+    run = get_run()
+    if run is None:
+        yield
+        return
+    run.switch(enter=name)
+    try:
+        yield
+    finally:
+        run.switch()
+
+
+def in_phase(name):
+    '''
+    Decorator of functions, the whole call is accounted to the phase `name`. Without active runs
+    it only calls the function
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not active:
+                return func(*args, **kwargs)
+            run = getattr(state, 'run', None)
+            if run is None:
+                return func(*args, **kwargs)
+            run.switch(enter=name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                run.switch()
+        return wrapper
+    return decorator
+
+
+def profiled(method):
+    '''
+    Decorator of fetch entry points: with ODNOKLASSNIKI_PHOTOS_PROFILE every call is profiled as separate run,
+    nested calls of entry points are parts of the outer run
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not PROFILE or get_run() is not None:
+            return method(self, *args, **kwargs)
+        with profile_run('%s.%s' % (getattr(self, 'model', self.__class__).__name__, method.__name__)):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def rank_collapsed(paths, limit=20):
+    '''
+    Return list of tuples (function, samples on top of stack, samples in stack), ranked by samples on top,
+    and dict of phase -> samples from files of collapsed stacks
+    '''
+    own, total, phases = {}, {}, {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                key, count = line.rsplit(' ', 1)
+                names, count = key.split(';'), int(count)
+                phases[names[0]] = phases.get(names[0], 0) + count
+                own[names[-1]] = own.get(names[-1], 0) + count
+                for name in set(names[1:]):
+                    total[name] = total.get(name, 0) + count
+
+    ranked = sorted(own.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    return [(name, count, total.get(name, count)) for name, count in ranked], phases
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db import connections, DatabaseError, DEFAULT_DB_ALIAS
+from django.db.models.query import QuerySet
+from odnoklassniki_api.decorators import atomic
+from odnoklassniki_api.models import MASTER_DATABASE
+from .utils import drop_ids_tables, get_ids_tables
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import threading
+import time
+
+log = logging.getLogger('odnoklassniki_photos')
+
+# database of writes of fetching, the primary
+WRITE_DATABASE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_WRITE_DATABASE', MASTER_DATABASE)
+# database of querysets returned by remote managers and of reads outside of fetching, None - decided by Django
+READ_DATABASE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_READ_DATABASE', None)
+# replicas for existence checks and diff queries of fetching, used while their lag is not more than REPLICA_MAX_LAG seconds
+REPLICA_DATABASES = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_REPLICA_DATABASES', ())
+REPLICA_MAX_LAG = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_REPLICA_MAX_LAG', 5)
+# lag of replica is measured not more often than once per this number of seconds
+REPLICA_LAG_CHECK_INTERVAL = 1
+
+APP_LABEL = 'odnoklassniki_photos'
+
+state = threading.local()
+
+
+def get_write_database():
+    '''
+    Return alias of the database of the current fetching or the primary one
+    '''
+    return getattr(state, 'using', None) or WRITE_DATABASE
+
+
+def get_read_database():
+    '''
+    Return alias of the database for querysets returned by fetching. Inside of fetching it's the database of writes,
+    so nested fetch methods return querysets, that see instances written by the outer transaction
+    '''
+    return getattr(state, 'using', None) or READ_DATABASE or WRITE_DATABASE
+
+
+def get_replica_lag(alias):
+    '''
+    Return lag of replication of the database in seconds, 0 for the primary and databases without replication,
+    None if the replica hasn't replayed anything yet
+    '''
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0
+
+    if connection.pg_version >= 100000:
+        receive, replay = 'pg_last_wal_receive_lsn()', 'pg_last_wal_replay_lsn()'
+    else:
+        receive, replay = 'pg_last_xlog_receive_location()', 'pg_last_xlog_replay_location()'
+
+    cursor = connection.cursor()
+    # replica, that replayed everything received, isn't lagging even if the primary is idle for a long time
+    cursor.execute('SELECT CASE WHEN NOT pg_is_in_recovery() OR %s = %s THEN 0 '
+                   'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END' % (receive, replay))
+    lag = cursor.fetchone()[0]
+    return float(lag) if lag is not None else None
+
+
+lags = {}
+
+
+def get_replica_database():
+    '''
+    Return alias of the first replica with lag not more than REPLICA_MAX_LAG or the database of writes
+    '''
+    for alias in REPLICA_DATABASES:
+        checked, lag = lags.get(alias, (0, None))
+        if time.time() - checked > REPLICA_LAG_CHECK_INTERVAL:
+            try:
+                lag = get_replica_lag(alias)
+            except DatabaseError as e:
+                log.warning('Lag of replica %s is unknown: %s' % (alias, e))
+                lag = None
+            lags[alias] = (time.time(), lag)
+        if lag is not None and lag <= REPLICA_MAX_LAG:
+            return alias
+    return get_write_database()
+
+
+@contextmanager
+def using_database(alias=None):
+    '''
+    Write fetched instances to the database `alias` inside the block, nested blocks without alias use the outer one
+    '''
+    previous = getattr(state, 'using', None)
+    state.using = alias or previous or WRITE_DATABASE
+    try:
+        yield state.using
+    finally:
+        state.using = previous
+
+
+def add_callback(func, args, always):
+    callbacks = getattr(state, 'callbacks', None)
+    if callbacks is None:
+        return False
+    callbacks.append((func, args, always))
+    return True
+
+
+def after_fetching(func, *args):
+    '''
+    Call `func` with `args` after the outermost fetch method of the thread exits and its transaction is committed
+    or rolled back. Return False outside of fetching, `func` isn't called then
+    '''
+    return add_callback(func, args, True)
+
+
+def after_commit(func, *args):
+    '''
+    Call `func` with `args` after the outermost fetch method of the thread exits and its transaction is committed,
+    not after failed fetching. Return False outside of fetching, `func` isn't called then
+    '''
+    return add_callback(func, args, False)
+
+
+def routed(method):
+    '''
+    Decorator of fetch methods: argument `using` is the alias of the database for writes of fetching,
+    the whole call is made in transaction of this database. Callbacks of after_fetching() and after_commit()
+    are called when the outermost call exits, queryset returned by it is bound to the read database,
+    unless it's joined with temporary table of ids in the session of the database of writes.
+    Other temporary tables of ids of the thread are dropped
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        outermost = getattr(state, 'callbacks', None) is None
+        if outermost:
+            state.callbacks = []
+        failed = True
+        result = None
+        try:
+            with using_database(kwargs.pop('using', None)) as using:
+                if using == DEFAULT_DB_ALIAS:
+                    result = method(self, *args, **kwargs)
+                else:
+                    # decorator @atomic of fetch methods opens transaction only in the default database
+                    with atomic(using=using):
+                        result = method(self, *args, **kwargs)
+            failed = False
+        finally:
+            if outermost:
+                callbacks, state.callbacks = state.callbacks, None
+                for func, args, always in callbacks:
+                    if always or not failed:
+                        func(*args)
+
+                tables = get_ids_tables(result) if isinstance(result, QuerySet) else []
+                drop_ids_tables(keep=tables)
+                if isinstance(result, QuerySet) and not tables:
+                    result = result.using(get_read_database())
+        return result
+    return wrapper
+
+
+class PhotosRouter(object):
+    '''
+    Router of models of the app: writes go to the database of fetching, reads inside of fetching go to the same
+    database, so they see instances written by it, other reads go to READ_DATABASE. Usage in settings:
+
+        DATABASE_ROUTERS = ['odnoklassniki_photos.routing.PhotosRouter']
+    '''
+    def get_databases(self):
+        return set([alias for alias in [get_write_database(), READ_DATABASE] + list(REPLICA_DATABASES) if alias])
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            return getattr(state, 'using', None) or READ_DATABASE
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            return get_write_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the same data in the primary and its replicas
+        databases = self.get_databases()
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
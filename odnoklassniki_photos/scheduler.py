@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+from django.db.models import Q
+from odnoklassniki_groups.models import Group
+from .models import Album, Photo, CrawlTask, Likable, PhotoBaseRemoteManager
+from .routing import using_database
+from .utils import IN_CLAUSE_LIMIT
+from datetime import datetime
+from pytz import utc
+import logging
+import math
+
+log = logging.getLogger('odnoklassniki_photos')
+
+REQUESTS_BUDGET = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_CRAWL_REQUESTS_BUDGET', 1000)
+
+# hours since the last run of the task, the parameter is the current time
+STALE_HOURS_SQL = {
+    'postgresql': 'EXTRACT(EPOCH FROM %s - last_run) / 3600',
+    'mysql': 'TIMESTAMPDIFF(SECOND, last_run, %s) / 3600',
+    'sqlite': '(julianday(%s) - julianday(last_run)) * 24',
+}
+
+
+class CrawlScheduler(object):
+    '''
+    Persistent queue of crawl tasks for groups, albums and likes.
+    Tasks are executed in order of priority (staleness multiplied by observed change rate)
+    while global budget of API requests is not spent.
+    Usage:
+
+        >>> scheduler = CrawlScheduler(budget=500)
+        >>> scheduler.schedule_group(group)
+        >>> scheduler.run()
+    '''
+    def __init__(self, budget=None):
+        self.budget = REQUESTS_BUDGET if budget is None else budget
+        self.requests_spent = 0
+
+    def get_task(self, kind, target):
+        task, created = CrawlTask.objects.get_or_create(kind=kind,
+                                                        target_content_type=ContentType.objects.get_for_model(target),
+                                                        target_id=target.pk)
+        return task
+
+    def get_tasks(self, kind, model, ids):
+        '''
+        Return tasks of the `kind` for instances of the `model` with `ids`, missing tasks are created by one query
+        '''
+        content_type = ContentType.objects.get_for_model(model)
+        tasks = []
+        for i in range(0, len(ids), IN_CLAUSE_LIMIT):
+            chunk = ids[i:i + IN_CLAUSE_LIMIT]
+            existing = dict([(task.target_id, task) for task in CrawlTask.objects.filter(
+                kind=kind, target_content_type=content_type, target_id__in=chunk)])
+            missing = [pk for pk in chunk if pk not in existing]
+            if missing:
+                CrawlTask.objects.bulk_create([CrawlTask(kind=kind, target_content_type=content_type, target_id=pk)
+                                               for pk in missing])
+                # pks of instances, created by bulk_create, are unknown
+                existing.update([(task.target_id, task) for task in CrawlTask.objects.filter(
+                    kind=kind, target_content_type=content_type, target_id__in=missing)])
+            tasks += [existing[pk] for pk in chunk]
+        return tasks
+
+    def schedule_group(self, group):
+        '''
+        Put in the queue tasks for the group albums list, photos of every stored album
+        and likes of every stored album and photo with likes.
+        Albums, photos and tasks are read from the database of writes, so just fetched ones aren't missed
+        '''
+        if not isinstance(group, Group):
+            raise Exception('group parameter should be odnoklassniki_groups.models.Group object')
+
+        with using_database():
+            albums = list(Album.objects.filter(owner_id=group.pk).values_list('pk', 'likes_count'))
+
+            tasks = [self.get_task(CrawlTask.KIND_ALBUMS, group)]
+            tasks += self.get_tasks(CrawlTask.KIND_PHOTOS, Album, [pk for pk, likes_count in albums])
+            tasks += self.get_tasks(CrawlTask.KIND_LIKES, Album, [pk for pk, likes_count in albums if likes_count])
+            tasks += self.get_tasks(CrawlTask.KIND_LIKES, Photo, list(Photo.objects.filter(
+                owner_id=group.pk, likes_count__gt=0).values_list('pk', flat=True)))
+
+        return tasks
+
+    def update_priorities(self, now):
+        '''
+        Recalculate priorities of executed tasks by one UPDATE, the same formula as CrawlTask.get_priority
+        '''
+        alias = router.db_for_write(CrawlTask)
+        connection = connections[alias]
+        if connection.vendor not in STALE_HOURS_SQL:
+            for task in CrawlTask.objects.using(alias).exclude(last_run=None).iterator():
+                CrawlTask.objects.using(alias).filter(pk=task.pk).update(priority=task.get_priority(now))
+            return
+
+        now = connection.ops.value_to_db_datetime(now)
+        stale_hours = STALE_HOURS_SQL[connection.vendor]
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET priority = (change_rate + %%s) * CASE WHEN %s > 0 THEN %s ELSE 0 END '
+                       'WHERE last_run IS NOT NULL' % (CrawlTask._meta.db_table, stale_hours, stale_hours),
+                       [CrawlTask.BASE_CHANGE_RATE, now, now])
+
+    def estimate_cost(self, task):
+        '''
+        Estimated number of API requests, needed for executing the task
+        '''
+        target = task.target
+        if task.kind == CrawlTask.KIND_ALBUMS:
+            count, limit = Album.objects.filter(owner_id=target.pk).count(), Album.remote.__class__.fetch_album_limit
+        elif task.kind == CrawlTask.KIND_PHOTOS:
+            count, limit = target.photos_count, Photo.remote.__class__.fetch_photo_limit
+        else:
+            count, limit = target.likes_count, Likable.fetch_like_users_limit
+
+        return max(int(math.ceil(float(count) / limit)), 1)
+
+    def observe(self, task):
+        '''
+        Return state of the task target: value of counter and date of the last change
+        '''
+        target = task.target.__class__.objects.get(pk=task.target_id)
+        if task.kind == CrawlTask.KIND_ALBUMS:
+            return Album.objects.filter(owner_id=target.pk).count(), None
+        elif task.kind == CrawlTask.KIND_PHOTOS:
+            return target.photos_count, None
+        else:
+            return target.likes_count, target.last_like_date
+
+    def execute(self, task):
+        target = task.target
+        if task.kind == CrawlTask.KIND_ALBUMS:
+            Album.remote.fetch(group=target, all=True)
+            # discovered albums should get their own tasks
+            self.schedule_group(target)
+        elif task.kind == CrawlTask.KIND_PHOTOS:
+            target.fetch_photos(all=True)
+        else:
+            target.fetch_likes(all=True)
+
+    def run(self):
+        '''
+        Execute tasks with the highest priority, skipping ones that don't fit in the rest of the budget.
+        Targets and their counters are read from the database of writes, so albums just discovered by the previous
+        task and counters just fetched are seen without waiting for replicas. Return list of executed tasks
+        '''
+        with using_database():
+            now = datetime.utcnow().replace(tzinfo=utc)
+            self.update_priorities(now)
+
+            executed = []
+            # failed tasks wait for the end of backoff
+            for task in CrawlTask.objects.filter(Q(retry_after=None) | Q(retry_after__lte=now)).order_by('-priority').iterator():
+                remaining = self.budget - self.requests_spent
+                if remaining <= 0:
+                    break
+
+                if task.target is None:
+                    log.warning('Crawl task %s has no target anymore, deleting' % task)
+                    task.delete()
+                    continue
+
+                if self.estimate_cost(task) > remaining:
+                    continue
+
+                calls_before = PhotoBaseRemoteManager.api_calls_count
+                try:
+                    self.execute(task)
+                except Exception as e:
+                    log.error('Crawl task %s failed with error: %s' % (task, e))
+                    task.fail(now=datetime.utcnow().replace(tzinfo=utc))
+                    task.save()
+                    continue
+                finally:
+                    self.requests_spent += PhotoBaseRemoteManager.api_calls_count - calls_before
+
+                count, date = self.observe(task)
+                task.observe(count, date, now=datetime.utcnow().replace(tzinfo=utc))
+                task.save()
+                executed += [task]
+
+            return executed
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Count
+from django.utils.encoding import force_text
+import math
+import re
+import time
+
+# 'index' - inverted index in the table of the app, 'postgres' - native full-text search of PostgreSQL,
+# by default PostgreSQL is used, if it's the backend of the database
+SEARCH_BACKEND = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_SEARCH_BACKEND', None)
+# text search configuration of PostgreSQL, the same is used in the index created by migration
+SEARCH_POSTGRES_CONFIG = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_SEARCH_POSTGRES_CONFIG', 'russian')
+SEARCH_PAGE_SIZE = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_SEARCH_PAGE_SIZE', 20)
+# seconds of caching of number of documents for idf of terms of the index backend
+SEARCH_COUNT_TIMEOUT = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_SEARCH_COUNT_TIMEOUT', 600)
+
+MAX_TERM_LENGTH = 50
+MIN_STEM_LENGTH = 3
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(u'[а-я]', re.UNICODE)
+
+# endings of russian words, removed from terms, longest first
+RUSSIAN_ENDINGS = sorted(u'''
+    иями иям ием ями ами ией иях ии ях ах ов ев ей ий ый ой ая яя ое ее ые ие ого его ому ему ыми ими ом ем ам ям ью ию ия ья
+    ешь ете ишь ите ет ит ют ут ят ат ла ло ли ал ил ыл ть ться тся ся
+    а я о е ы и у ю ь й
+'''.split(), key=len, reverse=True)
+
+
+def stem(word):
+    '''
+    Strip the longest russian ending, so different forms of the word become the same term
+    '''
+    if CYRILLIC_RE.search(word):
+        for ending in RUSSIAN_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+                return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    '''
+    Return list of terms of the text: lowercased words with ё replaced by е and russian endings stripped
+    '''
+    words = WORD_RE.findall(force_text(text or '').lower().replace(u'ё', u'е'))
+    return [stem(word)[:MAX_TERM_LENGTH] for word in words if len(word) > 1]
+
+
+# (database, model) -> (time of counting, number of documents)
+documents_counts = {}
+
+
+def get_documents_count(model, using):
+    '''
+    Return number of objects of the model, it's counted once per SEARCH_COUNT_TIMEOUT seconds
+    '''
+    key = (using, model._meta.object_name)
+    counted, count = documents_counts.get(key, (0, None))
+    if count is None or time.time() - counted > SEARCH_COUNT_TIMEOUT:
+        count = model.objects.using(using).count()
+        documents_counts[key] = (time.time(), count)
+    return count
+
+
+class IndexSearchBackend(object):
+    '''
+    Search by inverted index in the SearchPosting table, maintained by remote managers after saving of instances.
+    Objects of the queryset should contain all terms of the query, they are ranked by tf-idf with saturated term
+    frequency, ranking and paging are made by the database
+    '''
+    maintained = True
+
+    def search(self, queryset, q, offset, limit):
+        from .models import SearchPosting, OBJECT_TYPES
+
+        terms = sorted(set(tokenize(q)))
+        if not terms:
+            return []
+
+        model = queryset.model
+        using = queryset.db
+        postings = SearchPosting.objects.using(using).filter(object_type=OBJECT_TYPES[model._meta.object_name],
+                                                             term__in=terms).order_by()
+        documents = dict(postings.values_list('term').annotate(documents=Count('object_id')))
+        if len(documents) < len(terms):
+            return []
+
+        total = float(get_documents_count(model, using))
+        weights = []
+        for term in terms:
+            weights += [term, math.log(1 + total / documents[term])]
+
+        qn = connections[using].ops.quote_name
+        matches, params = postings.filter(object_id__in=queryset.order_by().values('pk')) \
+            .values_list('object_id', 'term', 'count').query.get_compiler(using=using).as_sql()
+        sql = 'SELECT %s, SUM((CASE %s %s END) * 2.0 * %s / (%s + 1)) AS search_rank FROM (%s) matches ' \
+              'GROUP BY %s HAVING COUNT(*) = %%s ORDER BY search_rank DESC, %s LIMIT %%s OFFSET %%s' % (
+                  qn('object_id'), qn('term'), ' '.join(['WHEN %s THEN %s'] * len(terms)), qn('count'), qn('count'),
+                  matches, qn('object_id'), qn('object_id'))
+        cursor = connections[using].cursor()
+        cursor.execute(sql, weights + list(params) + [len(terms), limit, offset])
+        ranks = [(object_id, float(rank)) for object_id, rank in cursor.fetchall()]
+
+        instances = queryset.in_bulk([object_id for object_id, rank in ranks])
+        result = []
+        for object_id, rank in ranks:
+            instance = instances[object_id]
+            instance.search_rank = rank
+            result += [instance]
+        return result
+
+
+class PostgresSearchBackend(object):
+    '''
+    Native full-text search of PostgreSQL, ranked by ts_rank. Index on to_tsvector of the field is created by migration
+    '''
+    maintained = False
+
+    def search(self, queryset, q, offset, limit):
+        model = queryset.model
+        qn = connections[queryset.db].ops.quote_name
+        column = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.get_field(model.search_field).column))
+        vector = "to_tsvector('%s', %s)" % (SEARCH_POSTGRES_CONFIG, column)
+        query = "plainto_tsquery('%s', %%s)" % SEARCH_POSTGRES_CONFIG
+
+        queryset = queryset.extra(select={'search_rank': 'ts_rank(%s, %s)' % (vector, query)}, select_params=[q],
+                                  where=['%s @@ %s' % (vector, query)], params=[q])
+        return list(queryset.order_by('-search_rank', 'pk')[offset:offset + limit])
+
+
+BACKENDS = {
+    'index': IndexSearchBackend,
+    'postgres': PostgresSearchBackend,
+}
+
+
+def get_backend(using=DEFAULT_DB_ALIAS):
+    name = SEARCH_BACKEND
+    if name is None:
+        name = 'postgres' if connections[using].vendor == 'postgresql' else 'index'
+    return BACKENDS[name]()
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+# sent by remote managers of Album and Photo after saving of every page of instances
+page_saved = Signal(providing_args=['created_ids', 'updated_ids', 'changed_fields'])
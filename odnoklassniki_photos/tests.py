@@ -3,12 +3,13 @@ import simplejson as json
 from django.test import TestCase
 from .models import Album, Photo
 from .factories import AlbumFactory, PhotoFactory
+from .validation import CountLimitError
 from odnoklassniki_groups.factories import GroupFactory
 from odnoklassniki_users.models import User
 from odnoklassniki_users.factories import UserFactory
-from odnoklassniki_api.utils import OdnoklassnikiError
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from pytz import utc
+import time
 
 # ria news
 GROUP_ID = 50415375614101
@@ -61,7 +62,7 @@ class OdnoklassnikiPhotosTest(TestCase):
         self.assertTrue(albums_part.count() > 0)
 
         # test if count is more than max
-        self.assertRaises(OdnoklassnikiError, Album.remote.fetch, group=group, count=Album.remote.__class__.fetch_album_limit + 20)
+        self.assertRaises(CountLimitError, Album.remote.fetch, group=group, count=Album.remote.__class__.fetch_album_limit + 20)
 
         # test fetch with default count
         albums_part2 = Album.remote.fetch(group=group)
@@ -294,6 +295,7 @@ class OdnoklassnikiPhotosTest(TestCase):
 
         users = photo.fetch_likes(count=50)
 
+        self.assertEqual(users.model, User)
         self.assertEqual(50, len(users))
         self.assertEqual(50, User.objects.count())
 
@@ -358,3 +360,983 @@ class OdnoklassnikiPhotosTest(TestCase):
         self.assertEqual(instance.text, u'\u0415\u0441\u043b\u0438 \u0432\u044b \u0434\u0430\u0432\u043d\u043e \u043d\u0435 \u043f\u0438\u0441\u0430\u043b\u0438 \u043a\u043e\u043c\u0443-\u043d\u0438\u0431\u0443\u0434\u044c \u0440\u0443\u043a\u043e\u043f\u0438\u0441\u043d\u044b\u0435 \u043f\u043e\u0441\u043b\u0430\u043d\u0438\u044f \u2014 \u0441\u0435\u0433\u043e\u0434\u043d\u044f \u0435\u0441\u0442\u044c \u043f\u043e\u0432\u043e\u0434: \u0432 \u043c\u0438\u0440\u0435 \u043e\u0442\u043c\u0435\u0447\u0430\u044e\u0442 \u0414\u0435\u043d\u044c \u0440\u0443\u0447\u043d\u043e\u0433\u043e \u043f\u0438\u0441\u044c\u043c\u0430 \u0438\u043b\u0438, \u043f\u0440\u043e\u0449\u0435 \u0433\u043e\u0432\u043e\u0440\u044f, \u043f\u043e\u0447\u0435\u0440\u043a\u0430, \u043a\u043e\u0442\u043e\u0440\u044b\u0439 \u0443 \u043a\u0430\u0436\u0434\u043e\u0433\u043e \u0447\u0435\u043b\u043e\u0432\u0435\u043a\u0430 \u0443\u043d\u0438\u043a\u0430\u043b\u0435\u043d.')
         self.assertEqual(instance.owner, group)
         self.assertEqual(instance.album, album)
+
+    def test_crawl_scheduler_priorities(self):
+        from .scheduler import CrawlScheduler
+        from .models import CrawlTask
+
+        group = GroupFactory(id=GROUP_ID)
+        album_busy = AlbumFactory(id=ALBUM1_ID, owner=group, likes_count=10)
+        album_dead = AlbumFactory(id=ALBUM2_ID, owner=group)
+
+        scheduler = CrawlScheduler(budget=10)
+        tasks = scheduler.schedule_group(group)
+        # albums list, photos of 2 albums and likes of 1 album
+        self.assertEqual(len(tasks), 4)
+        self.assertEqual(CrawlTask.objects.count(), 4)
+        self.assertEqual(len(scheduler.schedule_group(group)), 4)
+        self.assertEqual(CrawlTask.objects.count(), 4)
+
+        now = datetime.utcnow().replace(tzinfo=utc)
+        task_busy = scheduler.get_task(CrawlTask.KIND_PHOTOS, album_busy)
+        task_dead = scheduler.get_task(CrawlTask.KIND_PHOTOS, album_dead)
+        self.assertEqual(task_busy.get_priority(now), CrawlTask.NEW_TASK_PRIORITY)
+
+        for task, count in [(task_busy, 0), (task_dead, 0), (task_busy, 100), (task_dead, 0)]:
+            task.last_run = task.last_run and task.last_run - timedelta(hours=1)
+            task.observe(count, None, now)
+            task.save()
+
+        self.assertTrue(task_busy.change_rate > task_dead.change_rate)
+        later = now + timedelta(hours=2)
+        self.assertTrue(task_busy.get_priority(later) > task_dead.get_priority(later))
+        self.assertTrue(task_dead.get_priority(later) > task_dead.get_priority(now))
+
+        self.assertEqual(scheduler.estimate_cost(task_busy), 1)
+
+        scheduler.update_priorities(later)
+        for task in [task_busy, task_dead]:
+            self.assertAlmostEqual(CrawlTask.objects.get(pk=task.pk).priority, task.get_priority(later), places=3)
+
+        task_dead.fail(now)
+        task_dead.fail(now)
+        self.assertEqual(task_dead.retry_after, now + CrawlTask.RETRY_BACKOFF * 2)
+        task_dead.observe(0, None, now)
+        self.assertEqual((task_dead.failures_count, task_dead.retry_after), (0, None))
+
+    def test_fields_projection(self):
+        fields, update_fields = Photo.remote.get_projection()
+        self.assertEqual(fields, Photo.remote.get_request_fields('group_photo', prefix=True))
+        self.assertEqual(update_fields, None)
+
+        fields, update_fields = Photo.remote.get_projection(['likes_count', 'last_like_date', 'comments_count'])
+        self.assertEqual(fields, 'group_photo.id,group_photo.album_id,group_photo.group_id,group_photo.author_type,'
+                                 'group_photo.like_summary,group_photo.comments_count')
+        self.assertEqual(update_fields, ['likes_count', 'last_like_date', 'comments_count'])
+        self.assertTrue('pic1024max' not in fields)
+
+        fields, update_fields = Album.remote.get_projection('likes_count')
+        self.assertEqual(fields, 'group_album.aid,group_album.group_id,group_album.author_type,group_album.like_summary')
+
+        self.assertRaises(ValueError, Photo.remote.get_projection, ['album'])
+
+        # stored photos are updated only by projected columns, by one statement for the page after reading of them
+        photos = [Photo.objects.get(pk=PhotoFactory(likes_count=1, text=u'Фото').pk) for i in range(3)]
+        for photo in photos:
+            photo.likes_count, photo.text = 10, u'Другое фото'
+        with self.assertNumQueries(2):
+            Photo.remote.save_instances(photos, update_fields=['likes_count'])
+        for photo in Photo.objects.filter(pk__in=[photo.pk for photo in photos]):
+            self.assertEqual((photo.likes_count, photo.text), (10, u'Фото'))
+            self.assertTrue(photo.fetched is not None)
+
+    def test_photo_update_counters(self):
+        from .models import values_differ
+
+        photo1 = PhotoFactory(likes_count=5, comments_count=1)
+        photo2 = PhotoFactory(likes_count=3, comments_count=2)
+        photo1, photo2 = Photo.objects.get(pk=photo1.pk), Photo.objects.get(pk=photo2.pk)
+
+        instances = [
+            Photo(id=photo1.pk, likes_count=7, comments_count=1, last_like_date=photo1.last_like_date),
+            Photo(id=photo2.pk, likes_count=3, comments_count=2, last_like_date=photo2.last_like_date),
+        ]
+        changed_ids = Photo.remote.update_counters(instances, Photo.counters_fields)
+
+        self.assertEqual(changed_ids, [photo1.pk])
+        self.assertEqual(Photo.objects.get(pk=photo1.pk).likes_count, 7)
+        self.assertEqual(Photo.objects.get(pk=photo1.pk).comments_count, 1)
+        self.assertEqual(Photo.objects.get(pk=photo2.pk).likes_count, 3)
+
+        # refresh of photo with the date of the last like, parsed date is aware, stored one is naive without USE_TZ
+        last_like_date = datetime(2014, 4, 16, 13, 37, 42, tzinfo=utc)
+        Photo.objects.filter(pk=photo2.pk).update(last_like_date=last_like_date)
+        instances = [
+            Photo(id=photo1.pk, likes_count=7, comments_count=1, last_like_date=photo1.last_like_date),
+            Photo(id=photo2.pk, likes_count=3, comments_count=2, last_like_date=last_like_date),
+        ]
+        self.assertEqual(Photo.remote.update_counters(instances, Photo.counters_fields), [])
+
+        instances[1].last_like_date = last_like_date + timedelta(minutes=1)
+        self.assertEqual(Photo.remote.update_counters(instances, Photo.counters_fields), [photo2.pk])
+        self.assertFalse(values_differ(instances[1].last_like_date, Photo.objects.get(pk=photo2.pk).last_like_date))
+
+    def test_page_saved_events(self):
+        from .models import ChangeEvent
+        from .signals import page_saved
+
+        photo1 = Photo.objects.get(pk=PhotoFactory(likes_count=5).pk)
+        photo2 = Photo.objects.get(pk=PhotoFactory(likes_count=3).pk)
+
+        events = []
+        def receiver(sender, **kwargs):
+            events.append((sender, kwargs['created_ids'], kwargs['updated_ids'], kwargs['changed_fields']))
+        page_saved.connect(receiver)
+        try:
+            Photo.remote.update_counters([
+                Photo(id=photo1.pk, likes_count=7, comments_count=photo1.comments_count, last_like_date=photo1.last_like_date),
+                Photo(id=photo2.pk, likes_count=3, comments_count=photo2.comments_count, last_like_date=photo2.last_like_date),
+            ], Photo.counters_fields)
+        finally:
+            page_saved.disconnect(receiver)
+        self.assertEqual(events, [(Photo, [], [photo1.pk], {photo1.pk: ['likes_count']})])
+
+        # every page of fetching is saved and announced before the next one is requested
+        from odnoklassniki_api.models import OdnoklassnikiManager
+
+        album = AlbumFactory()
+        def api_call(manager, *args, **kwargs):
+            page = int(kwargs.get('anchor') or 0) + 1
+            self.assertEqual(len(events), page - 1)
+            return {'photos': [{'id': str(PHOTO_ID + page), 'album_id': str(album.pk), 'group_id': str(album.owner_id),
+                                'author_type': 'GROUP'}], 'has_more': page < 2, 'anchor': str(page)}
+
+        original = OdnoklassnikiManager.api_call
+        OdnoklassnikiManager.api_call = api_call
+        events = []
+        page_saved.connect(receiver)
+        try:
+            Photo.remote.fetch(group=album.owner, album=album, all=True)
+        finally:
+            OdnoklassnikiManager.api_call = original
+            page_saved.disconnect(receiver)
+        self.assertEqual(events, [(Photo, [PHOTO_ID + 1], [], {}), (Photo, [PHOTO_ID + 2], [], {})])
+
+        # outbox is read by cursor
+        event1 = ChangeEvent.objects.record(Photo, [photo1.pk], {})
+        event2 = ChangeEvent.objects.record(Album, [], {photo2.pk: ['title']})
+        self.assertEqual(ChangeEvent.objects.read(lag=0), [event1, event2])
+        self.assertEqual(ChangeEvent.objects.read(cursor=event1.pk, lag=0), [event2])
+        self.assertEqual(ChangeEvent.objects.read(model=Photo, lag=0), [event1])
+        self.assertEqual(event1.get_created_ids(), [photo1.pk])
+        self.assertEqual(ChangeEvent.objects.get(pk=event2.pk).get_changed_fields(), {photo2.pk: ['title']})
+
+        # events aren't read until they are older than the lag
+        self.assertEqual(ChangeEvent.objects.read(cursor=event2.pk), [])
+        ChangeEvent.objects.all().delete()
+
+        # transaction of the first worker allocates lower pk, but commits after the second one
+        first = ChangeEvent.objects.record(Photo, [photo1.pk], {})
+        second = ChangeEvent.objects.record(Photo, [photo2.pk], {})
+        first_pk = first.pk
+        first.delete()
+        self.assertEqual(ChangeEvent.objects.read(), [])
+        first.pk = first_pk
+        first.save(force_insert=True)
+        ChangeEvent.objects.update(timestamp=datetime.utcnow().replace(tzinfo=utc) - timedelta(minutes=1))
+        self.assertEqual(ChangeEvent.objects.read(), [first, second])
+        ChangeEvent.objects.all().delete()
+
+        # inside of fetching events are appended after the commit, failed fetching doesn't append them
+        from . import models
+        from .routing import routed
+
+        @routed
+        def save(manager, fail=False):
+            manager.instances_saved([photo1.pk], {})
+            self.assertEqual(ChangeEvent.objects.count(), 0)
+            if fail:
+                raise ValueError()
+
+        outbox = models.EVENTS_OUTBOX
+        models.EVENTS_OUTBOX = True
+        try:
+            self.assertRaises(ValueError, save, Photo.remote, fail=True)
+            self.assertEqual(ChangeEvent.objects.count(), 0)
+            save(Photo.remote)
+            self.assertEqual([event.get_created_ids() for event in ChangeEvent.objects.all()], [[photo1.pk]])
+        finally:
+            models.EVENTS_OUTBOX = outbox
+
+    def test_counter_snapshots(self):
+        from .models import CounterSnapshot
+
+        photo = PhotoFactory()
+        now = int(time.time())
+
+        CounterSnapshot.objects.record(Photo, {photo.pk: {'likes_count': 1, 'comments_count': 2}}, timestamp=now - 7200)
+        CounterSnapshot.objects.record(Photo, {photo.pk: {'likes_count': 1, 'comments_count': 2}}, timestamp=now - 3600)
+        self.assertEqual(CounterSnapshot.objects.count(), 1)
+
+        CounterSnapshot.objects.record(Photo, {photo.pk: {'likes_count': 3, 'comments_count': 2}}, timestamp=now - 3500)
+        CounterSnapshot.objects.record(Photo, {photo.pk: {'likes_count': 4, 'comments_count': 2}}, timestamp=now)
+        self.assertEqual(CounterSnapshot.objects.count(), 3)
+
+        # only the last snapshot of every object is compared
+        object_type = CounterSnapshot.objects.get_object_type(Photo)
+        self.assertEqual(CounterSnapshot.objects.get_last(object_type, [photo.pk, photo.pk + 1]),
+                         {photo.pk: (now, 4, 0, 2)})
+
+        history = CounterSnapshot.objects.history(photo, since=datetime.utcnow().replace(tzinfo=utc) - timedelta(minutes=90))
+        self.assertEqual(list(history.values_list('likes_count', flat=True)), [3, 4])
+
+        # only the last snapshot in the interval remains
+        deleted = CounterSnapshot.objects.downsample(datetime.utcnow().replace(tzinfo=utc) + timedelta(1), 86400 * 365)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(CounterSnapshot.objects.get().likes_count, 4)
+
+    def test_photos_aggregates(self):
+        from . import models
+        from .models import PhotosAggregate
+
+        album = AlbumFactory()
+        photo1 = PhotoFactory(album=album, owner=album.owner, likes_count=5, comments_count=1)
+        photo2 = PhotoFactory(album=album, owner=album.owner, likes_count=3, comments_count=0)
+
+        self.assertEqual(PhotosAggregate.objects.rebuild(), 2)
+        aggregate = PhotosAggregate.objects.get_for(album)
+        self.assertEqual((aggregate.photos_count, aggregate.likes_count, aggregate.comments_count), (2, 8, 1))
+
+        photo3 = PhotoFactory(album=album, owner=album.owner, likes_count=2)
+        PhotosAggregate.objects.apply_changes({
+            photo1.pk: ({'likes_count': 5, 'comments_count': 1}, {'likes_count': 6, 'comments_count': 3}),
+            photo3.pk: (None, {'likes_count': 2, 'comments_count': 0}),
+        }, [photo1, photo3])
+
+        for instance in [album, album.owner]:
+            aggregate = PhotosAggregate.objects.get_for(instance)
+            self.assertEqual((aggregate.photos_count, aggregate.likes_count, aggregate.comments_count), (3, 11, 3))
+
+        Photo.objects.filter(pk=photo1.pk).update(likes_count=6, comments_count=3)
+        PhotosAggregate.objects.rebuild()
+        aggregate = PhotosAggregate.objects.get_for(album.owner)
+        self.assertEqual((aggregate.photos_count, aggregate.likes_count, aggregate.comments_count), (3, 11, 3))
+
+        # archived photo isn't counted, it's counted again after it reappears
+        aggregates = models.AGGREGATES
+        models.AGGREGATES = True
+        try:
+            Photo.objects.filter(pk=photo3.pk).update(archived=True)
+            PhotosAggregate.objects.rebuild()
+            aggregate = PhotosAggregate.objects.get_for(album)
+            self.assertEqual((aggregate.photos_count, aggregate.likes_count, aggregate.comments_count), (2, 9, 3))
+
+            photo3 = Photo.objects.get(pk=photo3.pk)
+            photo3.archived = False
+            Photo.remote.save_instances([photo3])
+            aggregate = PhotosAggregate.objects.get_for(album)
+            self.assertEqual((aggregate.photos_count, aggregate.likes_count, aggregate.comments_count), (3, 11, 3))
+        finally:
+            models.AGGREGATES = aggregates
+
+    def test_likes_lease(self):
+        from . import models
+        from .models import LikesLease
+
+        photo = PhotoFactory()
+
+        lease = LikesLease.objects.claim(photo)
+        self.assertTrue(lease is not None)
+
+        # another worker can't claim the lease until it's expired
+        LikesLease.objects.filter(pk=lease.pk).update(owner='another')
+        self.assertEqual(LikesLease.objects.claim(photo), None)
+        LikesLease.objects.filter(pk=lease.pk).update(expires=datetime.utcnow().replace(tzinfo=utc) - timedelta(1))
+        lease = LikesLease.objects.claim(photo)
+        self.assertTrue(lease is not None)
+
+        # fresh likes are not fetched again
+        LikesLease.objects.release(lease, synced=True)
+        self.assertTrue(LikesLease.objects.is_fresh(photo))
+        self.assertEqual(LikesLease.objects.claim(photo, full=True), None)
+        self.assertTrue(LikesLease.objects.claim(photo, full=False) is not None)
+
+        # stored likes are returned as queryset of users, the same as fetched ones
+        self.assertEqual(photo.fetch_likes(all=True).model, User)
+
+        # the lease is prolonged after every page of long fetching
+        from odnoklassniki_api.models import OdnoklassnikiManager
+
+        photo = PhotoFactory()
+        expires = []
+        def api_call(manager, *args, **kwargs):
+            lease = LikesLease.objects.get(object_id=photo.pk)
+            page = int(kwargs.get('anchor') or 0) + 1
+            if page == 1:
+                # almost expired lease of the previous page
+                LikesLease.objects.filter(pk=lease.pk).update(expires=datetime.utcnow().replace(tzinfo=utc))
+            else:
+                expires.append(lease.expires)
+            if lost:
+                LikesLease.objects.filter(pk=lease.pk).update(owner='another')
+            return {'users': [{'uid': str(561348705508 + page), 'name': u'Пользователь'}],
+                    'has_more': page < 2, 'anchor': str(page)}
+
+        original = OdnoklassnikiManager.api_call
+        OdnoklassnikiManager.api_call = api_call
+        try:
+            lost = False
+            self.assertEqual(photo.fetch_likes(all=True).count(), 2)
+            self.assertTrue(expires[0] > datetime.utcnow().replace(tzinfo=utc) + timedelta(seconds=models.LIKES_LEASE_TIMEOUT / 2))
+
+            # fetching stops, if the expired lease is claimed by another worker, stored likes stay the same
+            photo = PhotoFactory()
+            lost = True
+            self.assertEqual(photo.fetch_likes(all=True).count(), 0)
+        finally:
+            OdnoklassnikiManager.api_call = original
+
+    def test_photo_update_likes_by_chunks(self):
+        from . import models
+
+        photo = PhotoFactory()
+        users = [UserFactory() for i in range(7)]
+        ids = sorted([user.pk for user in users])
+
+        chunk_size = models.LIKES_CHUNK_SIZE
+        models.LIKES_CHUNK_SIZE = 2
+        try:
+            photo.update_likes(ids[:5])
+            self.assertEqual(sorted(photo.like_users.values_list('pk', flat=True)), ids[:5])
+
+            likes = photo.update_likes(reversed(ids[2:]))
+            self.assertEqual(sorted(likes.values_list('pk', flat=True)), ids[2:])
+            self.assertEqual(sorted(photo.like_users.were_at(datetime.now() - timedelta(1), only_pk=True)), [])
+        finally:
+            models.LIKES_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(Photo.like_users.through.objects.filter(photo=photo).count(), 7)
+        self.assertEqual(Photo.like_users.through.objects.filter(photo=photo, time_to=None).count(), 5)
+        # likes, removed between syncs, are closed in history
+        removed = Photo.like_users.through.objects.filter(photo=photo, user__in=ids[:2])
+        self.assertEqual(removed.count(), 2)
+        self.assertEqual(removed.filter(time_to=None).count(), 0)
+
+    def test_sorted_id_array(self):
+        from .utils import sorted_id_array
+
+        ids = [5, 3, 10 ** 12, 3, 1, 7, 5, 2]
+        for chunk_size in [1, 3, 100]:
+            self.assertEqual(list(sorted_id_array(iter(ids), chunk_size)), [1, 2, 3, 5, 7, 10 ** 12])
+        self.assertEqual(list(sorted_id_array([])), [])
+
+    def test_photos_prefetch_like_users(self):
+        photos = [PhotoFactory() for i in range(3)]
+        users = [UserFactory() for i in range(3)]
+        ids = sorted([user.pk for user in users])
+
+        photos[0].update_likes(ids[:2])
+        photos[1].update_likes(ids[1:])
+        Photo.like_users.through.objects.update(time_from=datetime.utcnow().replace(tzinfo=utc) - timedelta(1))
+        photos[1].update_likes([])
+
+        with self.assertNumQueries(2):
+            instances = Photo.objects.filter(pk__in=[photo.pk for photo in photos]).order_by('pk').prefetch_like_users(only_pk=True)
+        self.assertEqual([instance.prefetched_like_users for instance in instances], [ids[:2], [], []])
+
+        with self.assertNumQueries(3):
+            instances = Photo.objects.order_by('pk').prefetch_like_users(at=datetime.utcnow().replace(tzinfo=utc) - timedelta(hours=1))
+        self.assertEqual([user.pk for user in instances[1].prefetched_like_users], ids[1:])
+
+        instances = Photo.objects.order_by('pk').prefetch_like_users(only_count=True)
+        self.assertEqual([instance.prefetched_like_users for instance in instances], [2, 0, 0])
+
+    def test_page_size_controller(self):
+        from .paging import PageSizeController
+
+        # latency grows non-linearly with page size, the best items per second are at size 50
+        controller = PageSizeController(100, min_size=10, step=10, adaptive=True)
+        for i in range(30):
+            controller.record(controller.size, controller.size, 1 + (controller.size / 50.) ** 2)
+        self.assertTrue(40 <= controller.size <= 60)
+
+        # short last page doesn't change size
+        size = controller.size
+        controller.record(size, size - 1, 0.1)
+        self.assertEqual(controller.size, size)
+
+        controller.record(size, 0, 1, error=True)
+        self.assertEqual(controller.size, size // 2)
+        self.assertEqual(controller.get_metrics()['errors'], 1)
+
+        controller = PageSizeController(100, min_size=10, adaptive=False)
+        controller.record(100, 100, 100)
+        self.assertEqual(controller.size, 100)
+
+    def test_adaptive_page_size(self):
+        from odnoklassniki_api.models import OdnoklassnikiManager
+        from .paging import get_controller
+
+        group = GroupFactory(id=GROUP_ID)
+        album = AlbumFactory(id=ALBUM1_ID, owner=group)
+        controller = get_controller('photos.getPhotos')
+        size = controller.size
+        sizes = [60, 40]
+        counts = []
+
+        def api_call(manager, *args, **kwargs):
+            # the controller is tuned between pages, the next page is requested with the new size
+            counts.append(kwargs['count'])
+            page = len(counts)
+            if sizes:
+                controller.size = sizes.pop(0)
+            return {'photos': [{'id': str(PHOTO_ID + page), 'album_id': str(album.pk), 'group_id': str(group.pk),
+                                'author_type': 'GROUP'}], 'has_more': page < 3, 'anchor': str(page)}
+
+        original = OdnoklassnikiManager.api_call
+        OdnoklassnikiManager.api_call = api_call
+        try:
+            photos = Photo.remote.fetch(group=group, album=album, all=True)
+        finally:
+            OdnoklassnikiManager.api_call = original
+            controller.size = size
+
+        self.assertEqual(photos.count(), 3)
+        self.assertEqual(counts, [size, 60, 40])
+
+    def test_photos_search(self):
+        from .models import SearchPosting
+        from .search import tokenize
+
+        self.assertEqual(tokenize(u'Фотографии Москвы, ёлки'), [u'фотограф', u'москв', u'елк'])
+
+        photo1 = PhotoFactory(text=u'Москва. Фотографии Красной площади')
+        photo2 = PhotoFactory(text=u'Фотография Москвы, фотография Кремля')
+        photo3 = PhotoFactory(text=u'Петербург')
+        PhotoFactory(text=u'Фотография Москвы', owner=photo3.owner)
+        SearchPosting.objects.index(Photo, [photo1.pk, photo2.pk])
+
+        # index is built from texts and postings of the database of writes, even if reads are routed to a replica
+        from django.db import router
+        from . import routing
+        routers, read_database = router.routers, routing.READ_DATABASE
+        router.routers, routing.READ_DATABASE = [routing.PhotosRouter()], 'replica'
+        try:
+            self.assertEqual(SearchPosting.objects.rebuild(Photo), 4)
+        finally:
+            router.routers, routing.READ_DATABASE = routers, read_database
+
+        photos = Photo.objects.search(u'фотография москва')
+        self.assertEqual(len(photos), 3)
+        self.assertEqual(photos[0].pk, photo2.pk)
+        self.assertTrue(photos[0].search_rank > photos[1].search_rank)
+
+        self.assertEqual([photo.pk for photo in Photo.objects.search(u'фотография москва', group=photo1.owner)], [photo1.pk])
+        self.assertEqual(len(Photo.objects.search(u'фотография москва', page=2, per_page=2)), 1)
+        self.assertEqual(Photo.objects.search(u'кремль петербург'), [])
+
+        # ranking and paging are made by one query, archived photos aren't found
+        Photo.objects.filter(pk=photo2.pk).update(archived=True)
+        with self.assertNumQueries(3):
+            photos = Photo.objects.search(u'фотография москва', per_page=1)
+        self.assertEqual([photo.pk for photo in photos], [photo1.pk])
+        self.assertEqual(len(Photo.objects.search(u'фотография москва', archived=True)), 3)
+
+    def test_export(self):
+        from .export import export
+        import gzip
+        import os
+        import shutil
+        import tempfile
+
+        album = AlbumFactory()
+        photos = [Photo(id=PHOTO_ID + i, album=album, owner=album.owner, text=u'Фото %d' % i, created=datetime.now())
+                  for i in range(5)]
+        Photo.remote.save_instances(photos)
+        photos[0].update_likes([UserFactory().pk])
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'photos.jsonl.gz')
+            count, watermark = export('photos', path, chunk_size=2)
+            self.assertEqual(count, 5)
+            self.assertEqual(watermark, Photo.objects.get(pk=photos[0].pk).fetched)
+            with gzip.open(path) as f:
+                rows = [json.loads(line.decode('utf-8')) for line in f]
+            self.assertEqual([row['id'] for row in rows], sorted([photo.pk for photo in photos]))
+            self.assertEqual(rows[0]['text'], Photo.objects.order_by('pk')[0].text)
+
+            # incremental export, fetched is refreshed by saving, updating of counters and archiving
+            Photo.remote.save_instances([photos[3]])
+            count, watermark = export('photos', os.path.join(directory, 'photos.csv.gz'), format='csv', since=watermark,
+                                      lag=0)
+            self.assertEqual(count, 1)
+
+            photos[1].likes_count = 100
+            Photo.remote.update_counters([photos[1]], ['likes_count'])
+            Photo.remote.archive_missing([photo.pk for photo in photos if photo.pk != photos[2].pk], album_id=album.pk)
+            count, watermark = export('photos', os.path.join(directory, 'photos2.csv.gz'), format='csv', since=watermark,
+                                      lag=0)
+            self.assertEqual(count, 2)
+
+            # row, stamped before the watermark, but committed after the export, is exported by the next one
+            Photo.objects.filter(pk=photos[4].pk).update(fetched=watermark - timedelta(minutes=1))
+            path = os.path.join(directory, 'photos3.jsonl.gz')
+            self.assertEqual(export('photos', path, since=watermark, lag=0), (0, watermark))
+            count, watermark = export('photos', path, since=watermark)
+            with gzip.open(path) as f:
+                self.assertTrue(photos[4].pk in [json.loads(line.decode('utf-8'))['id'] for line in f])
+
+            count, watermark = export('photo_likes', os.path.join(directory, 'likes.jsonl.gz'))
+            self.assertEqual(count, 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_import_pages(self):
+        from .importer import PagesImporter
+        import os
+        import tempfile
+
+        group = GroupFactory(id=GROUP_ID)
+        album = AlbumFactory(id=ALBUM1_ID, owner=group)
+        photos = [{'id': str(PHOTO_ID + i), 'album_id': str(album.pk), 'group_id': str(group.pk), 'author_type': 'GROUP',
+                   'created_ms': 1390456312257, 'text': u'Фото %d' % i, 'comments_count': 1,
+                   'like_summary': {'count': 1, 'last_like_date_ms': 1397655462641}} for i in range(3)]
+        pages = [
+            {'photos': photos[:2]},
+            {'photos': photos[1:]},
+            {'photo_id': str(PHOTO_ID), 'users': [{'uid': '561348705508', 'name': u'Пользователь'}]},
+        ]
+
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for page in pages:
+                    f.write(json.dumps(page) + '\n')
+            counts = PagesImporter(batch_pages=2).import_file(path)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(counts['photos'], 3)
+        self.assertEqual(counts['likes'], 1)
+        self.assertEqual(Photo.objects.filter(album=album).count(), 3)
+        self.assertEqual(Photo.objects.get(pk=PHOTO_ID + 2).text, u'Фото 2')
+        self.assertEqual(list(Photo.objects.get(pk=PHOTO_ID).like_users.values_list('pk', flat=True)), [561348705508])
+
+        # related objects are checked before inserting, photos of missing album fail the batch
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps({'photos': [dict(photos[0], id=str(PHOTO_ID + 10), album_id=str(ALBUM2_ID))]}) + '\n')
+            self.assertRaises(Album.DoesNotExist, PagesImporter().import_file, path)
+        finally:
+            os.remove(path)
+
+    def test_like_edges_storage(self):
+        from . import models
+        from .models import LikeEdge
+
+        photo = PhotoFactory()
+        users = [UserFactory() for i in range(3)]
+        ids = sorted([user.pk for user in users])
+        photo.update_likes(ids[:2])
+
+        self.assertEqual(LikeEdge.objects.copy_from_m2m(Photo, chunk_size=1), 2)
+        self.assertEqual(LikeEdge.objects.filter(shard=photo.owner_id % models.LIKES_SHARDS).count(), 2)
+        self.assertEqual(LikeEdge.objects.get_copy_differences(Photo), [])
+        # difference of the copy from the source is detected
+        LikeEdge.objects.filter(user_id=ids[0]).update(removed=int(time.time()))
+        self.assertEqual(LikeEdge.objects.get_copy_differences(Photo), [('current likes', 2, 1)])
+        LikeEdge.objects.filter(user_id=ids[0]).update(removed=None)
+
+        storage = models.LIKES_STORAGE
+        models.LIKES_STORAGE = 'edges'
+        try:
+            likes = photo.update_likes(ids[1:])
+            self.assertEqual(sorted(likes.values_list('pk', flat=True)), ids[1:])
+            self.assertEqual(LikeEdge.objects.filter(object_id=photo.pk).count(), 3)
+            self.assertEqual(LikeEdge.objects.filter(object_id=photo.pk, removed=None).count(), 2)
+            self.assertEqual(list(photo.get_like_users(at=datetime.utcnow().replace(tzinfo=utc) - timedelta(1))), [])
+
+            instances = Photo.objects.filter(pk=photo.pk).prefetch_like_users(only_pk=True)
+            self.assertEqual(instances[0].prefetched_like_users, ids[1:])
+            self.assertEqual(sorted(photo.get_like_users().values_list('pk', flat=True)), ids[1:])
+
+            # copying after switching would replace likes fetched since then
+            from django.core.management import call_command
+            from django.core.management.base import CommandError
+            self.assertRaises(CommandError, call_command, 'odnoklassniki_photos_copy_likes')
+            self.assertEqual(LikeEdge.objects.filter(object_id=photo.pk).count(), 3)
+        finally:
+            models.LIKES_STORAGE = storage
+
+    def test_instances_cache(self):
+        from . import models
+        from .cache import get_instance_cache
+        from .routing import routed
+
+        photo = Photo.objects.get(pk=PhotoFactory(likes_count=1).pk)
+
+        cache = models.CACHE
+        models.CACHE = True
+        try:
+            self.assertEqual(Photo.objects.get_cached(photo.pk).likes_count, 1)
+            with self.assertNumQueries(0):
+                cached = Photo.objects.get_cached(photo.pk)
+            self.assertEqual(cached.album_id, photo.album_id)
+            self.assertEqual(Photo.objects.get_cached(photo.pk, owner=True).owner, photo.owner)
+
+            Photo.remote.update_counters([Photo(id=photo.pk, likes_count=5, comments_count=photo.comments_count,
+                                                last_like_date=photo.last_like_date)], Photo.counters_fields)
+            self.assertEqual(Photo.objects.get_cached(photo.pk).likes_count, 5)
+            self.assertRaises(Photo.DoesNotExist, Photo.objects.get_cached, 0)
+
+            # row, read into caches by other process before the commit, is removed after the fetching exits
+            instances_cache = get_instance_cache(Photo)
+            stale = instances_cache.local.get(instances_cache.get_key(photo.pk))
+
+            @routed
+            def update(manager):
+                Photo.objects.filter(pk=photo.pk).update(likes_count=7)
+                manager.invalidate_cache([photo.pk])
+                instances_cache.local.set(instances_cache.get_key(photo.pk), stale)
+                instances_cache.backend.set(instances_cache.get_key(photo.pk), stale)
+                self.assertEqual(Photo.objects.get_cached(photo.pk).likes_count, 5)
+
+            update(Photo.remote)
+            self.assertEqual(Photo.objects.get_cached(photo.pk).likes_count, 7)
+        finally:
+            models.CACHE = cache
+            get_instance_cache(Photo).invalidate([photo.pk])
+
+    def test_dry_run_diff(self):
+        from .dryrun import start_dry_run
+
+        album = AlbumFactory()
+        photos = [PhotoFactory(album=album, text=u'Фото') for i in range(3)]
+        users = [UserFactory() for i in range(3)]
+        ids = sorted([user.pk for user in users])
+        photos[0].update_likes(ids[:2])
+
+        changed = Photo.objects.get(pk=photos[0].pk)
+        changed.text = u'Другое фото'
+        new = Photo.objects.get(pk=photos[0].pk)
+        new.id, new.text = photos[0].pk + 10 ** 6, u'Новое фото'
+
+        with start_dry_run() as diff:
+            Photo.remote.save_instances([changed, new, Photo.objects.get(pk=photos[1].pk)])
+            Photo.remote.archive_missing([changed.pk, new.pk, photos[1].pk], album_id=photos[0].album_id)
+            photos[0].update_likes(ids[1:])
+
+        self.assertEqual(diff.models['Photo']['new'], [new.pk])
+        self.assertEqual(diff.models['Photo']['changed'], {changed.pk: ['text']})
+        self.assertEqual(diff.models['Photo']['unchanged'], [photos[1].pk])
+        self.assertEqual(diff.models['Photo']['missing'], [photos[2].pk])
+        self.assertEqual(diff.likes['Photo:%s' % photos[0].pk], {'added': [ids[2]], 'removed': [ids[0]], 'unchanged': 1})
+        self.assertEqual(diff.summary()['likes'], {'added': 1, 'removed': 1, 'unchanged': 1})
+
+        # nothing is written
+        self.assertEqual(Photo.objects.count(), 3)
+        self.assertEqual(Photo.objects.get(pk=changed.pk).text, u'Фото')
+        self.assertEqual(Photo.objects.filter(archived=True).count(), 0)
+        self.assertEqual(sorted(photos[0].like_users.values_list('pk', flat=True)), ids[:2])
+
+    def test_fetch_params_rejected_early(self):
+        from .models import PhotoBaseRemoteManager
+        from .validation import FetchParamsError, MissingParamError, ParamTypeError
+
+        photo = PhotoFactory()
+        album, group = photo.album, photo.album.owner
+        api_calls_count = PhotoBaseRemoteManager.api_calls_count
+
+        # no transaction, no queries and no API requests
+        with self.assertNumQueries(0):
+            self.assertRaises(CountLimitError, Album.remote.fetch, group=group, count=Album.remote.__class__.fetch_album_limit + 1)
+            self.assertRaises(ParamTypeError, Album.remote.fetch, group=group, count='10')
+            self.assertRaises(MissingParamError, Album.remote.fetch, all=True)
+            self.assertRaises(ParamTypeError, Album.remote.fetch, group=group.pk)
+            self.assertRaises(ParamTypeError, Album.remote.fetch_group_specific, group=group, ids=111)
+            self.assertRaises(MissingParamError, Photo.remote.fetch_group_specific, group=group, ids=[PHOTO_ID])
+            self.assertRaises(FetchParamsError, Photo.remote.fetch, group=group, album=album, count=10, archive_missing=True)
+            self.assertRaises(FetchParamsError, Photo.remote.fetch, group=group, album=album, fields=['album'])
+            self.assertRaises(CountLimitError, photo.fetch_likes, count=Photo.fetch_like_users_limit + 1)
+
+        self.assertEqual(PhotoBaseRemoteManager.api_calls_count, api_calls_count)
+
+    def test_database_routing(self):
+        from odnoklassniki_groups.models import Group
+        from .routing import PhotosRouter, get_replica_database, get_replica_lag, get_write_database, routed, using_database
+
+        router = PhotosRouter()
+        self.assertEqual(router.db_for_write(Photo), 'default')
+        self.assertEqual(router.db_for_read(Group), None)
+        with using_database('default'):
+            with using_database():
+                self.assertEqual(get_write_database(), 'default')
+                self.assertEqual(router.db_for_read(Photo), 'default')
+
+        # database without replication is never lagging
+        self.assertEqual(get_replica_lag('default'), 0)
+        self.assertEqual(get_replica_database(), 'default')
+
+        photo = PhotoFactory()
+        self.assertEqual(Photo.remote.filter_by_ids([photo.pk]).db, 'default')
+        self.assertTrue(router.allow_relation(photo, photo.album))
+
+        # querysets of nested fetch methods see the transaction of fetching, only the outermost one is read from replica
+        from . import routing
+        read_database = routing.READ_DATABASE
+        routing.READ_DATABASE = 'replica'
+        try:
+            @routed
+            def fetch(manager):
+                self.assertEqual(manager.filter_by_ids([photo.pk]).db, 'default')
+                return manager.filter_by_ids([photo.pk])
+
+            self.assertEqual(routing.get_read_database(), 'replica')
+            self.assertEqual(fetch(Photo.remote).db, 'replica')
+            with using_database('default'):
+                self.assertEqual(routing.get_read_database(), 'default')
+        finally:
+            routing.READ_DATABASE = read_database
+
+        # values deciding writes aren't read from a replica, even if it isn't lagging
+        replica_database = routing.get_replica_database
+        routing.get_replica_database = lambda: 'replica'
+        try:
+            photo = Photo.objects.get(pk=photo.pk)
+            photo.likes_count += 1
+            Photo.remote.save_instances([photo])
+            self.assertEqual(Photo.remote.update_counters([photo], ['likes_count']), [])
+            self.assertEqual(Photo.objects.get(pk=photo.pk).likes_count, photo.likes_count)
+        finally:
+            routing.get_replica_database = replica_database
+
+    def test_profile_run(self):
+        from django.core.management import call_command
+        from django.utils import six
+        from requests.models import Response
+        from . import profiling
+        from .profiling import in_phase, profile_run
+        import os
+        import shutil
+        import tempfile
+
+        # responses are decoded by API client inside of http phase
+        @in_phase('http')
+        def api_call():
+            response = Response()
+            response._content = ('[%s]' % ', '.join(['{"id": "%d", "text": "photo"}' % i for i in range(5000)])).encode('utf-8')
+            response.encoding = 'utf-8'
+            return response.json()
+
+        photo = Photo.objects.get(pk=PhotoFactory().pk)
+        directory = tempfile.mkdtemp()
+        try:
+            for mode in ['cprofile', 'sampling']:
+                with profile_run('test', mode=mode, directory=directory, interval=0.001) as run:
+                    Photo.remote.save_instances([photo])
+                    api_call()
+                self.assertTrue(run.seconds['persist'] > 0)
+                self.assertTrue(run.seconds['decode'] > 0)
+
+            paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+            self.assertEqual(len([path for path in paths if path.endswith('.json')]), 2)
+            self.assertTrue([path for path in paths if path.endswith('.persist.prof')])
+            self.assertTrue([path for path in paths if path.endswith('.decode.prof')])
+            self.assertTrue([path for path in paths if path.endswith('.collapsed')])
+
+            output = six.StringIO()
+            call_command('odnoklassniki_photos_profile_summary', *paths, sort='cumulative', stdout=output)
+            self.assertTrue('save_instances' in output.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+        # without active runs phases aren't accounted, even if the thread has a stale run
+        profiling.state.run = object()
+        try:
+            self.assertEqual(len(api_call()), 5000)
+        finally:
+            profiling.state.run = None
+
+    def test_sync_workers(self):
+        from django.core.management import CommandError
+        from django.db import connections
+        from odnoklassniki_api.models import OdnoklassnikiManager
+        from .management.commands import odnoklassniki_photos_sync as sync
+
+        group = GroupFactory(id=GROUP_SMALL_ID)
+
+        def api_call(manager, *args, **kwargs):
+            # canned pages: one album with two pages of photos
+            if manager.model is Album:
+                return {'albums': [{'aid': str(ALBUM1_ID), 'group_id': str(group.pk), 'author_type': 'GROUP',
+                                    'title': 'Album'}], 'has_more': False}
+            page = int(kwargs.get('anchor') or 0) + 1
+            return {'photos': [{'id': str(PHOTO_ID + page), 'album_id': str(ALBUM1_ID), 'group_id': str(group.pk),
+                                'author_type': 'GROUP'}], 'has_more': page < 2, 'anchor': str(page)}
+
+        # every connection of the parent process is closed in the worker, not only the default one,
+        # and is opened again by the first query of the worker
+        log = []
+        def logged(action, alias, method=None):
+            def wrapper():
+                log.append((action, alias))
+                return method() if method else None
+            return wrapper
+
+        for connection in connections.all():
+            connection.close = logged('close', connection.alias)
+            connection.cursor = logged('cursor', connection.alias, connection.cursor)
+        original = OdnoklassnikiManager.api_call
+        OdnoklassnikiManager.api_call = api_call
+        try:
+            sync.init_worker()
+            closed = [alias for action, alias in log if action == 'close']
+            result = sync.sync_group(GROUP_SMALL_ID)
+        finally:
+            OdnoklassnikiManager.api_call = original
+            for connection in connections.all():
+                del connection.close
+                del connection.cursor
+        self.assertEqual(sorted(closed), sorted([connection.alias for connection in connections.all()]))
+        self.assertTrue(('cursor', 'default') in log[log.index(('close', 'default')):])
+
+        self.assertEqual(result['error'], None)
+        self.assertEqual(result['photos'], 2)
+        self.assertEqual(result['requests'], 3)
+        self.assertEqual(Album.objects.filter(owner_id=GROUP_SMALL_ID).count(), 1)
+        self.assertEqual(sorted(Photo.objects.filter(owner_id=GROUP_SMALL_ID).values_list('pk', flat=True)),
+                         [PHOTO_ID + 1, PHOTO_ID + 2])
+
+        self.assertRaises(CommandError, sync.Command().handle, file=None, workers=1, summary=None)
+
+    def test_parse_response_list(self):
+        from .models import datetimes_from_timestamps_ms
+
+        self.assertEqual(datetimes_from_timestamps_ms([1397655462641, '1397655462641', 0, '0', None, '', 'wrong']),
+                         [datetime(2014, 4, 16, 13, 37, 42, tzinfo=utc)] * 2 + [None] * 5)
+
+        group = GroupFactory(id=GROUP_ID)
+        album = AlbumFactory(id=ALBUM_BIG_ID, owner=group)
+        resources = [{'id': str(PHOTO_ID + i), 'album_id': str(ALBUM_BIG_ID), 'group_id': str(GROUP_ID),
+                      'author_type': 'GROUP', 'author_name': 'RIA', 'created_ms': 1390456312257,
+                      'pic50x50': 'http://mycdn.me/%d' % i,
+                      'like_summary': {'count': i, 'last_like_date_ms': 1397655462641 if i else 0}} for i in range(3)]
+
+        # groups and albums of the whole page are read by one query each
+        with self.assertNumQueries(2):
+            instances = Photo.remote.parse_response_list(resources)
+
+        self.assertEqual([instance.pk for instance in instances], [PHOTO_ID, PHOTO_ID + 1, PHOTO_ID + 2])
+        for i, instance in enumerate(instances):
+            self.assertEqual(instance.album_id, album.pk)
+            self.assertEqual(instance.owner, group)
+            self.assertEqual(instance.owner_name, 'RIA')
+            self.assertEqual(instance.created, datetime(2014, 1, 23, 5, 51, 52, tzinfo=utc))
+            self.assertEqual(instance.pic50x50, 'http://mycdn.me/%d' % i)
+            self.assertEqual(instance.likes_count, i)
+        # zero timestamp is missing date of the last like, not 1970
+        self.assertEqual(instances[0].last_like_date, None)
+        self.assertEqual(instances[1].last_like_date, datetime(2014, 4, 16, 13, 37, 42, tzinfo=utc))
+
+        resources[0]['album_id'] = str(ALBUM2_ID)
+        self.assertRaises(Album.DoesNotExist, Photo.remote.parse_response_list, resources)
+
+    def test_filter_by_ids_table(self):
+        from django.db import DatabaseError
+        from .routing import routed
+        from .utils import drop_ids_tables, filter_by_ids, get_ids_tables, IdsTable, IN_CLAUSE_LIMIT
+
+        photos = [PhotoFactory() for i in range(3)]
+        ids = [photo.pk for photo in photos] + list(range(10 ** 12, 10 ** 12 + IN_CLAUSE_LIMIT * 3))
+
+        self.assertEqual(filter_by_ids(Photo.objects.all(), ids).count(), 3)
+        self.assertEqual(filter_by_ids(Photo.objects.all(), ids[:2]).count(), 2)
+        # long list of ids works as subquery
+        self.assertEqual(Album.objects.filter(photos__in=filter_by_ids(Photo.objects.all(), ids)).distinct().count(), 3)
+        # ids aren't inlined into the statement, temporary tables of the thread are dropped after fetching
+        queryset = filter_by_ids(Photo.objects.all(), ids)
+        self.assertTrue(len(str(queryset.values('pk').query)) < 500)
+        self.assertEqual(len(get_ids_tables(queryset)), 1)
+
+        @routed
+        def fetch(manager):
+            return manager.filter_by_ids(ids)
+
+        photos_ids = fetch(Photo.remote)
+        self.assertEqual(sorted(photos_ids.values_list('pk', flat=True)), sorted([photo.pk for photo in photos]))
+        self.assertRaises(DatabaseError, queryset.count)
+        drop_ids_tables()
+        self.assertRaises(DatabaseError, photos_ids.count)
+
+        table = IdsTable(ids[1:])
+        self.assertEqual(table.count, len(ids) - 1)
+        self.assertEqual(list(table.exclude(Photo.objects.all()).values_list('pk', flat=True)), [photos[0].pk])
+        # ids of albums and photos of factories can coincide, so only albums of one group are filtered
+        album = AlbumFactory(id=10 ** 12)
+        self.assertEqual(list(table.filter(Album.objects.filter(owner_id=album.owner_id), 'id').values_list('pk', flat=True)), [album.pk])
+        table.drop()
+
+    def test_archive_missing(self):
+        album = AlbumFactory()
+        photos = [PhotoFactory(album=album, owner=album.owner) for i in range(3)]
+        photo_another = PhotoFactory()
+
+        count = Photo.remote.archive_missing([photos[0].pk], album_id=album.pk)
+        self.assertEqual(count, 2)
+        self.assertEqual(list(Photo.objects.filter(archived=False).order_by('pk').values_list('pk', flat=True)),
+                         sorted([photos[0].pk, photo_another.pk]))
+        self.assertTrue(Photo.objects.get(pk=photos[1].pk).archived_date is not None)
+
+        # already archived are not touched
+        self.assertEqual(Photo.remote.archive_missing([], album_id=album.pk), 1)
+
+        # reappeared photo is unarchived completely
+        photo = Photo.objects.get(pk=photos[1].pk)
+        photo.archived, photo.archived_date = False, None
+        Photo.remote.save_instances([photo])
+        photo = Photo.objects.get(pk=photos[1].pk)
+        self.assertEqual((photo.archived, photo.archived_date), (False, None))
+
+        self.assertRaises(ValueError, Album.remote.fetch, group=album.owner, archive_missing=True)
+
+    def test_photo_images_downloader(self):
+        from .downloader import ImageStore, PhotoImageDownloader
+        from .models import PhotoImage
+        import shutil
+        import tempfile
+        import threading
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        requests_paths = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_paths.append(self.path)
+                content = ('image %s' % self.path).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        root = tempfile.mkdtemp()
+        try:
+            url = 'http://127.0.0.1:%d/' % server.server_port
+            photos = [PhotoFactory(pic128x128=url + '%d.jpg' % i) for i in range(3)]
+            downloader = PhotoImageDownloader(sizes=['pic128x128'], store=ImageStore(root, max_size=10 ** 6), workers=2)
+
+            self.assertEqual(downloader.download(Photo.objects.all()), (3, 0))
+            self.assertEqual(PhotoImage.objects.count(), 3)
+            image = PhotoImage.objects.get_local(photos[0], 'pic128x128')
+            with open(downloader.store.get_full_path(image.path), 'rb') as f:
+                self.assertEqual(f.read(), b'image /0.jpg')
+
+            # cached images are skipped
+            self.assertEqual(downloader.download(Photo.objects.all()), (0, 0))
+            self.assertEqual(len(requests_paths), 3)
+
+            # total size of the store is tracked, PhotoImage table isn't aggregated while it's less than max_size
+            self.assertEqual(downloader.store.total, image.bytes * 3)
+            with self.assertNumQueries(0):
+                self.assertEqual(downloader.store.evict(), 0)
+
+            # least recently accessed images are evicted
+            downloader.store.max_size = image.bytes
+            self.assertEqual(downloader.store.evict(), 2)
+            self.assertEqual(list(PhotoImage.objects.values_list('pk', flat=True)), [image.pk])
+            self.assertEqual(downloader.store.total, image.bytes)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(root)
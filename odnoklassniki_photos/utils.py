@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from array import array
+from functools import wraps
+from importlib import import_module
+import heapq
+import threading
+
+# max count of ids in IN clause, more ids are filtered by temporary table
+IN_CLAUSE_LIMIT = getattr(settings, 'ODNOKLASSNIKI_PHOTOS_IN_CLAUSE_LIMIT', 500)
+# count of rows in one INSERT into temporary table, 500 is the limit of SQLite
+IDS_TABLE_CHUNK_SIZE = 500
+# count of ids, sorted at once by sorted_id_array()
+IDS_SORT_CHUNK_SIZE = 10000
+IDS_TABLE_PREFIX = 'odnoklassniki_photos_ids_'
+
+# temporary tables of querysets of filter_by_ids(), created by the thread: list of IdsTable
+state = threading.local()
+
+
+def bulk_update(model, values, fields, using=DEFAULT_DB_ALIAS):
+    '''
+    Update `fields` of many rows of the `model` table by one UPDATE statement with CASE expression for every field.
+    `values` is dict of pk -> tuple of values in order of `fields`
+    '''
+    if not values:
+        return 0
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+
+    assignments = []
+    params = []
+    for i, field_name in enumerate(fields):
+        field = model._meta.get_field(field_name)
+        column = qn(field.column)
+        cases = []
+        for pk, row in values.items():
+            cases += ['WHEN %s THEN %%s' % int(pk)]
+            params += [field.get_db_prep_save(row[i], connection=connection)]
+        # ELSE branch keeps type of the column for NULL values in CASE
+        assignments += ['%s = CASE %s %s ELSE %s END' % (column, pk_column, ' '.join(cases), column)]
+
+    sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (qn(model._meta.db_table), ', '.join(assignments), pk_column,
+                                                 ', '.join([str(int(pk)) for pk in values]))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.rowcount
+
+
+def id_array(ids=()):
+    '''
+    Return compact array of 64-bit ids
+    '''
+    try:
+        return array('q', ids)
+    except ValueError:
+        # type code 'q' is not available before python 3.3, 'l' is 64-bit on 64-bit unix platforms
+        return array('l', ids)
+
+
+def sorted_id_array(ids, chunk_size=IDS_SORT_CHUNK_SIZE):
+    '''
+    Return compact array of unique ids from iterable `ids` in ascending order.
+    Ids are sorted by chunks and merged chunks are streamed into the array, so list or set of all ids is never built
+    '''
+    chunks, chunk = [], []
+    for pk in ids:
+        chunk.append(pk)
+        if len(chunk) >= chunk_size:
+            chunks.append(id_array(sorted(chunk)))
+            chunk = []
+    if chunk:
+        chunks.append(id_array(sorted(chunk)))
+
+    result = id_array()
+    last = None
+    for pk in heapq.merge(*chunks):
+        if pk != last:
+            result.append(pk)
+            last = pk
+    return result
+
+
+def merge_sorted_ids(remote_ids, stored_ids):
+    '''
+    Compare 2 ascending sequences of unique ids and yield tuples (id, True) for ids only in `remote_ids`
+    and (id, False) for ids only in `stored_ids`
+    '''
+    remote_ids, stored_ids = iter(remote_ids), iter(stored_ids)
+    remote_id, stored_id = next(remote_ids, None), next(stored_ids, None)
+    while remote_id is not None or stored_id is not None:
+        if stored_id is None or remote_id is not None and remote_id < stored_id:
+            yield remote_id, True
+            remote_id = next(remote_ids, None)
+        elif remote_id is None or stored_id < remote_id:
+            yield stored_id, False
+            stored_id = next(stored_ids, None)
+        else:
+            remote_id, stored_id = next(remote_ids, None), next(stored_ids, None)
+
+
+def lazy_decorator(path, *args):
+    '''
+    Decorator `path` ('module.name') applied on the first call of the function, so the module is imported
+    only when it's used, not while importing models. `args` are arguments of the decorator factory
+    '''
+    def decorator(func):
+        decorated = []
+
+        @wraps(func)
+        def wrapper(*a, **kw):
+            if not decorated:
+                module, name = path.rsplit('.', 1)
+                real = getattr(import_module(module), name)
+                decorated.append(real(*args)(func) if args else real(func))
+            return decorated[0](*a, **kw)
+        return wrapper
+    return decorator
+
+
+class IdsTable(object):
+    '''
+    Temporary table of the DB session with set of ids. Querysets are filtered by join with it
+    instead of IN clause with all ids, so they work with any number of ids on any backend.
+    Querysets filtered by it should be evaluated in the same session before the table is removed by drop()
+    '''
+    def __init__(self, ids, using=DEFAULT_DB_ALIAS):
+        # uuid imports ctypes on python 2, it's needed only for archiving of missing instances
+        from uuid import uuid4
+
+        self.using = using
+        self.name = '%s%s' % (IDS_TABLE_PREFIX, uuid4().hex[:16])
+
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE %s (id BIGINT PRIMARY KEY)' % qn(self.name))
+
+        ids = sorted(set([int(id) for id in ids]))
+        # ids are integers, so they are inlined to avoid limits of count of query parameters
+        for i in range(0, len(ids), IDS_TABLE_CHUNK_SIZE):
+            values = ', '.join(['(%d)' % id for id in ids[i:i + IDS_TABLE_CHUNK_SIZE]])
+            cursor.execute('INSERT INTO %s (id) VALUES %s' % (qn(self.name), values))
+
+        self.count = len(ids)
+
+    def filter(self, queryset, field='pk'):
+        '''
+        Filter queryset by join with the table on values of `field`, ids in the table are unique,
+        so rows aren't duplicated
+        '''
+        qn = connections[self.using].ops.quote_name
+        opts = queryset.model._meta
+        column = opts.pk.column if field == 'pk' else opts.get_field(field).column
+        return queryset.extra(tables=[self.name], where=['%s.%s = %s.id' % (qn(opts.db_table), qn(column), qn(self.name))])
+
+    def exclude(self, queryset, field='pk'):
+        '''
+        Exclude from queryset rows with values of `field` in the table
+        '''
+        qn = connections[self.using].ops.quote_name
+        opts = queryset.model._meta
+        column = opts.pk.column if field == 'pk' else opts.get_field(field).column
+        return queryset.extra(where=['%s.%s NOT IN (SELECT id FROM %s)' % (qn(opts.db_table), qn(column), qn(self.name))])
+
+    def drop(self):
+        # the table is already removed, if the transaction, that created it, is rolled back
+        connection = connections[self.using]
+        connection.cursor().execute('DROP TABLE IF EXISTS %s' % connection.ops.quote_name(self.name))
+
+
+def filter_by_ids(queryset, ids, field='pk'):
+    '''
+    Filter queryset by list of ids: by IN clause with parameters for short lists, for long ones on PostgreSQL
+    by one array parameter, so size of the statement and planning don't depend on count of ids,
+    on other backends by join with temporary table of ids in the session of the queryset database.
+    Such queryset should be evaluated in the same session before drop_ids_tables() of the thread
+    '''
+    if len(ids) <= IN_CLAUSE_LIMIT:
+        return queryset.filter(**{'%s__in' % field: list(ids)})
+
+    connection = connections[queryset.db]
+    opts = queryset.model._meta
+    column = opts.pk.column if field == 'pk' else opts.get_field(field).column
+    ids = sorted(set([int(id) for id in ids]))
+    if connection.vendor == 'postgresql':
+        qn = connection.ops.quote_name
+        return queryset.extra(where=['%s.%s = ANY(%%s::bigint[])' % (qn(opts.db_table), qn(column))],
+                              params=['{%s}' % ','.join([str(id) for id in ids])])
+
+    table = IdsTable(ids, using=queryset.db)
+    if not hasattr(state, 'tables'):
+        state.tables = []
+    state.tables.append(table)
+    return table.filter(queryset, field)
+
+
+def get_ids_tables(queryset):
+    '''
+    Return names of temporary tables of ids, the queryset depends on
+    '''
+    return [name for name in queryset.query.extra_tables if name.startswith(IDS_TABLE_PREFIX)]
+
+
+def drop_ids_tables(keep=()):
+    '''
+    Drop temporary tables of filter_by_ids(), created by the thread, except tables with names in `keep`
+    '''
+    tables = getattr(state, 'tables', [])
+    state.tables = [table for table in tables if table.name in keep]
+    for table in tables:
+        if table.name not in keep:
+            table.drop()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from django.utils import six
+from functools import wraps
+from .paging import PAGE_LIMITS
+
+
+class FetchParamsError(ValueError):
+    '''
+    Wrong parameters of fetching, detected before any transaction or API request
+    '''
+
+
+class MissingParamError(FetchParamsError):
+    pass
+
+
+class ParamTypeError(FetchParamsError, TypeError):
+    pass
+
+
+class CountLimitError(FetchParamsError):
+    pass
+
+
+def check_instance(name, value, model, required=True):
+    if value is None:
+        if required:
+            raise MissingParamError('Parameter %s (object of %s.%s) is required' % (name, model.__module__, model.__name__))
+    elif not isinstance(value, model):
+        raise ParamTypeError('Parameter %s should be object of %s.%s, not %r' % (name, model.__module__, model.__name__, value))
+
+
+def check_ids(name, value):
+    if value is None:
+        raise MissingParamError('Parameter %s (list or tuple of ints) is required' % name)
+    if not isinstance(value, (list, tuple)) or not all([isinstance(id, six.integer_types) for id in value]):
+        raise ParamTypeError('Parameter %s should be list or tuple of ints, not %r' % (name, value))
+
+
+def check_count(count, api_method):
+    '''
+    Check `count` of items per request of the API method against its limit
+    '''
+    if count is None:
+        return
+    if isinstance(count, bool) or not isinstance(count, six.integer_types):
+        raise ParamTypeError('Parameter count should be int, not %r' % (count,))
+    limit = PAGE_LIMITS[api_method]
+    if not 0 < count <= limit:
+        raise CountLimitError('Parameter count of %s should be between 1 and %d, not %d' % (api_method, limit, count))
+
+
+def check_archive_missing(archive_missing, paginated):
+    '''
+    Missing items are detected only after fetching of all pages
+    '''
+    if archive_missing and not paginated:
+        raise FetchParamsError('Parameter archive_missing is applicable only for fetching of all items')
+
+
+def validated(method):
+    '''
+    Decorator of fetch methods of remote managers: parameters are checked by the method `validate_<name>`
+    of the manager before the call, so wrong ones are rejected without transaction and API requests
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        getattr(self, 'validate_%s' % method.__name__)(*args, **kwargs)
+        return method(self, *args, **kwargs)
+    return wrapper
@@ -17,6 +17,7 @@ setup(
         'django-odnoklassniki-api>=0.1.0',
         'django-odnoklassniki-groups>=0.0.6',
         'django-odnoklassniki-users>=0.0.6',
+        'requests',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',